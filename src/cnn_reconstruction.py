@@ -15,35 +15,80 @@ import time
 import glob
 import types
 import keras
+import json
 import atexit
 import warnings
 import tensorflow as tf
 
 from keras import losses
 from inspect import signature
+from dataclasses import replace
 
 # from utils.log import *
 from model.cnn_model import *
 from utils.plotting import *
+from utils.labels import LabelSchema
+from utils.normalize import Normalizer, fit_files
+from utils.precision import decode, storage_of
+from utils.valid_index import valid_index
+from utils.sparse_grid import fit_sparse_files, sparse_shapes
+from utils.training_cache import open_training_cache
 from model.model import Model, TrainingArgs
+from model.sampler import GlobalSampler, SamplerCursor
+from model.distributed import cluster_task, is_chief, shard_files
+from model.autotune import autotuned_args
+from model.checkpoint import TrainingCheckpoint, latest_checkpoint, load_checkpoint
+from model.schedule import EpochSchedule, step_decay
+from functools import partial
+from model.pipeline import (
+    PROVENANCE_DTYPE,
+    FilePrefetcher,
+    PrefetchWait,
+    dataset_shapes,
+    load_file,
+    make_array_dataset,
+    make_dataset,
+    make_prefetched_dataset,
+    make_sparse_dataset,
+)
 
 print(f"Tensorflow Version: {tf.__version__}")
 
 print(f"Keras Version: {keras.__version__}")
 
-tf.config.threading.set_inter_op_parallelism_threads(12)
-tf.config.threading.set_intra_op_parallelism_threads(12)
-
 
 # TODO - Working on combining with Model base class
 class Convolution(Model):
 
     def __init__(self, args: TrainingArgs) -> None:
 
-        super().__init__(args)
+        # Only the chief task of a distributed run writes to `output_dir`
+        self.chief = not args.distributed or is_chief()
+
+        if not self.chief:
+            args = replace(args, save=False, notify=False)
+
+        # Threads and batch size left unset come from `model.autotune`
+        super().__init__(autotuned_args(args))
+
+        self._configure_threads()
+
+        # Must exist before any other TensorFlow op runs
+        if self.args.distributed:
+            self.strategy = tf.distribute.MultiWorkerMirroredStrategy()
+        else:
+            self.strategy = tf.distribute.get_strategy()
 
         self.callbacks = []
 
+        # Batches come from a tf.data pipeline instead of in memory arrays
+        self.streamed = (
+            self.args.streaming
+            or self.args.sparse
+            or self.args.distributed
+            or self.args.memmap_dir is not None
+        )
+
         if self.args.save == True:
             if not self.args.continue_train:
                 super()._make_output_dir()
@@ -54,13 +99,14 @@ class Convolution(Model):
 
         self._get_training_data()
 
-        self._build_model()
+        with self.strategy.scope():
+            self._build_model()
 
-        self._build_learning_func()
+            self._build_learning_func()
 
-        self._build_loss_function()
+            self._build_loss_function()
 
-        self._compile_model_params()
+            self._compile_model_params()
 
     def __str__(self) -> str:
         if self.built:
@@ -68,8 +114,45 @@ class Convolution(Model):
         else:
             return "Convolutional Neural Network"
 
+    def _configure_threads(self):
+        """
+        Protected method setting the TensorFlow thread pools from TrainingArgs
+        data class arguments `inter_op_threads` and `intra_op_threads`, or the
+        autotuned configuration of the host, otherwise the TensorFlow default
+        is kept. Pools are fixed once TensorFlow runs.
+
+        :returns: None
+        """
+
+        pools = [
+            (
+                self.args.inter_op_threads,
+                tf.config.threading.get_inter_op_parallelism_threads,
+                tf.config.threading.set_inter_op_parallelism_threads,
+            ),
+            (
+                self.args.intra_op_threads,
+                tf.config.threading.get_intra_op_parallelism_threads,
+                tf.config.threading.set_intra_op_parallelism_threads,
+            ),
+        ]
+
+        for threads, current, configure in pools:
+            if threads is not None and current() != threads:
+                configure(threads)
+
     def _get_training_files(self):
 
+        if self.args.memmap_dir is not None:
+
+            assert os.path.isdir(
+                self.args.memmap_dir
+            ), "`TrainingArgs.memmap_dir` must pass directory written by `utils.training_cache`"
+
+            self.files = self.args.memmap_dir
+
+            return self.files
+
         if self.args.multi_file:
 
             assert os.path.isdir(
@@ -78,12 +161,16 @@ class Convolution(Model):
 
             files_with_paths = os.path.join(
                 self.args.data_dir,
-                "*_contained.hdf5",
+                "*_sparse.hdf5" if self.args.sparse else "*_contained.hdf5",
             )
 
             self.files = sorted(glob.glob(files_with_paths))
 
-            if len(self.files) > self.args.epochs:
+            if (
+                len(self.files) > self.args.epochs
+                and not self.args.global_sampler
+                and not self.args.distributed
+            ):
                 warnings.warn(
                     "there are more files than epochs, some files will not be trained on"
                 )
@@ -103,26 +190,49 @@ class Convolution(Model):
     def _get_training_data(self, hdf=None):
         """
         Protected method that gets model training data using TrainingArgs data class argument `data_dir`.
+        Only the valid events, those of positive `train_variable`, are read,
+        as every other mode trains on.
 
         :returns: None
         """
+        if self.args.memmap_dir is not None:
+            self._get_training_cache()
+            return
+
+        if self.streamed:
+            self._get_training_shapes()
+            return
+
         if hdf is None:
             if self.args.multi_file:
                 hdf = h5py.File(self.files[0], "r")
             else:
                 hdf = h5py.File(self.files, "r")
 
-        self.X_train_DC = hdf["X_train_DC"][:]
-        self.X_train_IC = hdf["X_train_IC"][:]
-        self.Y_train = hdf["Y_train"][:, 14]
+        labels = LabelSchema.from_hdf(hdf)
+        index = valid_index(hdf.filename, self.args.train_variable, hdf)
+
+        # Keras casts float16 itself, bfloat16 bit patterns are decoded
+        def grid(split, detector):
+            dataset = hdf[f"X_{split}_{detector}"]
+            storage = storage_of(dataset)
+            X = index.read(dataset, split)
+            return decode(X, storage) if storage == "bfloat16" else X
 
-        self.X_validate_DC = hdf["X_validate_DC"][:]
-        self.X_validate_IC = hdf["X_validate_IC"][:]
-        self.Y_validate = hdf["Y_validate"][:, 14]
+        def truth(split):
+            return labels.read(hdf, split, self.args.train_variable)[index.rows[split]]
 
-        self.X_test_DC = hdf["X_test_DC"][:]
-        self.X_test_IC = hdf["X_test_IC"][:]
-        self.Y_test = hdf["Y_test"][:, 14]
+        self.X_train_DC = grid("train", "DC")
+        self.X_train_IC = grid("train", "IC")
+        self.Y_train = truth("train")
+
+        self.X_validate_DC = grid("validate", "DC")
+        self.X_validate_IC = grid("validate", "IC")
+        self.Y_validate = truth("validate")
+
+        self.X_test_DC = grid("test", "DC")
+        self.X_test_IC = grid("test", "IC")
+        self.Y_test = truth("test")
 
         assert len(self.Y_train) > 0, "Truth training data is empty"
         assert len(self.Y_validate) > 0, "Truth validating data is empty"
@@ -138,6 +248,98 @@ class Convolution(Model):
 
         self.data = True
 
+    def _get_training_shapes(self):
+        """
+        Protected method used with TrainingArgs data class arguments `streaming`
+        and `sparse`. Reads only the dataset shapes from file metadata, the
+        feature arrays are empty placeholders carrying the per event shape for
+        `make_network` and batches are streamed from file by `_dataset`.
+
+        :returns: None
+        """
+
+        files = self.files if self.args.multi_file else [self.files]
+
+        shapes_of = sparse_shapes if self.args.sparse else dataset_shapes
+
+        for split in ["train", "validate", "test"]:
+            shapes = shapes_of(files[0], split)
+
+            for name, (shape, dtype) in shapes.items():
+                assert shape[0] > 0, f"{name} is empty"
+
+                if name.startswith("X_"):
+                    setattr(self, name, np.empty((0,) + shape[1:], dtype=dtype))
+
+        self.data = True
+
+    def _get_training_cache(self):
+        """
+        Protected method used with TrainingArgs data class argument `memmap_dir`.
+        Opens the `.npy` files of a training cache with `np.memmap`, batches are
+        zero copy page cache reads shared with other runs on the node.
+
+        :returns: None
+        """
+
+        self.memmap = open_training_cache(self.args.memmap_dir)
+
+        manifest = self.memmap["manifest"]
+
+        assert (
+            manifest["label"] == self.args.train_variable
+        ), f"training cache holds label `{manifest['label']}`, not `{self.args.train_variable}`"
+
+        for split in ["train", "validate", "test"]:
+            for name in [f"X_{split}_DC", f"X_{split}_IC", f"Y_{split}"]:
+                assert len(self.memmap[name]) > 0, f"{name} is empty"
+
+                setattr(self, name, self.memmap[name])
+
+        self.data = True
+
+    def _dataset(self, files, split, shuffle=True, seed=None):
+        """
+        Protected method building a `tf.data` pipeline streaming `split` of
+        `files` in batches of TrainingArgs data class argument `batch_size`,
+        or of the memory mapped arrays with `memmap_dir`, shuffled by `seed`.
+
+        :returns: tf.data.Dataset
+        """
+
+        if self.args.memmap_dir is not None:
+            arrays = self.memmap["manifest"]["arrays"]
+
+            return make_array_dataset(
+                getattr(self, f"X_{split}_DC"),
+                getattr(self, f"X_{split}_IC"),
+                getattr(self, f"Y_{split}"),
+                batch_size=self.args.batch_size,
+                shuffle=shuffle,
+                seed=seed,
+                storage_DC=arrays[f"X_{split}_DC"].get("storage", "float32"),
+                storage_IC=arrays[f"X_{split}_IC"].get("storage", "float32"),
+            )
+
+        if self.args.sparse:
+            return make_sparse_dataset(
+                files,
+                split,
+                batch_size=self.args.batch_size,
+                label=self.args.train_variable,
+                shuffle=shuffle,
+                seed=seed,
+            )
+
+        return make_dataset(
+            files,
+            split,
+            batch_size=self.args.batch_size,
+            label=self.args.train_variable,
+            shuffle_buffer=self.args.shuffle_buffer if shuffle else None,
+            seed=seed,
+        )
+
     def _build_model(self):
         """
         Protected method for taking training data and building model. Takes
@@ -156,18 +358,87 @@ class Convolution(Model):
             self.args.activation,
         )
 
+        if self.args.norm_method is not None:
+            self._build_normalization()
+
         self.built = True
 
-    # TODO - Change so learning rate function works with _compile_model_params (throws error)
+    def _build_normalization(self):
+        """
+        Protected method that puts normalization layers in front of the network
+        using TrainingArgs data class argument `norm_method`. Statistics are
+        computed in one streaming pass over the training files, or loaded when
+        continuing a run, and saved next to the model. Batches are normalized
+        in graph so no normalized copy of the data is held.
+
+        :returns: None
+        """
+
+        files = self.files if self.args.multi_file else [self.files]
+
+        self.normalizers = {}
+
+        for detector in ["DC", "IC"]:
+            path = None
+            if self.args.save:
+                path = os.path.join(self.path, f"normalization_{detector}.npz")
+
+            if path is not None and os.path.isfile(path):
+                self.normalizers[detector] = Normalizer.load(path)
+            elif self.args.memmap_dir is not None:
+                X_train = getattr(self, f"X_train_{detector}")
+                storage = self.memmap["manifest"]["arrays"][f"X_train_{detector}"].get(
+                    "storage", "float32"
+                )
+
+                self.normalizers[detector] = Normalizer(self.args.norm_method).fit(
+                    decode(X_train[start : start + 4096], storage)
+                    for start in range(0, len(X_train), 4096)
+                )
+
+                if path is not None:
+                    self.normalizers[detector].save(path)
+            elif self.args.sparse:
+                self.normalizers[detector] = fit_sparse_files(
+                    files, f"X_train_{detector}", self.args.norm_method
+                )
+
+                if path is not None:
+                    self.normalizers[detector].save(path)
+            else:
+                self.normalizers[detector] = fit_files(
+                    files, f"X_train_{detector}", self.args.norm_method
+                )
+
+                if path is not None:
+                    self.normalizers[detector].save(path)
+
+        network = self.model
+
+        input_DC = keras.Input(shape=network.inputs[0].shape[1:])
+        input_IC = keras.Input(shape=network.inputs[1].shape[1:])
+
+        output = network(
+            [
+                self.normalizers["DC"].keras_layer(name="normalize_DC")(input_DC),
+                self.normalizers["IC"].keras_layer(name="normalize_IC")(input_IC),
+            ]
+        )
+
+        self.model = keras.Model(inputs=[input_DC, input_IC], outputs=output)
+
     def _build_learning_func(self):
         """
-        Protected method for building learning rate scheduler for keras callbacks.
-        Uses TrainingArgs data class arguments `lr_func` and appends the learning
-        rate scheduler to the self.callbacks instance variable.
+        Protected method for building the learning rate function of the epoch
+        used by `EpochSchedule`. Uses TrainingArgs data class argument
+        `lr_func`, called with the epoch as a tensor, or else `step_decay`, and
+        sets the self.lr_func instance variable.
 
         :returns: None
         """
 
+        self.lr_func = step_decay
+
         if self.args.lr_func is not None:
             sig = signature(self.args.lr_func)
 
@@ -186,11 +457,7 @@ Learning rate function `TrainingArgs.lr_func` should take 4 parameters:
 
 """
 
-            lr_scheduler = keras.callbacks.LearningRateScheduler(
-                lambda epoch: self.args.lr_func
-            )
-
-            self.callbacks.append(lr_scheduler)
+            self.lr_func = self.args.lr_func
 
     def _build_loss_function(self):
 
@@ -223,7 +490,6 @@ Learning rate function `TrainingArgs.lr_func` should take 4 parameters:
 
             self.loss = "mae"
 
-    # TODO - Figure out how learning rate functions work with keras.optimizer
     def _compile_model_params(self):
 
         if self.args.early:
@@ -238,13 +504,6 @@ Learning rate function `TrainingArgs.lr_func` should take 4 parameters:
                 )
             )
 
-        if self.args.optimizer is not None:
-            self.optimizer = self.args.optimizer
-        else:
-            self.optimizer = keras.optimizers.Adam(
-                learning_rate=self.args.learning_rate
-            )
-
         if self.args.save:
             log_dir = self.path + "/logs/"
 
@@ -252,16 +511,112 @@ Learning rate function `TrainingArgs.lr_func` should take 4 parameters:
                 tf.keras.callbacks.TensorBoard(log_dir=log_dir, write_images=True)
             )
 
-        if not self.args.multi_file:
+        # Multi file training compiles once it knows the steps of an epoch
+        if not self.args.multi_file or self.args.memmap_dir is not None:
+            self.optimizer = self._build_optimizer(self._steps_per_epoch())
+
             self.model.compile(
                 optimizer=self.optimizer,
                 loss=self.loss,
                 metrics=[self.loss],
+                **self._compile_options(),
             )
 
+    def _build_optimizer(self, steps_per_epoch):
+        """
+        Protected method returning TrainingArgs data class argument `optimizer`,
+        or Adam with an `EpochSchedule` of `lr_func` from `learning_rate`,
+        `lr_drop` and `epochs_step_drop`, epochs of `steps_per_epoch` steps
+        counted from `start_epoch`. An epoch is one pass over the training
+        data in every mode unless `steps_per_epoch` is set, the steps used are
+        printed.
+
+        :returns: keras.optimizers.Optimizer
+        """
+
+        print(f"Steps per epoch: {steps_per_epoch}")
+
+        if self.args.optimizer is not None:
+            return self.args.optimizer
+
+        schedule = EpochSchedule(
+            self.args.learning_rate,
+            self.args.lr_drop,
+            self.args.epochs_step_drop,
+            steps_per_epoch,
+            initial_epoch=self.args.start_epoch,
+            function=self.lr_func,
+        )
+
+        return keras.optimizers.Adam(learning_rate=schedule)
+
+    def _split_steps(self, files, split):
+        """
+        Protected method counting the batches of one pass over the valid
+        events of `split` of `files`, from their valid row indexes.
+
+        :returns: int
+        """
+
+        if isinstance(files, str):
+            files = [files]
+
+        rows = sum(
+            valid_index(file, self.args.train_variable).count(split) for file in files
+        )
+
+        return max(-(-rows // self.args.batch_size), 1)
+
+    def _steps_per_epoch(self):
+        """
+        Protected method counting the batches of one pass over the training
+        data of `_fit_model`, the streamed files or the arrays in memory.
+
+        :returns: int
+        """
+
+        if self.streamed and self.args.memmap_dir is None:
+            return self._split_steps(self.files, "train")
+
+        return max(-(-len(self.Y_train) // self.args.batch_size), 1)
+
+    def _validation_steps(self):
+        """
+        Protected method returning the validation batches of every epoch of
+        multi file training, TrainingArgs data class argument
+        `validation_steps` or else those of an average file, so validation
+        does not grow with the number of files. The stream is unshuffled and
+        restarts every epoch, every epoch validates on the same events.
+
+        :returns: int
+        """
+
+        if self.args.validation_steps is not None:
+            return self.args.validation_steps
+
+        return max(self._split_steps(self.files, "validate") // len(self.files), 1)
+
+    def _compile_options(self):
+        """
+        Protected method returning the `model.compile` options of TrainingArgs
+        data class arguments `jit_compile`, XLA compilation of the train
+        function, and `steps_per_execution`, training steps per call of it.
+
+        :returns: dict
+        """
+
+        return {
+            "jit_compile": self.args.jit_compile,
+            "steps_per_execution": self.args.steps_per_execution,
+        }
+
     def fit_model(self):
 
-        if self.args.multi_file:
+        if self.args.distributed:
+            self._fit_distributed_model()
+        elif self.args.multi_file and self.args.global_sampler:
+            self._fit_sampled_model()
+        elif self.args.multi_file and self.args.memmap_dir is None:
             self._fit_large_model()
         else:
             self._fit_model()
@@ -269,108 +624,122 @@ Learning rate function `TrainingArgs.lr_func` should take 4 parameters:
         return
 
     def _fit_large_model(self):
+        """
+        Protected method used with TrainingArgs data class argument
+        `multi_file`. Trains in a single `fit` on a stream cycling through the
+        files, from `_dataset` with `streaming`, otherwise whole files loaded
+        into memory by a `FilePrefetcher` while the previous one trains, every
+        file shuffled by the run seed and its position in the run.
+        Epochs are `steps_per_epoch` batches, by default one pass over every
+        file as in the other modes, so `EpochSchedule` decays the learning
+        rate at the same pace whatever the storage. A restored epoch continues
+        from the file and batch it stopped at. Every epoch validates on the
+        same `_validation_steps` batches and prints the time it waited for
+        files, kept in the self.data_wait instance variable.
 
-        self.history = {"loss": [], "mae": [], "val_loss": [], "val_mae": []}
+        :returns: None
+        """
 
         self.log_dir = self.path + "/logs/"
 
-        tensorboard_callback = tf.keras.callbacks.TensorBoard(
-            log_dir=self.log_dir, write_images=True
+        # Batches of every file, in memory batches never span two files
+        file_steps = [self._split_steps(file, "train") for file in self.files]
+
+        # One pass over every valid event, as `memmap_dir` counts it
+        steps_per_epoch = self.args.steps_per_epoch or self._split_steps(
+            self.files, "train"
         )
 
         self.model.compile(
             loss="mae",
-            optimizer=keras.optimizers.Adam(learning_rate=self.args.learning_rate),
+            optimizer=self._build_optimizer(steps_per_epoch),
             metrics=["mae"],
+            **self._compile_options(),
         )
 
-        if self.args.continue_train:
-            self.model.load_weights(self.args.load_model_path)
-        else:
-            weight_path = self.path + "/model_while_running.keras"
+        checkpoint = self._training_checkpoint()
 
-        for epoch in range(
-            self.args.start_epoch, self.args.start_epoch + self.args.epochs
-        ):
-
-            start = time.time()
+        self.history = checkpoint.history
 
-            current_lr = self.args.learning_rate * math.pow(
-                self.args.lr_drop,
-                math.floor((1 + epoch / 1000) / self.args.epochs_step_drop),
-            )
+        end = self.args.start_epoch + self.args.epochs
 
-            self.model.optimizer.learning_rate.assign(current_lr)
+        prefetchers = []
 
-            file = self.files[epoch % len(self.files)]
+        def train_data(initial_epoch, epochs, skip):
+            if self.streamed:
+                return self._epoch_stream(
+                    lambda seed: self._dataset(self.files, "train", seed=seed),
+                    initial_epoch,
+                    epochs,
+                    skip,
+                    steps_per_epoch,
+                )
 
-            hdf = h5py.File(file, "r")
+            # Batches trained on since `start_epoch`, by whole cycles of files
+            done = (initial_epoch - self.args.start_epoch) * steps_per_epoch + skip
+            cycles, done = divmod(done, sum(file_steps))
 
-            X_train_DC = hdf["X_train_DC"][:]
-            X_train_IC = hdf["X_train_IC"][:]
-            Y_train = hdf["Y_train"][:, 14]
-            X_validate_DC = hdf["X_validate_DC"][:]
-            X_validate_IC = hdf["X_validate_IC"][:]
-            Y_validate = hdf["Y_validate"][:, 14]
+            remaining = (end - initial_epoch) * steps_per_epoch - skip
 
-            valid_train = np.where(Y_train > 0)
-            X_train_DC = X_train_DC[valid_train]
-            X_train_IC = X_train_IC[valid_train]
-            Y_train = Y_train[valid_train]
+            first = 0
+            while done >= file_steps[first]:
+                done -= file_steps[first]
+                first += 1
 
-            valid_validate = np.where(Y_validate > 0)
-            X_validate_DC = X_validate_DC[valid_validate]
-            X_validate_IC = X_validate_IC[valid_validate]
-            Y_validate = Y_validate[valid_validate]
+            # Files in training order, enough for every remaining batch
+            order = []
+            while remaining > 0:
+                file = (first + len(order)) % len(self.files)
+                remaining -= file_steps[file] - (done if not order else 0)
+                order.append(self.files[file])
 
-            # if epoch > 0:
-            #     self.model.load_weights(weight_path)
+            prefetcher = FilePrefetcher(
+                order,
+                partial(load_file, splits=("train",), label=self.args.train_variable),
+                self.args.prefetch_buffers,
+            )
+            prefetchers.append(prefetcher)
 
-            history = self.model.fit(
-                [X_train_DC, X_train_IC],
-                Y_train,
-                validation_data=(
-                    [X_validate_DC, X_validate_IC],
-                    Y_validate,
-                ),
+            # Each file is shuffled by its position in the run
+            return make_prefetched_dataset(
+                prefetcher,
                 batch_size=self.args.batch_size,
-                initial_epoch=epoch,
-                epochs=epoch + 1,  # increment to next epoch
-                callbacks=[
-                    keras.callbacks.ModelCheckpoint(
-                        "%s/model_while_running.keras" % self.path
-                    ),
-                    tensorboard_callback,
-                ],
-                verbose=2,
+                skip=done,
+                seed=self.seed,
+                first=cycles * len(self.files) + first,
             )
 
-            hdf.close()
-
-            del (
-                X_train_DC,
-                X_train_IC,
-                Y_train,
-                X_validate_DC,
-                X_validate_IC,
-                Y_validate,
-                file,
-                hdf,
+        validation_steps = self._validation_steps()
+
+        data_wait = PrefetchWait(prefetchers, verbose=not self.streamed)
+
+        callbacks = [
+            tf.keras.callbacks.TensorBoard(log_dir=self.log_dir, write_images=True),
+            data_wait,
+            checkpoint,
+        ]
+
+        def fit(initial_epoch, epochs, skip):
+            return self.model.fit(
+                train_data(initial_epoch, epochs, skip),
+                validation_data=self._dataset(self.files, "validate", shuffle=False),
+                validation_steps=validation_steps,
+                steps_per_epoch=steps_per_epoch - skip,
+                initial_epoch=initial_epoch,
+                epochs=epochs,
+                callbacks=callbacks,
+                verbose=self.args.verbose,
             )
 
-            mae = history.history["mae"][0]
-            val_mae = history.history["val_mae"][0]
+        self._fit_epochs(checkpoint, fit)
+        self._finish_checkpoints(checkpoint)
 
-            self.history["loss"].append(history.history["loss"][0])
-            self.history["mae"].append(mae)
-            self.history["val_loss"].append(history.history["val_loss"][0])
-            self.history["val_mae"].append(val_mae)
+        self.data_wait = data_wait.epochs
 
-            end = time.time()
+        if not self.streamed:
+            files = sum(len(prefetcher.wait_times) for prefetcher in prefetchers)
 
-            print(
-                f"Epoch: {epoch}, Time: {end-start:.2f}s, Error: {mae:.4f}, Val Error: {val_mae:.4f}, Learning Rate: {current_lr}"
-            )
+            print(f"Files: {files}, Data Wait: {sum(self.data_wait):.2f}s")
 
         model_path = self.path + "/keras.keras"
 
@@ -383,28 +752,443 @@ Learning rate function `TrainingArgs.lr_func` should take 4 parameters:
 
         self.fit = True
 
-    def _fit_model(self):
+    def _fit_sampled_model(self):
+        """
+        Protected method used with TrainingArgs data class argument
+        `global_sampler`. Trains in a single `fit` on batches mixing every file
+        from a `GlobalSampler`, `steps_per_epoch` batches per epoch, one pass
+        over the valid events by default, in the order of the run seed, each
+        validated on the same `_validation_steps` batches. The
+        sampler cursor is saved to `sampler_cursor.json` every epoch and with
+        every training checkpoint, which `continue_train` restores.
+
+        :returns: None
+        """
 
-        self.history = self.model.fit(
-            [self.X_train_DC, self.X_train_IC],
-            self.Y_train,
-            validation_data=([self.X_validate_DC, self.X_validate_IC], self.Y_validate),
+        assert not self.args.sparse, "`global_sampler` reads dense shards only"
+
+        self.log_dir = self.path + "/logs/"
+
+        self.sampler = GlobalSampler(
+            self.files,
+            "train",
             batch_size=self.args.batch_size,
-            epochs=self.args.epochs,
-            callbacks=self.callbacks,
-            verbose=self.args.verbose,
+            label=self.args.train_variable,
+        )
+
+        cursor_path = os.path.join(self.path, "sampler_cursor.json")
+
+        steps_per_epoch = self.args.steps_per_epoch or self.sampler.steps_per_pass
+
+        self.model.compile(
+            loss="mae",
+            optimizer=self._build_optimizer(steps_per_epoch),
+            metrics=["mae"],
+            **self._compile_options(),
         )
 
+        checkpoint = self._training_checkpoint(
+            extra=lambda: {"sampler": self.sampler.state()}
+        )
+
+        # Known once the checkpoint is restored, a saved cursor keeps its own
+        self.sampler.seed = self.seed
+
+        if "sampler" in checkpoint.state:
+            self.sampler.restore(checkpoint.state["sampler"])
+        elif self.args.continue_train:
+            saved_cursor = os.path.join(
+                os.path.dirname(self.args.load_model_path), "sampler_cursor.json"
+            )
+            if os.path.exists(saved_cursor):
+                self.sampler.load(saved_cursor)
+
+        # The cursor advances before the checkpoint saves it
+        callbacks = [
+            SamplerCursor(self.sampler, cursor_path),
+            checkpoint,
+            tf.keras.callbacks.TensorBoard(log_dir=self.log_dir, write_images=True),
+        ]
+
+        validation_steps = self._validation_steps()
+
+        def fit(initial_epoch, epochs, skip):
+            return self.model.fit(
+                self.sampler.dataset(),
+                validation_data=self._dataset(self.files, "validate", shuffle=False),
+                validation_steps=validation_steps,
+                steps_per_epoch=steps_per_epoch - skip,
+                initial_epoch=initial_epoch,
+                epochs=epochs,
+                callbacks=callbacks,
+                verbose=self.args.verbose,
+            )
+
+        self._fit_epochs(checkpoint, fit)
+        self._finish_checkpoints(checkpoint)
+
+        self.history = checkpoint.history
+
+        model_path = self.path + "/keras.keras"
+
+        self.model.save(model_path)
+
+        self.fit = True
+
+    def _fit_distributed_model(self):
+        """
+        Protected method used with TrainingArgs data class argument
+        `distributed`, one task of a `MultiWorkerMirroredStrategy` cluster
+        described by `TF_CONFIG`, see `model.distributed`. Every task streams
+        its own shard of the files in batches of `batch_size` and gradients
+        are all-reduced each step. Keras `fit` cannot reduce multi input
+        batches across workers, so steps run in a custom loop. Epochs are
+        `steps_per_epoch` batches, by default those of the smallest shard, so
+        every task runs the same steps. Only the chief writes checkpoints,
+        logs, history and the trained model. Full training state checkpoints
+        are written at epoch boundaries, every task resumes from the latest.
+
+        :returns: None
+        """
+
+        assert self.args.multi_file, "`distributed` shards the files of `data_dir`"
+        assert (
+            self.args.memmap_dir is None and not self.args.global_sampler
+        ), "`distributed` streams shards, not `memmap_dir` or `global_sampler`"
+
+        task, tasks = cluster_task()
+
+        shards = [shard_files(self.files, worker, tasks) for worker in range(tasks)]
+
+        def steps(split):
+            rows = min(
+                sum(
+                    valid_index(file, self.args.train_variable).count(split)
+                    for file in shard
+                )
+                for shard in shards
+            )
+            return max(rows // self.args.batch_size, 1)
+
+        steps_per_epoch = self.args.steps_per_epoch or steps("train")
+        validation_steps = steps("validate")
+
+        # Each task builds the batches of its own shard, nothing is resharded
+        train = iter(
+            self.strategy.distribute_datasets_from_function(
+                lambda context: self._dataset(shards[task], "train").repeat()
+            )
+        )
+        validation = iter(
+            self.strategy.distribute_datasets_from_function(
+                lambda context: self._dataset(
+                    shards[task], "validate", shuffle=False
+                ).repeat()
+            )
+        )
+
+        loss_func = keras.losses.get(self.loss)
+
+        with self.strategy.scope():
+            self.optimizer = self._build_optimizer(steps_per_epoch)
+
+            self.model.compile(optimizer=self.optimizer, loss=self.loss)
+            self.optimizer.build(self.model.trainable_variables)
+
+            # Every task restores, only the chief writes
+            checkpoint = self._training_checkpoint()
+
+        def forward(batch, training):
+            (X_DC, X_IC), Y = batch
+            predicted = self.model([X_DC, X_IC], training=training)
+            Y = tf.cast(tf.reshape(Y, [-1, 1]), predicted.dtype)
+
+            loss = tf.reduce_mean(loss_func(Y, predicted))
+            mae = tf.reduce_mean(tf.abs(Y - predicted))
+
+            return loss, mae
+
+        def train_step(batch):
+            with tf.GradientTape() as tape:
+                loss, mae = forward(batch, True)
+                # Gradients are summed over replicas
+                scaled = loss / self.strategy.num_replicas_in_sync
+
+            variables = self.model.trainable_variables
+            gradients = tape.gradient(scaled, variables)
+            self.optimizer.apply_gradients(zip(gradients, variables))
+
+            return loss, mae
+
+        def validate_step(batch):
+            return forward(batch, False)
+
+        def distributed(step):
+            @tf.function(reduce_retracing=True)
+            def run(iterator):
+                metrics = self.strategy.run(step, args=(next(iterator),))
+                return [self.strategy.reduce("MEAN", m, axis=None) for m in metrics]
+
+            def epoch(iterator, steps):
+                return np.mean(
+                    [[m.numpy() for m in run(iterator)] for _ in range(steps)], axis=0
+                )
+
+            return epoch
+
+        train_epoch, validate_epoch = distributed(train_step), distributed(
+            validate_step
+        )
+
+        if self.args.save:
+            self.log_dir = self.path + "/logs/"
+            writer = tf.summary.create_file_writer(self.log_dir)
+
+        checkpoint.set_model(self.model)
+
+        self.history = checkpoint.history
+
+        epochs = range(
+            checkpoint.state["epoch"], self.args.start_epoch + self.args.epochs
+        )
+
+        for epoch in epochs:
+
+            start = time.time()
+
+            current_lr = float(self.optimizer.learning_rate)
+
+            loss, mae = train_epoch(train, steps_per_epoch)
+            val_loss, val_mae = validate_epoch(validation, validation_steps)
+
+            checkpoint.on_epoch_end(
+                epoch,
+                {"loss": loss, "mae": mae, "val_loss": val_loss, "val_mae": val_mae},
+            )
+
+            if not self.chief:
+                continue
+
+            print(
+                f"Epoch: {epoch}, Time: {time.time()-start:.2f}s, Workers: {tasks}, Error: {mae:.4f}, Val Error: {val_mae:.4f}, Learning Rate: {current_lr}"
+            )
+
+            if self.args.save:
+                with writer.as_default():
+                    tf.summary.scalar("epoch_loss", loss, step=epoch)
+                    tf.summary.scalar("epoch_val_loss", val_loss, step=epoch)
+                    tf.summary.scalar("learning_rate", current_lr, step=epoch)
+
+        self._finish_checkpoints(checkpoint)
+
+        if self.args.save:
+            with open(os.path.join(self.path, "history.json"), "w") as f:
+                json.dump(self.history, f, indent=2)
+
+            self.model.save(self.path + "/keras.keras")
+
+        self.fit = True
+
+    def _fit_model(self):
+
+        checkpoint = self._training_checkpoint()
+
+        callbacks = self.callbacks + [checkpoint]
+
+        # Whole passes, the same steps the learning rate schedule counts
+        steps_per_epoch = self._steps_per_epoch()
+
+        if self.streamed:
+
+            def train(seed):
+                return self._dataset(self.files, "train", seed=seed)
+
+            validation_data = self._dataset(self.files, "validate", shuffle=False)
+
+        else:
+
+            def train(seed):
+                return make_array_dataset(
+                    self.X_train_DC,
+                    self.X_train_IC,
+                    self.Y_train,
+                    batch_size=self.args.batch_size,
+                    seed=seed,
+                )
+
+            validation_data = (
+                [self.X_validate_DC, self.X_validate_IC],
+                self.Y_validate,
+            )
+
+        def fit(initial_epoch, epochs, skip):
+            return self.model.fit(
+                self._epoch_stream(train, initial_epoch, epochs, skip, steps_per_epoch),
+                validation_data=validation_data,
+                validation_batch_size=None if self.streamed else self.args.batch_size,
+                steps_per_epoch=steps_per_epoch - skip,
+                initial_epoch=initial_epoch,
+                epochs=epochs,
+                callbacks=callbacks,
+                verbose=self.args.verbose,
+            )
+
+        self._fit_epochs(checkpoint, fit)
+        self._finish_checkpoints(checkpoint)
+
+        self.history = checkpoint.history
+
         model_path = self.path + "/keras.keras"
 
         self.model.save(model_path)
 
         self.fit = True
 
+    def _training_checkpoint(self, extra=None):
+        """
+        Protected method building the `TrainingCheckpoint` callback, saving the
+        weights, optimizer moments and step, learning rate, epoch, batch and
+        history to `checkpoints` in the output directory every TrainingArgs
+        data class argument `checkpoint_steps` steps and every epoch. Files are
+        written on a background thread, the `checkpoints_kept` newest and the
+        one of the lowest validation loss are kept. With
+        `continue_train` the latest checkpoint in `output_dir` is restored into
+        the compiled model, without one only the weights at `load_model_path`
+        are loaded. The seed of the training data order, TrainingArgs data
+        class argument `seed` or drawn for the run, is saved with the progress
+        and restored in the self.seed instance variable.
+
+        :returns: TrainingCheckpoint
+        """
+
+        directory = None
+        if self.args.save:
+            directory = os.path.join(self.path, "checkpoints")
+
+        seed = self.args.seed
+        if seed is None:
+            seed = int(np.random.default_rng().integers(2**31))
+
+        state = {"epoch": self.args.start_epoch, "seed": seed}
+
+        if self.args.continue_train:
+            latest = latest_checkpoint(
+                os.path.join(self.args.output_dir, "checkpoints")
+            )
+
+            if latest is not None:
+                state = load_checkpoint(latest, self.model)
+
+                print(
+                    f"Resuming {latest}, epoch {state['epoch']}, batch {state['batch']}"
+                )
+            else:
+                self.model.load_weights(self.args.load_model_path)
+
+        # Checkpoints of older runs have none
+        self.seed = state.setdefault("seed", seed)
+
+        return TrainingCheckpoint(
+            directory,
+            self.args.checkpoint_steps,
+            state,
+            extra,
+            self.args.checkpoints_kept,
+        )
+
+    def _finish_checkpoints(self, checkpoint):
+        """
+        Protected method waiting for the last checkpoint to be written. The
+        seconds training waited for every checkpoint are kept in the
+        `checkpoint_wait` instance variable.
+
+        :returns: None
+        """
+
+        if checkpoint.writer is None:
+            self.checkpoint_wait = []
+            return
+
+        checkpoint.writer.wait()
+
+        self.checkpoint_wait = list(checkpoint.blocked)
+
+        print(
+            f"Checkpoints: {len(self.checkpoint_wait)}, Training Blocked: {sum(self.checkpoint_wait):.2f}s, Best: {checkpoint.writer.best_path}"
+        )
+
+    def _data_seed(self, *keys):
+        """
+        Protected method deriving the seed of one part of the training data,
+        e.g. an epoch, from the run seed self.seed and `keys`.
+
+        :returns: int
+        """
+
+        return int(np.random.SeedSequence([self.seed, *keys]).generate_state(1)[0])
+
+    def _epoch_stream(self, make, initial_epoch, epochs, skip, steps_per_epoch):
+        """
+        Protected method chaining the `steps_per_epoch` batches of every epoch
+        from `initial_epoch` up to `epochs`, each epoch taken from
+        `make(seed)` with its own `_data_seed`. An epoch holds the same
+        batches whether or not training restarted in it, the `skip` batches
+        of the first epoch already trained on are left out.
+
+        :returns: tf.data.Dataset
+        """
+
+        stream = None
+
+        for epoch in range(initial_epoch, epochs):
+            batches = make(self._data_seed(epoch)).repeat().take(steps_per_epoch)
+
+            if epoch == initial_epoch:
+                batches = batches.skip(skip)
+
+            stream = batches if stream is None else stream.concatenate(batches)
+
+        return stream
+
+    def _fit_epochs(self, checkpoint, fit):
+        """
+        Protected method training up to epoch `start_epoch + epochs` from the
+        progress of `checkpoint`. An epoch a restored checkpoint stopped in is
+        finished first by `fit(initial_epoch, epochs, skip)`, skipping the
+        `skip` batches already trained on, whole epochs follow in one call.
+
+        :returns: None
+        """
+
+        epoch, skip = checkpoint.state["epoch"], checkpoint.state["batch"]
+        end = self.args.start_epoch + self.args.epochs
+
+        if skip > 0 and epoch < end:
+            fit(epoch, epoch + 1, skip)
+            epoch += 1
+
+        if epoch < end:
+            fit(epoch, end, 0)
+
     def predict_model(self):
 
-        if self.args.multi_file:
+        if (
+            self.args.multi_file
+            and self.args.memmap_dir is None
+            and not self.args.sparse
+        ):
             self._predict_large_model()
+        elif self.streamed:
+
+            reconstruction = []
+            truth = []
+
+            for X, Y in self._dataset(self.files, "test", shuffle=False):
+                reconstruction.append(self.model.predict_on_batch(X)[:, 0])
+                truth.append(Y.numpy())
+
+            self.reconstruction = np.concatenate(reconstruction)
+            self.truth = np.concatenate(truth)
         else:
 
             reconstruction = self.model.predict([self.X_test_DC, self.X_test_IC])
@@ -413,59 +1197,70 @@ Learning rate function `TrainingArgs.lr_func` should take 4 parameters:
 
             self.truth = self.Y_test
 
-            return self.reconstruction
-
         self.reconstructed = True
 
-        return
+        return self.reconstruction
 
     def _predict_large_model(self):
+        """
+        Protected method predicting the valid test events of every file. Files
+        are read and filtered by TrainingArgs data class argument
+        `predict_workers` worker processes and feed a single predict loop. Outputs are
+        preallocated from the valid event counts of the files' `valid_index`
+        and `self.provenance` holds the file and row of every prediction.
+        Saved to `predictions.npz` with TrainingArgs data class argument `save`.
 
-        self.reconstruction = []
-        self.truth = []
-
-        count = 0
-
-        for file in self.files:
+        :returns: None
+        """
 
-            count += 1
+        label = self.args.train_variable
 
-            hdf = h5py.File(file, "r")
+        rows = [valid_index(file, label).rows["test"] for file in self.files]
+        offsets = np.concatenate(([0], np.cumsum([len(row) for row in rows])))
 
-            X_test_DC = hdf["X_test_DC"][:]
-            X_test_IC = hdf["X_test_IC"][:]
-            Y_test = hdf["Y_test"][:, 14]
+        self.reconstruction = np.empty(offsets[-1], dtype=np.float32)
+        self.truth = np.empty(offsets[-1], dtype=np.float32)
+        self.provenance = np.empty(offsets[-1], dtype=PROVENANCE_DTYPE)
 
-            valid_test = np.where(Y_test > 0)
-            X_test_DC = X_test_DC[valid_test]
-            X_test_IC = X_test_IC[valid_test]
-            Y_test = Y_test[valid_test]
+        loader = FilePrefetcher(
+            self.files,
+            partial(load_file, splits=["test"], label=label),
+            buffers=self.args.predict_workers + 1,
+            workers=self.args.predict_workers,
+            processes=True,
+        )
 
-            pred = self.model.predict([X_test_DC, X_test_IC])
+        for file, data in enumerate(loader):
+            X_test, Y_test = data["test"]
+            events = slice(offsets[file], offsets[file + 1])
 
-            pred = [i[0] for i in pred]
+            if len(Y_test) > 0:
+                pred = self.model.predict(
+                    X_test, batch_size=self.args.batch_size, verbose=0
+                )
+                self.reconstruction[events] = pred[:, 0]
 
-            self.reconstruction = np.concatenate((self.reconstruction, pred))
-            self.truth = np.concatenate((self.truth, Y_test))
+            self.truth[events] = Y_test
+            self.provenance["file"][events] = file
+            self.provenance["row"][events] = rows[file]
 
-            hdf.close()
+            del X_test, Y_test, data
 
-            del (
-                X_test_DC,
-                X_test_IC,
-                Y_test,
-                hdf,
+        if self.args.save:
+            np.savez(
+                os.path.join(self.path, "predictions.npz"),
+                reconstruction=self.reconstruction,
+                truth=self.truth,
+                provenance=self.provenance,
+                files=np.array(self.files),
             )
 
-            if count > 5:
-                break
-
     def plot_model(self):
 
         assert self.fit, "must call `fit_model` before plotting"
         assert self.reconstructed, "must call `predicted_model` before plotting"
 
-        if self.args.multi_file:
+        if isinstance(self.history, dict):
             history = self.history
         else:
             history = self.history.history
@@ -515,29 +1310,6 @@ Learning rate function `TrainingArgs.lr_func` should take 4 parameters:
             self._notify_user()
 
 
-args = TrainingArgs(
-    data_dir="/home/bread/Documents/MuonNeutrinoReconstruction/src/data/archive/flercnn_IC19cut",
-    output_dir="/home/bread/Documents/MuonNeutrinoReconstruction/src/data/review",
-    title="Inelasticity Testing",
-    epochs=2,
-    save=True,
-    train_variable="inelasticity",
-    batch_size=128,
-    activation="linear",
-    verbose=1,
-    multi_file=True,
-    notify=True,
-)
-
-model = Convolution(args=args)
-
-model.fit_model()
-
-model.predict_model()
-
-# model.plot_model()
-
-
 def ZenithLoss(y_truth, y_predicted):
     return losses.mean_absolute_error(y_truth, y_predicted[:, 0])
 
@@ -548,3 +1320,27 @@ def EnergyLoss(y_truth, y_predicted):
 
 def InelasticityLoss(y_truth, y_predicted):
     return losses.mean_absolute_error(y_truth, y_predicted)
+
+
+if __name__ == "__main__":
+    args = TrainingArgs(
+        data_dir="/home/bread/Documents/MuonNeutrinoReconstruction/src/data/archive/flercnn_IC19cut",
+        output_dir="/home/bread/Documents/MuonNeutrinoReconstruction/src/data/review",
+        title="Inelasticity Testing",
+        epochs=2,
+        save=True,
+        train_variable="inelasticity",
+        batch_size=128,
+        activation="linear",
+        verbose=1,
+        multi_file=True,
+        notify=True,
+    )
+
+    model = Convolution(args=args)
+
+    model.fit_model()
+
+    model.predict_model()
+
+    # model.plot_model()
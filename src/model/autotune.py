@@ -0,0 +1,392 @@
+import os
+import sys
+import json
+import math
+import time
+import socket
+import argparse
+import resource
+import subprocess
+import numpy as np
+
+from datetime import datetime
+from dataclasses import replace
+from typing import Optional, Sequence
+
+# Best configuration of every host, written by `sweep`
+AUTOTUNE_PATH = "./cache/autotune.json"
+
+# Used when neither `TrainingArgs` nor the host configuration sets a batch size
+DEFAULT_BATCH_SIZE = 128
+
+BATCH_SIZES = [64, 128, 256, 512]
+
+# Per event grid shapes written by `utils.grid`, for synthetic batches
+SYNTHETIC_SHAPES = {"DC": (8, 60, 5), "IC": (19, 60, 5)}
+
+# Directory `python -m model.autotune` runs from
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _read_numbers(path: str) -> Optional[list]:
+
+    try:
+        with open(path) as f:
+            return f.read().split()
+    except OSError:
+        return None
+
+
+def cgroup_cpus(root: str = "/sys/fs/cgroup") -> Optional[float]:
+    """
+    CPUs allowed by the cgroup CPU quota of this process, from `cpu.max` of
+    cgroup v2 or the CFS quota of cgroup v1. `None` without a quota.
+    """
+
+    limit = _read_numbers(os.path.join(root, "cpu.max"))
+
+    if limit is not None and len(limit) == 2:
+        quota, period = limit
+        return None if quota == "max" else int(quota) / int(period)
+
+    quota = _read_numbers(os.path.join(root, "cpu", "cpu.cfs_quota_us"))
+    period = _read_numbers(os.path.join(root, "cpu", "cpu.cfs_period_us"))
+
+    if quota is None or period is None or int(quota[0]) <= 0:
+        return None
+
+    return int(quota[0]) / int(period[0])
+
+
+def available_cores() -> int:
+    """
+    Cores this process may use, its CPU affinity bounded by the cgroup quota.
+    """
+
+    cores = len(os.sched_getaffinity(0))
+    quota = cgroup_cpus()
+
+    if quota is not None:
+        cores = min(cores, max(math.floor(quota), 1))
+
+    return cores
+
+
+def thread_configs(cores: int) -> list:
+    """
+    `(inter_op_threads, intra_op_threads)` candidates, intra op pools of all,
+    half and a quarter of the cores with one or two inter op pools.
+    """
+
+    intra = sorted({max(cores >> shift, 1) for shift in range(3)}, reverse=True)
+
+    return [(inter, threads) for threads in intra for inter in (1, 2)]
+
+
+def training_batch(batch_size: int, data: Optional[str] = None, seed: int = 0):
+    """
+    One `(X_DC, X_IC, Y)` batch, the first valid training events of the file
+    at `data` or uniform random grids. Short files are repeated.
+    """
+
+    if data is None:
+        rng = np.random.default_rng(seed)
+
+        X_DC = rng.random((batch_size, *SYNTHETIC_SHAPES["DC"]), dtype=np.float32)
+        X_IC = rng.random((batch_size, *SYNTHETIC_SHAPES["IC"]), dtype=np.float32)
+        Y = rng.random(batch_size, dtype=np.float32)
+
+        return X_DC, X_IC, Y
+
+    from model.pipeline import make_dataset
+
+    (X_DC, X_IC), Y = next(
+        iter(make_dataset(data, "train", batch_size=batch_size, shuffle_buffer=None))
+    )
+
+    rows = np.resize(np.arange(len(Y)), batch_size)
+
+    return X_DC.numpy()[rows], X_IC.numpy()[rows], Y.numpy()[rows]
+
+
+def trial(
+    inter_op_threads: int,
+    intra_op_threads: int,
+    batch_size: int,
+    steps: int = 20,
+    warmup: int = 3,
+    data: Optional[str] = None,
+) -> dict:
+    """
+    Times `steps` training steps of `make_network` after `warmup` steps. The
+    thread pools are fixed once TensorFlow runs, so every configuration is
+    measured in a fresh process by `sweep`.
+
+    Args:
+        inter_op_threads: Threads running independent ops.
+        intra_op_threads: Threads within one op.
+        batch_size: Events per step.
+        steps: Timed steps.
+        warmup: Untimed steps, including tracing.
+        data: HDF5 training file, synthetic batches when `None`.
+
+    Returns:
+        Dictionary of the configuration, samples per second and peak RSS.
+    """
+
+    import tensorflow as tf
+
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+
+    import keras
+
+    from model.cnn_model import make_network
+
+    X_DC, X_IC, Y = training_batch(batch_size, data)
+
+    model = make_network(X_DC, X_IC, 1, 0.2, 0.2, 0.2)
+    model.compile(loss="mae", optimizer=keras.optimizers.Adam(), metrics=["mae"])
+
+    for _ in range(warmup):
+        model.train_on_batch([X_DC, X_IC], Y)
+
+    start = time.perf_counter()
+
+    for _ in range(steps):
+        model.train_on_batch([X_DC, X_IC], Y)
+
+    elapsed = time.perf_counter() - start
+
+    return {
+        "inter_op_threads": inter_op_threads,
+        "intra_op_threads": intra_op_threads,
+        "batch_size": batch_size,
+        "samples_per_second": steps * batch_size / elapsed,
+        "step_seconds": elapsed / steps,
+        # Kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def sweep(
+    threads: Optional[Sequence[tuple]] = None,
+    batch_sizes: Sequence[int] = BATCH_SIZES,
+    steps: int = 20,
+    data: Optional[str] = None,
+    max_rss_mb: Optional[float] = None,
+    path: Optional[str] = AUTOTUNE_PATH,
+    timeout: float = 1800,
+) -> Optional[dict]:
+    """
+    Runs a `trial` in a subprocess for every thread configuration and batch
+    size and keeps the highest throughput within `max_rss_mb` as the
+    configuration of this host.
+
+    Args:
+        threads: `(inter, intra)` pairs, by default `thread_configs` of
+            `available_cores`.
+        batch_sizes: Batch sizes tried with every thread configuration.
+        steps: Timed steps per trial.
+        data: HDF5 training file, synthetic batches when `None`.
+        max_rss_mb: Peak resident memory allowed, unbounded when `None`.
+        path: `.json` file of host configurations, not written when `None`.
+        timeout: Seconds before a trial is abandoned.
+
+    Returns:
+        Best configuration, `None` when no trial succeeded.
+    """
+
+    if threads is None:
+        threads = thread_configs(available_cores())
+
+    results = []
+
+    for inter, intra in threads:
+        for batch_size in batch_sizes:
+            command = [sys.executable, "-m", "model.autotune", "trial"]
+            command += ["--inter", str(inter), "--intra", str(intra)]
+            command += ["--batch-size", str(batch_size), "--steps", str(steps)]
+
+            if data is not None:
+                command += ["--data", os.path.abspath(data)]
+
+            try:
+                run = subprocess.run(
+                    command,
+                    cwd=SOURCE_DIR,
+                    capture_output=True,
+                    text=True,
+                    timeout=timeout,
+                )
+            except subprocess.TimeoutExpired:
+                print(f"inter {inter} intra {intra} batch {batch_size}: timed out")
+                continue
+
+            if run.returncode != 0:
+                error = (run.stderr.strip().splitlines() or ["no output"])[-1]
+                print(f"inter {inter} intra {intra} batch {batch_size}: {error}")
+                continue
+
+            result = json.loads(run.stdout.strip().splitlines()[-1])
+            results.append(result)
+
+            print(
+                f"inter {inter} intra {intra} batch {batch_size}: "
+                f"{result['samples_per_second']:.1f} samples/s, "
+                f"{result['step_seconds'] * 1000:.1f} ms/step, "
+                f"peak RSS {result['peak_rss_mb']:.0f} MB"
+            )
+
+    allowed = [
+        result
+        for result in results
+        if max_rss_mb is None or result["peak_rss_mb"] <= max_rss_mb
+    ]
+
+    if not allowed:
+        return None
+
+    best = max(allowed, key=lambda result: result["samples_per_second"])
+
+    if path is not None:
+        save_config(best, path)
+
+    return best
+
+
+def host() -> str:
+    return socket.gethostname()
+
+
+def load_configs(path: str = AUTOTUNE_PATH) -> dict:
+    """
+    Dictionary from host name to its configuration, empty when `path` is
+    missing.
+    """
+
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_config(config: dict, path: str = AUTOTUNE_PATH) -> str:
+    """
+    Stores `config` as the configuration of this host, with the cores it was
+    measured on.
+    """
+
+    configs = load_configs(path)
+    configs[host()] = dict(
+        config, cores=available_cores(), date=datetime.now().isoformat()
+    )
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+
+    with open(temporary, "w") as f:
+        json.dump(configs, f, indent=2)
+
+    os.replace(temporary, path)
+
+    return path
+
+
+def host_config(path: str = AUTOTUNE_PATH) -> Optional[dict]:
+    """
+    Configuration of this host, `None` when it was never tuned or was tuned
+    with a different number of cores, e.g. under another cgroup quota.
+    """
+
+    config = load_configs(path).get(host())
+
+    if config is None or config.get("cores") != available_cores():
+        return None
+
+    return config
+
+
+def autotuned_args(args):
+    """
+    `TrainingArgs` with the thread counts and batch size left `None` taken
+    from the configuration of this host at `args.autotune_path`. Threads stay
+    the TensorFlow default and the batch size `DEFAULT_BATCH_SIZE` without one.
+    """
+
+    config = {}
+
+    if args.autotune_path is not None:
+        config = host_config(args.autotune_path) or {}
+
+    def pick(name, default=None):
+        value = getattr(args, name)
+        return value if value is not None else config.get(name, default)
+
+    return replace(
+        args,
+        inter_op_threads=pick("inter_op_threads"),
+        intra_op_threads=pick("intra_op_threads"),
+        batch_size=pick("batch_size", DEFAULT_BATCH_SIZE),
+    )
+
+
+def main(argv=None) -> None:
+    """
+    Command line interface, run from `src` with `python -m model.autotune`.
+    """
+
+    parser = argparse.ArgumentParser(description="Thread and batch size tuning")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    tune = commands.add_parser("sweep", help="time every configuration, keep the best")
+    tune.add_argument("--data", default=None, help="training file, else synthetic")
+    tune.add_argument("--batch-sizes", type=int, nargs="+", default=BATCH_SIZES)
+    tune.add_argument("--intra", type=int, nargs="+", default=None)
+    tune.add_argument("--inter", type=int, nargs="+", default=[1, 2])
+    tune.add_argument("--steps", type=int, default=20)
+    tune.add_argument("--max-rss-mb", type=float, default=None)
+    tune.add_argument("--output", default=AUTOTUNE_PATH)
+
+    one = commands.add_parser("trial", help="time one configuration")
+    one.add_argument("--inter", type=int, required=True)
+    one.add_argument("--intra", type=int, required=True)
+    one.add_argument("--batch-size", type=int, required=True)
+    one.add_argument("--steps", type=int, default=20)
+    one.add_argument("--data", default=None)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "sweep":
+        threads = None
+        if args.intra is not None:
+            threads = [(inter, intra) for intra in args.intra for inter in args.inter]
+
+        print(f"{host()}: {available_cores()} cores")
+
+        best = sweep(
+            threads,
+            args.batch_sizes,
+            args.steps,
+            args.data,
+            args.max_rss_mb,
+            args.output,
+        )
+
+        assert best is not None, "no configuration completed"
+
+        print(f"best: {json.dumps(best)}")
+
+    elif args.command == "trial":
+        result = trial(
+            args.inter, args.intra, args.batch_size, args.steps, data=args.data
+        )
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
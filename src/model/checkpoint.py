@@ -0,0 +1,317 @@
+import os
+import copy
+import glob
+import json
+import time
+import keras
+import numpy as np
+
+from typing import Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+# File name of the training state after `step` optimizer steps
+CHECKPOINT_NAME = "checkpoint-{step:09d}.npz"
+
+
+def training_state(model: keras.Model) -> dict:
+    """
+    Arrays of the weights of `model` and the variables of its optimizer, the
+    moments, step count and learning rate.
+    """
+
+    arrays = {f"weight_{i}": weight for i, weight in enumerate(model.get_weights())}
+
+    for i, variable in enumerate(model.optimizer.variables):
+        arrays[f"optimizer_{i}"] = keras.ops.convert_to_numpy(variable)
+
+    return arrays
+
+
+def save_checkpoint(directory: str, model: keras.Model, state: dict) -> str:
+    """
+    Writes the complete training state to one `.npz` file in `directory`,
+    under a temporary name first so a crash never leaves a partial file.
+
+    Args:
+        directory: Checkpoint directory.
+        model: Compiled model.
+        state: Progress, `epoch`, `batch`, `step` and `history`, saved as json.
+
+    Returns:
+        Path of the checkpoint.
+    """
+
+    return write_checkpoint(directory, training_state(model), state)
+
+
+def write_checkpoint(directory: str, arrays: dict, state: dict) -> str:
+    """
+    Writes arrays of `training_state` and `state` as a checkpoint.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+
+    arrays = dict(arrays, state=np.array(json.dumps(state)))
+
+    name = CHECKPOINT_NAME.format(step=state["step"])
+    path = os.path.join(directory, name)
+
+    # Hidden, so `latest_checkpoint` never picks it up
+    temporary = os.path.join(directory, f".{name}.{os.getpid()}.tmp.npz")
+    np.savez(temporary, **arrays)
+    os.replace(temporary, path)
+
+    return path
+
+
+def latest_checkpoint(directory: str) -> Optional[str]:
+    """
+    Checkpoint with the most optimizer steps in `directory`, `None` if empty.
+    """
+
+    paths = checkpoints(directory)
+
+    return paths[-1] if paths else None
+
+
+def checkpoints(directory: str) -> list:
+    """
+    Checkpoints in `directory`, oldest first.
+    """
+
+    return sorted(glob.glob(os.path.join(directory, "checkpoint-*.npz")))
+
+
+def read_state(path: str) -> dict:
+    """
+    Progress state of a checkpoint, without loading its arrays.
+    """
+
+    with np.load(path) as arrays:
+        return json.loads(str(arrays["state"]))
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints on a background thread. The training loop only waits
+    for the in memory snapshot of the weights and optimizer variables, and
+    for the previous write when it has not finished yet, so at most one
+    snapshot is held besides the model. The time it waited each save is kept
+    in `blocked`.
+
+    Only the `keep` newest checkpoints are kept, and the one with the lowest
+    `val_loss` among those saved at the end of an epoch.
+    """
+
+    def __init__(self, directory: str, keep: int = 3) -> None:
+        """Construct `CheckpointWriter`
+
+        Args:
+            directory: Checkpoint directory.
+            keep: Newest checkpoints kept.
+
+        """
+
+        assert keep >= 1, "must keep at least one checkpoint"
+
+        self.directory = directory
+        self.keep = keep
+        self.blocked = []
+
+        # Best of an earlier run in the same directory
+        self.best = None
+        for path in checkpoints(directory):
+            self._rank(path, read_state(path).get("val_loss"))
+
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def _rank(self, path: str, val_loss: Optional[float]) -> None:
+
+        if val_loss is not None and (self.best is None or val_loss < self.best[0]):
+            self.best = (val_loss, path)
+
+    def submit(self, model: keras.Model, state: dict) -> None:
+        """
+        Snapshots `model` and a copy of `state` and queues their checkpoint, a
+        `val_loss` entry ranks it for the best checkpoint.
+        """
+
+        start = time.time()
+
+        self.wait()
+
+        # Training goes on changing the history while the write runs
+        arrays = training_state(model)
+        self.pending = self.pool.submit(self._write, arrays, copy.deepcopy(state))
+
+        self.blocked.append(time.time() - start)
+
+    def _write(self, arrays: dict, state: dict) -> str:
+
+        path = write_checkpoint(self.directory, arrays, state)
+
+        self._rank(path, state.get("val_loss"))
+        self._prune()
+
+        return path
+
+    def _prune(self) -> None:
+
+        best = None if self.best is None else self.best[1]
+
+        for path in checkpoints(self.directory)[: -self.keep]:
+            if path != best:
+                os.remove(path)
+
+    def wait(self) -> Optional[str]:
+        """
+        Waits for the queued checkpoint, its path or `None` if none is queued.
+        """
+
+        if self.pending is None:
+            return None
+
+        pending, self.pending = self.pending, None
+
+        return pending.result()
+
+    @property
+    def best_path(self) -> Optional[str]:
+        return None if self.best is None else self.best[1]
+
+
+def load_checkpoint(path: str, model: keras.Model) -> dict:
+    """
+    Restores the weights and optimizer variables of a compiled `model` from
+    a checkpoint written by `save_checkpoint`.
+
+    Returns:
+        The saved progress state.
+    """
+
+    optimizer = model.optimizer
+
+    if not optimizer.built:
+        optimizer.build(model.trainable_variables)
+
+    with np.load(path) as arrays:
+        weights = sorted(name for name in arrays.files if name.startswith("weight_"))
+        variables = [name for name in arrays.files if name.startswith("optimizer_")]
+
+        assert len(weights) == len(
+            model.get_weights()
+        ), f"{path} holds {len(weights)} weights, the model has {len(model.get_weights())}"
+        assert len(variables) == len(
+            optimizer.variables
+        ), f"{path} holds {len(variables)} optimizer variables, the optimizer has {len(optimizer.variables)}"
+
+        model.set_weights([arrays[f"weight_{i}"] for i in range(len(weights))])
+
+        for i, variable in enumerate(optimizer.variables):
+            variable.assign(arrays[f"optimizer_{i}"])
+
+        return json.loads(str(arrays["state"]))
+
+
+class TrainingCheckpoint(keras.callbacks.Callback):
+    """
+    Saves the complete training state through a `CheckpointWriter` every
+    `every_steps` optimizer steps and at the end of every epoch. The progress
+    is the epoch, the batches of it already trained on, the optimizer step and
+    the history of every finished epoch, along with the result of `extra`,
+    such as a sampler cursor. Epoch end checkpoints also hold the `val_loss`.
+
+    A `fit` resumed from a checkpoint starts at its `epoch`, skipping `batch`
+    batches, the callback numbers those batches on from where it stopped.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str],
+        every_steps: Optional[int] = None,
+        state: Optional[dict] = None,
+        extra: Optional[Callable[[], dict]] = None,
+        keep: int = 3,
+    ) -> None:
+        """Construct `TrainingCheckpoint`
+
+        Args:
+            directory: Checkpoint directory, nothing is written when `None`.
+            every_steps: Optimizer steps between checkpoints within an epoch.
+            state: Progress restored by `load_checkpoint`, a new run if `None`.
+            extra: Function returning more state to save.
+            keep: Newest checkpoints kept besides the best.
+
+        """
+
+        super().__init__()
+
+        self.every_steps = every_steps
+        self.extra = extra
+
+        self.writer = None
+        if directory is not None:
+            self.writer = CheckpointWriter(directory, keep)
+
+        self.state = {"epoch": 0, "batch": 0, "step": 0, "history": {}}
+        self.state.update(state or {})
+
+        self.history = self.state["history"]
+
+    def on_epoch_begin(self, epoch, logs=None):
+
+        # Batches of this epoch trained before a restart
+        self.offset = self.state["batch"] if epoch == self.state["epoch"] else 0
+        self.state.update(epoch=epoch, batch=self.offset)
+
+    def _step(self) -> int:
+        return int(keras.ops.convert_to_numpy(self.model.optimizer.iterations))
+
+    def on_train_batch_end(self, batch, logs=None):
+
+        step = self._step()
+        interval = self.every_steps
+
+        # Steps advance by `steps_per_execution` between calls
+        due = interval is not None and step // interval > self.state["step"] // interval
+
+        self.state.update(batch=self.offset + batch + 1, step=step)
+
+        if due:
+            self.save()
+
+    def on_epoch_end(self, epoch, logs=None):
+
+        for key, value in (logs or {}).items():
+            self.history.setdefault(key, []).append(float(value))
+
+        self.state.update(epoch=epoch + 1, batch=0, step=self._step())
+        self.save(val_loss=(logs or {}).get("val_loss"))
+
+    def on_train_end(self, logs=None):
+        if self.writer is not None:
+            self.writer.wait()
+
+    def save(self, val_loss: Optional[float] = None) -> None:
+
+        if self.writer is None:
+            return
+
+        state = dict(self.state)
+
+        if val_loss is not None:
+            state["val_loss"] = float(val_loss)
+
+        if self.extra is not None:
+            state.update(self.extra())
+
+        self.writer.submit(self.model, state)
+
+    @property
+    def blocked(self) -> list:
+        """
+        Seconds the training loop waited for every checkpoint.
+        """
+
+        return [] if self.writer is None else self.writer.blocked
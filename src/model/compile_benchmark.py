@@ -0,0 +1,223 @@
+import sys
+import time
+import keras
+import argparse
+import numpy as np
+import tensorflow as tf
+
+from typing import Optional, Sequence, Union
+
+from model.autotune import training_batch
+from model.cnn_model import make_network, make_network_3D
+
+# Inputs of `make_network_3D`, the IceCube strings around DeepCore on x/y
+# grids, for synthetic batches
+SYNTHETIC_SHAPES_3D = {
+    "DC": (8, 60, 5),
+    "IC1": (4, 4, 60, 5),
+    "IC2": (4, 4, 60, 5),
+    "IC3": (3, 3, 60, 5),
+}
+
+NETWORKS = ["make_network", "make_network_3D"]
+
+
+def parse_jit(value: str) -> Union[bool, str]:
+    """
+    `jit_compile` option from the command line, `auto`, `true` or `false`.
+    """
+
+    value = value.lower()
+
+    assert value in ["auto", "true", "false"], "jit must be `auto`, `true` or `false`"
+
+    return value if value == "auto" else value == "true"
+
+
+def network_batch(
+    network: str, batch_size: int, data: Optional[str] = None, seed: int = 0
+) -> tuple:
+    """
+    Inputs and labels of one batch for `network`, real events from the file
+    at `data` are only available for `make_network`.
+    """
+
+    assert network in NETWORKS, f"network must be one of {NETWORKS}"
+
+    if network == "make_network":
+        X_DC, X_IC, Y = training_batch(batch_size, data, seed)
+        return [X_DC, X_IC], Y
+
+    assert data is None, "`make_network_3D` is benchmarked on synthetic batches"
+
+    rng = np.random.default_rng(seed)
+
+    inputs = [
+        rng.random((batch_size, *shape), dtype=np.float32)
+        for shape in SYNTHETIC_SHAPES_3D.values()
+    ]
+
+    return inputs, rng.random(batch_size, dtype=np.float32)
+
+
+def build_network(network: str, inputs: Sequence[np.ndarray]) -> keras.Model:
+
+    if network == "make_network":
+        return make_network(*inputs, 1, 0.2, 0.2, 0.2)
+
+    return make_network_3D(*inputs, 1, 0.2, 0.2, 0.2)
+
+
+class ExecutionTimer(keras.callbacks.Callback):
+    """
+    Wall time of every call of the train function.
+    """
+
+    def __init__(self) -> None:
+
+        super().__init__()
+
+        self.durations = []
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.durations.append(time.perf_counter() - self.start)
+
+
+def time_steps(
+    network: str = "make_network",
+    jit_compile: Union[bool, str] = "auto",
+    steps_per_execution: int = 1,
+    batch_size: int = 128,
+    steps: int = 64,
+    data: Optional[str] = None,
+) -> dict:
+    """
+    Trains `network` compiled with `jit_compile` and `steps_per_execution` on
+    one repeated batch. The first execution, which traces and compiles the
+    train function, is timed apart from the `steps` that follow.
+
+    Args:
+        network: `make_network` or `make_network_3D`.
+        jit_compile: XLA compilation, `auto` is what `model.compile` defaults to.
+        steps_per_execution: Training steps per call of the train function.
+        batch_size: Events per step.
+        steps: Timed steps, rounded up to whole executions.
+        data: HDF5 training file, synthetic batches when `None`.
+
+    Returns:
+        Dictionary of compile seconds, step latencies and samples per second.
+    """
+
+    inputs, Y = network_batch(network, batch_size, data)
+
+    model = build_network(network, inputs)
+    model.compile(
+        loss="mae",
+        optimizer=keras.optimizers.Adam(),
+        metrics=["mae"],
+        jit_compile=jit_compile,
+        steps_per_execution=steps_per_execution,
+    )
+
+    dataset = tf.data.Dataset.from_tensors((tuple(inputs), Y)).repeat()
+
+    start = time.perf_counter()
+    model.fit(dataset, steps_per_epoch=steps_per_execution, epochs=1, verbose=0)
+    compile_seconds = time.perf_counter() - start
+
+    executions = -(-steps // steps_per_execution)
+    timer = ExecutionTimer()
+
+    model.fit(
+        dataset,
+        steps_per_epoch=executions * steps_per_execution,
+        epochs=1,
+        verbose=0,
+        callbacks=[timer],
+    )
+
+    # Steady state, without the set up of `fit` itself
+    elapsed = sum(timer.durations)
+
+    step_ms = np.array(timer.durations) / steps_per_execution * 1000
+
+    return {
+        "network": network,
+        "jit_compile": jit_compile,
+        "steps_per_execution": steps_per_execution,
+        "batch_size": batch_size,
+        "compile_seconds": compile_seconds,
+        "step_ms_median": float(np.median(step_ms)),
+        "step_ms_p90": float(np.percentile(step_ms, 90)),
+        "samples_per_second": executions * steps_per_execution * batch_size / elapsed,
+    }
+
+
+def benchmark(
+    network: str = "make_network",
+    jit: Sequence[Union[bool, str]] = ("auto", True),
+    steps_per_execution: Sequence[int] = (1, 8),
+    batch_size: int = 128,
+    steps: int = 64,
+    data: Optional[str] = None,
+) -> list:
+    """
+    Runs `time_steps` for every combination of `jit` and
+    `steps_per_execution` and prints them against the first, by default the
+    current `jit_compile="auto"`, one step per execution path.
+
+    Returns:
+        Results of every combination, in order.
+    """
+
+    results = [
+        time_steps(network, jit_compile, execution, batch_size, steps, data)
+        for jit_compile in jit
+        for execution in steps_per_execution
+    ]
+
+    baseline = results[0]
+
+    for result in results:
+        print(
+            f"jit_compile={str(result['jit_compile']):>5} "
+            f"steps_per_execution={result['steps_per_execution']:<3}: "
+            f"compile {result['compile_seconds']:.2f}s, "
+            f"step {result['step_ms_median']:.1f} ms (p90 {result['step_ms_p90']:.1f}), "
+            f"{result['samples_per_second']:.1f} samples/s "
+            f"({result['samples_per_second'] / baseline['samples_per_second']:.2f}x)"
+        )
+
+    return results
+
+
+def main(argv=None) -> None:
+    """
+    Command line interface, run from `src` with `python -m model.compile_benchmark`.
+    """
+
+    parser = argparse.ArgumentParser(description="XLA and multi step execution")
+    parser.add_argument("--network", choices=NETWORKS, default="make_network")
+    parser.add_argument("--jit", type=parse_jit, nargs="+", default=["auto", True])
+    parser.add_argument("--steps-per-execution", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--steps", type=int, default=64)
+    parser.add_argument("--data", default=None, help="training file, else synthetic")
+
+    args = parser.parse_args(argv)
+
+    benchmark(
+        args.network,
+        args.jit,
+        args.steps_per_execution,
+        args.batch_size,
+        args.steps,
+        args.data,
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
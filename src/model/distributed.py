@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import socket
+import argparse
+import subprocess
+
+from typing import Optional, Sequence
+
+from model.autotune import available_cores
+
+# Task types of a `TF_CONFIG` cluster, the chief is task 0 when present
+TASK_TYPES = ["chief", "worker"]
+
+
+def free_ports(count: int, host: str = "localhost") -> list:
+    """
+    Ports the operating system reports free on `host`, for a local cluster.
+    """
+
+    sockets = []
+
+    try:
+        for _ in range(count):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.bind((host, 0))
+            sockets.append(s)
+
+        return [s.getsockname()[1] for s in sockets]
+    finally:
+        for s in sockets:
+            s.close()
+
+
+def local_cluster(workers: int, host: str = "localhost") -> dict:
+    """
+    Cluster spec of `workers` worker processes on this machine.
+    """
+
+    return {"worker": [f"{host}:{port}" for port in free_ports(workers, host)]}
+
+
+def tf_config(cluster: dict, index: int, task_type: str = "worker") -> str:
+    """
+    `TF_CONFIG` of task `index` of `task_type` in `cluster`.
+    """
+
+    return json.dumps({"cluster": cluster, "task": {"type": task_type, "index": index}})
+
+
+def cluster_task(config: Optional[str] = None) -> tuple:
+    """
+    Position of this process among all training tasks and their number, read
+    from `TF_CONFIG`. A process without one is task 0 of 1.
+    """
+
+    config = json.loads(config or os.environ.get("TF_CONFIG", "{}"))
+
+    if not config.get("cluster"):
+        return 0, 1
+
+    tasks = [
+        (task_type, index)
+        for task_type in TASK_TYPES
+        for index in range(len(config["cluster"].get(task_type, [])))
+    ]
+
+    task = (config["task"]["type"], int(config["task"]["index"]))
+
+    assert task in tasks, f"task {task} not in cluster {config['cluster']}"
+
+    return tasks.index(task), len(tasks)
+
+
+def is_chief(config: Optional[str] = None) -> bool:
+    """
+    Whether this process writes checkpoints, history and the trained model.
+    """
+
+    return cluster_task(config)[0] == 0
+
+
+def shard_files(files: Sequence[str], task: int, tasks: int) -> list:
+    """
+    Files trained on by task `task` of `tasks`, every `tasks`-th file.
+    """
+
+    assert (
+        len(files) >= tasks
+    ), f"{len(files)} files cannot be sharded over {tasks} workers"
+
+    return list(files)[task::tasks]
+
+
+def launch(
+    config_path: str,
+    workers: int = 2,
+    threads: Optional[int] = None,
+    host: str = "localhost",
+) -> int:
+    """
+    Trains with `workers` local processes, each given its own `TF_CONFIG` of
+    one generated cluster. The cores of the machine are split between them.
+
+    Args:
+        config_path: `.json` file of `TrainingArgs` keyword arguments.
+        workers: Worker processes.
+        threads: Intra op threads per worker, defaults to cores / workers.
+        host: Address the workers listen on.
+
+    Returns:
+        Exit code, the first non zero one of the workers.
+    """
+
+    if threads is None:
+        threads = max(available_cores() // workers, 1)
+
+    cluster = local_cluster(workers, host)
+
+    processes = []
+
+    for index in range(workers):
+        env = dict(os.environ, TF_CONFIG=tf_config(cluster, index))
+
+        command = [sys.executable, "-m", "model.distributed", "worker", config_path]
+        command += ["--threads", str(threads)]
+
+        processes.append(subprocess.Popen(command, env=env))
+
+    codes = [process.wait() for process in processes]
+
+    return next((code for code in codes if code != 0), 0)
+
+
+def worker(config_path: str, threads: Optional[int] = None) -> None:
+    """
+    Training task started by `launch`, runs `Convolution` in distributed mode.
+    """
+
+    from cnn_reconstruction import Convolution
+    from model.model import TrainingArgs
+
+    with open(config_path) as f:
+        config = json.load(f)
+
+    if threads is not None:
+        config.update(inter_op_threads=threads, intra_op_threads=threads)
+
+    model = Convolution(TrainingArgs(**dict(config, distributed=True)))
+
+    model.fit_model()
+
+
+def main(argv=None) -> None:
+    """
+    Command line interface, run from `src` with `python -m model.distributed`.
+    """
+
+    parser = argparse.ArgumentParser(description="Multi worker training")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("launch", help="train with local worker processes")
+    run.add_argument("config", help="json file of TrainingArgs keyword arguments")
+    run.add_argument("--workers", type=int, default=2)
+    run.add_argument("--threads", type=int, default=None)
+    run.add_argument("--host", default="localhost")
+
+    task = commands.add_parser("worker", help="one task, reads TF_CONFIG")
+    task.add_argument("config")
+    task.add_argument("--threads", type=int, default=None)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "launch":
+        sys.exit(launch(args.config, args.workers, args.threads, args.host))
+
+    elif args.command == "worker":
+        worker(args.config, args.threads)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
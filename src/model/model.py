@@ -10,32 +10,51 @@ from typing import Union, Optional
 @dataclass
 class TrainingArgs:
     activation: str = "linear"
-    batch_size: int = 128
+    autotune_path: Optional[str] = "./cache/autotune.json"
+    batch_size: Optional[int] = None
+    checkpoint_steps: Optional[int] = 1000
+    checkpoints_kept: int = 3
     connected_drop_value: float = 0.2
     continue_train: bool = False
     data_dir: str = "src/data/archive/combined.hdf5"
     DC_drop_value: float = 0.2
+    distributed: bool = False
     epochs: int = 8
     epochs_step_drop: int = 10
     early: bool = False
+    global_sampler: bool = False
     IC_drop_value: float = 0.2
+    jit_compile: Union[bool, str] = "auto"
+    inter_op_threads: Optional[int] = None
+    intra_op_threads: Optional[int] = None
     learning_rate: float = 0.001
     load_model_path: str = None
     loss_func: Optional[Union[str, callable]] = None
     lr_drop: float = 0.58
     lr_epoch: int = 64
     lr_func: Optional[callable] = None
+    memmap_dir: Optional[str] = None
     multi_file: bool = False
     network: str = "make_network"
+    norm_method: Optional[str] = None
     notify: bool = False
     optimizer: Optional[callable] = None
     oscweight: bool = False
+    prefetch_buffers: int = 2
+    predict_workers: int = 4
     output_dir: str = "src/data/review"
     save: bool = True
+    seed: Optional[int] = None
     show: bool = True
+    shuffle_buffer: int = 10000
+    sparse: bool = False
     start_epoch: int = 0
+    steps_per_epoch: Optional[int] = None
+    steps_per_execution: int = 1
+    streaming: bool = False
     title: str = "Low Energy Muon Neutrino Inelasticity Reconstruction"
     train_variable: str = "inelasticity"
+    validation_steps: Optional[int] = None
     verbose: int = 2
     zmax: float = 3.14
     zmin: float = 0.0
@@ -0,0 +1,620 @@
+import time
+import h5py
+import keras
+import numpy as np
+import tensorflow as tf
+
+from collections import deque
+from itertools import islice
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Sequence
+
+from utils.labels import DEFAULT_LABEL, LabelSchema
+from utils.precision import decode, storage_of
+from utils.sparse_grid import read_sparse_batches, sparse_shapes
+from utils.valid_index import read_runs, valid_index
+
+
+# File index and row within the file of every event of a prediction
+PROVENANCE_DTYPE = np.dtype([("file", np.int32), ("row", np.int64)])
+
+# Files a stream reads at once by default, each holds one block in memory
+CYCLE_LENGTH = 4
+
+
+def aligned_rows(dataset: h5py.Dataset, block_rows: int) -> int:
+    """
+    Rounds `block_rows` to a whole number of HDF5 chunks of `dataset` so every
+    read decompresses each chunk once.
+    """
+
+    if dataset.chunks is None:
+        return block_rows
+
+    chunk_rows = dataset.chunks[0]
+
+    return max(block_rows // chunk_rows, 1) * chunk_rows
+
+
+def dataset_shapes(path: str, split: str = "train") -> dict:
+    """
+    Shapes and dtypes of the datasets of one split, read from file metadata.
+    """
+
+    with h5py.File(path, "r") as hdf:
+        return {
+            name: (hdf[name].shape, hdf[name].dtype)
+            for name in [f"X_{split}_DC", f"X_{split}_IC", f"Y_{split}"]
+        }
+
+
+def grid_storage(path: str, split: str = "train") -> tuple:
+    """
+    Storage types of `X_{split}_DC` and `X_{split}_IC` of one file, see
+    `utils.precision`.
+    """
+
+    with h5py.File(path, "r") as hdf:
+        return tuple(
+            storage_of(hdf[f"X_{split}_{detector}"]) for detector in ["DC", "IC"]
+        )
+
+
+def upcast(X: tf.Tensor, storage: str) -> tf.Tensor:
+    """
+    Float32 tensor of a batch stored as `storage`, bfloat16 arrives as the
+    uint16 bit pattern and is reinterpreted.
+    """
+
+    if storage == "bfloat16":
+        X = tf.bitcast(X, tf.bfloat16)
+
+    return tf.cast(X, tf.float32)
+
+
+def with_upcast(
+    dataset: tf.data.Dataset, storage_DC: str, storage_IC: str
+) -> tf.data.Dataset:
+    """
+    Upcasts the grids of `((X_DC, X_IC), Y)` batches to float32 in the input
+    pipeline, so reduced precision is only stored and moved.
+    """
+
+    if storage_DC == "float32" and storage_IC == "float32":
+        return dataset
+
+    def upcast_batch(X, Y):
+        return (upcast(X[0], storage_DC), upcast(X[1], storage_IC)), Y
+
+    return dataset.map(upcast_batch, num_parallel_calls=tf.data.AUTOTUNE)
+
+
+def read_blocks(
+    path,
+    split: str = "train",
+    label: str = DEFAULT_LABEL,
+    block_rows: int = 4096,
+    valid_only: bool = True,
+):
+    """
+    Generator of aligned `((X_DC, X_IC), Y)` blocks of one file, only one
+    block is in memory at a time. With `valid_only` only the valid runs of
+    each block are read, using the file's `valid_index`.
+
+    Args:
+        path: HDF5 file.
+        split: `train`, `validate` or `test`.
+        label: Name of the label to yield.
+        block_rows: Rows per read, rounded to the HDF5 chunk size.
+        valid_only: Drop events whose label is not positive.
+
+    """
+
+    if isinstance(path, bytes):
+        path = path.decode()
+
+    with h5py.File(path, "r") as hdf:
+        X_DC = hdf[f"X_{split}_DC"]
+        X_IC = hdf[f"X_{split}_IC"]
+        schema = LabelSchema.from_hdf(hdf)
+
+        block_rows = aligned_rows(X_DC, block_rows)
+
+        if valid_only:
+            labels = schema.read(hdf, split, label)
+
+            for runs in valid_index(path, label, hdf).blocks(split, block_rows):
+                rows = np.concatenate([np.arange(start, stop) for start, stop in runs])
+
+                yield (read_runs(X_DC, runs), read_runs(X_IC, runs)), labels[rows]
+
+            return
+
+        for start in range(0, X_DC.shape[0], block_rows):
+            stop = min(start + block_rows, X_DC.shape[0])
+
+            block_DC = X_DC[start:stop]
+            block_IC = X_IC[start:stop]
+            block_Y = schema.read(hdf, split, label, slice(start, stop))
+
+            yield (block_DC, block_IC), block_Y
+
+
+def make_dataset(
+    files: Sequence[str],
+    split: str = "train",
+    batch_size: int = 128,
+    label: str = DEFAULT_LABEL,
+    shuffle_buffer: Optional[int] = 10000,
+    block_rows: int = 4096,
+    cycle_length: Optional[int] = None,
+    valid_only: bool = True,
+    seed: Optional[int] = None,
+) -> tf.data.Dataset:
+    """
+    Streams batches straight from HDF5 files. Files are read in aligned
+    blocks, interleaved, shuffled within a bounded buffer and prefetched, so
+    memory use is independent of file size.
+
+    Args:
+        files: HDF5 files.
+        split: `train`, `validate` or `test`.
+        batch_size: Events per batch.
+        label: Name of the label used as target.
+        shuffle_buffer: Events in the shuffle buffer, `None` keeps file order.
+        block_rows: Rows per read.
+        cycle_length: Files read concurrently, at most `CYCLE_LENGTH` when
+            `None`, so memory does not grow with the number of files.
+        valid_only: Drop events whose label is not positive.
+        seed: Shuffle seed.
+
+    Returns:
+        Dataset of `((X_DC, X_IC), Y)` batches.
+    """
+
+    if isinstance(files, str):
+        files = [files]
+
+    shapes = dataset_shapes(files[0], split)
+    (_, *shape_DC), dtype_DC = shapes[f"X_{split}_DC"]
+    (_, *shape_IC), dtype_IC = shapes[f"X_{split}_IC"]
+    _, dtype_Y = shapes[f"Y_{split}"]
+
+    signature = (
+        (
+            tf.TensorSpec(shape=[None, *shape_DC], dtype=tf.as_dtype(dtype_DC)),
+            tf.TensorSpec(shape=[None, *shape_IC], dtype=tf.as_dtype(dtype_IC)),
+        ),
+        tf.TensorSpec(shape=[None], dtype=tf.as_dtype(dtype_Y)),
+    )
+
+    def file_blocks(path):
+        return tf.data.Dataset.from_generator(
+            partial(
+                read_blocks,
+                split=split,
+                label=label,
+                block_rows=block_rows,
+                valid_only=valid_only,
+            ),
+            args=(path,),
+            output_signature=signature,
+        )
+
+    dataset = tf.data.Dataset.from_tensor_slices(list(files))
+
+    if shuffle_buffer is not None:
+        dataset = dataset.shuffle(len(files), seed=seed)
+
+    dataset = dataset.interleave(
+        file_blocks,
+        cycle_length=cycle_length or min(len(files), CYCLE_LENGTH),
+        num_parallel_calls=tf.data.AUTOTUNE,
+        # Seeded pipelines repeat their order, e.g. for a resumed epoch
+        deterministic=shuffle_buffer is None or seed is not None,
+    )
+
+    dataset = dataset.unbatch()
+
+    if shuffle_buffer is not None:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed)
+
+    dataset = with_upcast(dataset.batch(batch_size), *grid_storage(files[0], split))
+
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def load_file(
+    path: str,
+    splits: Sequence[str] = ("train", "validate"),
+    label: str = DEFAULT_LABEL,
+    valid_only: bool = True,
+) -> dict:
+    """
+    Reads whole splits of one file into memory, with `valid_only` only the
+    valid rows are read.
+
+    Args:
+        path: HDF5 file.
+        splits: Splits to read.
+        label: Name of the label used as target.
+        valid_only: Drop events whose label is not positive.
+
+    Returns:
+        Dictionary from split to `([X_DC, X_IC], Y)`.
+    """
+
+    data = {}
+
+    with h5py.File(path, "r") as hdf:
+        schema = LabelSchema.from_hdf(hdf)
+
+        index = None
+        if valid_only:
+            index = valid_index(path, label, hdf)
+
+        for split in splits:
+            X_DC = hdf[f"X_{split}_DC"]
+            X_IC = hdf[f"X_{split}_IC"]
+            Y = schema.read(hdf, split, label)
+
+            storages = storage_of(X_DC), storage_of(X_IC)
+
+            if index is not None:
+                X_DC = index.read(X_DC, split)
+                X_IC = index.read(X_IC, split)
+                Y = Y[index.rows[split]]
+            else:
+                X_DC = X_DC[:]
+                X_IC = X_IC[:]
+
+            # Keras casts float16 itself, bfloat16 bit patterns are decoded
+            if storages[0] == "bfloat16":
+                X_DC = decode(X_DC, "bfloat16")
+            if storages[1] == "bfloat16":
+                X_IC = decode(X_IC, "bfloat16")
+
+            data[split] = ([X_DC, X_IC], Y)
+
+    return data
+
+
+class FilePrefetcher:
+    """
+    Loads the next files in the background while the current one is used.
+    At most `buffers` loaded files exist at once, counting the one handed out,
+    so `buffers=2` is double buffering. Files are handed out in order.
+
+    With `processes` the files load in up to `workers` worker processes, so
+    HDF5 decompression runs in parallel, otherwise on `workers` threads.
+
+    The time spent waiting for each file is kept in `wait_times`.
+    """
+
+    def __init__(
+        self,
+        files: Sequence[str],
+        load=load_file,
+        buffers: int = 2,
+        workers: int = 1,
+        processes: bool = False,
+    ) -> None:
+        """Construct `FilePrefetcher`
+
+        Args:
+            files: Files in the order they are consumed, may repeat.
+            load: Function loading one file, picklable with `processes`.
+            buffers: Maximum number of loaded files held at once.
+            workers: Files loading at the same time.
+            processes: Load in worker processes instead of threads.
+
+        """
+
+        assert buffers >= 1, "need at least one buffer"
+        assert workers >= 1, "need at least one worker"
+
+        self.files = list(files)
+        self.load = load
+        self.buffers = buffers
+        self.workers = workers
+        self.processes = processes
+        self.wait_times = []
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def __iter__(self):
+
+        # Files loading while the consumer holds one
+        ahead = self.buffers - 1
+
+        pending = deque()
+        files = iter(self.files)
+
+        executor = ProcessPoolExecutor if self.processes else ThreadPoolExecutor
+
+        with executor(max_workers=self.workers) as pool:
+
+            def submit():
+                for file in islice(files, 1):
+                    pending.append(pool.submit(self.load, file))
+
+            submit()
+
+            while pending:
+                start = time.time()
+                data = pending.popleft().result()
+                self.wait_times.append(time.time() - start)
+
+                for _ in range(ahead - len(pending)):
+                    submit()
+
+                yield data
+
+                del data
+
+                if not pending:
+                    submit()
+
+
+class PrefetchWait(keras.callbacks.Callback):
+    """
+    Seconds training waited for the files of `FilePrefetcher`s in every
+    epoch, kept in `epochs` and printed at the end of it. Prefetchers may be
+    added to `prefetchers` while training.
+    """
+
+    def __init__(self, prefetchers: list, verbose: bool = True) -> None:
+
+        super().__init__()
+
+        self.prefetchers = prefetchers
+        self.verbose = verbose
+        self.epochs = []
+
+        # Waits already counted in an earlier epoch
+        self.counted = 0
+
+    def on_epoch_end(self, epoch, logs=None):
+
+        waits = [
+            wait for prefetcher in self.prefetchers for wait in prefetcher.wait_times
+        ]
+
+        self.epochs.append(sum(waits[self.counted :]))
+        self.counted = len(waits)
+
+        if self.verbose:
+            print(f"Epoch: {epoch}, Data Wait: {self.epochs[-1]:.2f}s")
+
+
+def make_array_dataset(
+    X_DC: np.ndarray,
+    X_IC: np.ndarray,
+    Y: np.ndarray,
+    batch_size: int = 128,
+    shuffle: bool = True,
+    seed: Optional[int] = None,
+    storage_DC: str = "float32",
+    storage_IC: str = "float32",
+) -> tf.data.Dataset:
+    """
+    Batches from arrays that must not be copied whole, e.g. `np.memmap` views
+    of a training cache. Each batch gathers its rows in increasing order so
+    reads stay local, only one batch is materialized at a time.
+
+    Args:
+        X_DC: DeepCore features.
+        X_IC: IceCube features.
+        Y: Targets.
+        batch_size: Events per batch.
+        shuffle: Shuffle rows every pass.
+        seed: Shuffle seed.
+        storage_DC: Storage type of `X_DC`.
+        storage_IC: Storage type of `X_IC`.
+
+    Returns:
+        Dataset of `((X_DC, X_IC), Y)` batches.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    def batches():
+        rows = rng.permutation(len(Y)) if shuffle else np.arange(len(Y))
+
+        for start in range(0, len(rows), batch_size):
+            batch = np.sort(rows[start : start + batch_size])
+            yield (X_DC[batch], X_IC[batch]), Y[batch]
+
+    signature = (
+        (
+            tf.TensorSpec(shape=[None, *X_DC.shape[1:]], dtype=tf.as_dtype(X_DC.dtype)),
+            tf.TensorSpec(shape=[None, *X_IC.shape[1:]], dtype=tf.as_dtype(X_IC.dtype)),
+        ),
+        tf.TensorSpec(shape=[None], dtype=tf.as_dtype(Y.dtype)),
+    )
+
+    dataset = tf.data.Dataset.from_generator(batches, output_signature=signature)
+    dataset = with_upcast(dataset, storage_DC, storage_IC)
+
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def make_prefetched_dataset(
+    prefetcher: FilePrefetcher,
+    split: str = "train",
+    batch_size: int = 128,
+    shuffle: bool = True,
+    skip: int = 0,
+    seed: Optional[int] = None,
+    first: int = 0,
+) -> tf.data.Dataset:
+    """
+    Batches of whole files loaded into memory by a `FilePrefetcher` of
+    `load_file`, one file after another in the order of its files, so a
+    single `fit` trains on any number of files while the next ones load.
+    Batches never span two files.
+
+    Args:
+        prefetcher: Loads `split` of every file.
+        split: `train`, `validate` or `test`.
+        batch_size: Events per batch.
+        shuffle: Shuffle the events of every file.
+        skip: Batches of the first file left out, e.g. already trained on.
+        seed: Shuffle seed, every file is shuffled by it and its position.
+        first: Position of the first file among all files of the run, so a
+            stream restarted at any file shuffles it as before.
+
+    Returns:
+        Dataset of `((X_DC, X_IC), Y)` batches.
+    """
+
+    def batches():
+        skipped = skip
+
+        for position, data in enumerate(prefetcher, first):
+            (X_DC, X_IC), Y = data[split]
+
+            rng = np.random.default_rng(None if seed is None else [seed, position])
+            rows = rng.permutation(len(Y)) if shuffle else np.arange(len(Y))
+
+            for start in range(skipped * batch_size, len(rows), batch_size):
+                batch = rows[start : start + batch_size]
+                yield (X_DC[batch], X_IC[batch]), Y[batch]
+
+            skipped = 0
+
+    shapes = dataset_shapes(prefetcher.files[0], split)
+
+    # `load_file` decodes bfloat16 bit patterns
+    def spec(name, storage):
+        (_, *shape), dtype = shapes[name]
+        dtype = np.float32 if storage == "bfloat16" else dtype
+        return tf.TensorSpec(shape=[None, *shape], dtype=tf.as_dtype(dtype))
+
+    storage_DC, storage_IC = grid_storage(prefetcher.files[0], split)
+
+    signature = (
+        (spec(f"X_{split}_DC", storage_DC), spec(f"X_{split}_IC", storage_IC)),
+        tf.TensorSpec(shape=[None], dtype=tf.as_dtype(shapes[f"Y_{split}"][1])),
+    )
+
+    dataset = tf.data.Dataset.from_generator(batches, output_signature=signature)
+
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def densify(lengths, slots, values, shape) -> tf.Tensor:
+    """
+    Scatters one sparse batch from `utils.sparse_grid` into the dense
+    `(n, strings, doms, features)` tensor, in graph.
+
+    Args:
+        lengths: Entries of every event.
+        slots: Flat DOM slot of every entry.
+        values: Features of every entry.
+        shape: Dense shape of one event, `(strings, doms, features)`.
+
+    """
+
+    strings, doms, features = shape
+
+    n = tf.shape(lengths, out_type=tf.int64)[0]
+    events = tf.repeat(tf.range(n), lengths)
+
+    indices = tf.stack([events, tf.cast(slots, tf.int64)], axis=1)
+    dense = tf.scatter_nd(indices, values, tf.stack([n, strings * doms, features]))
+
+    return tf.reshape(dense, [-1, strings, doms, features])
+
+
+def make_sparse_dataset(
+    files: Sequence[str],
+    split: str = "train",
+    batch_size: int = 128,
+    label: str = DEFAULT_LABEL,
+    shuffle: bool = True,
+    block_rows: int = 4096,
+    cycle_length: Optional[int] = None,
+    valid_only: bool = True,
+    seed: Optional[int] = None,
+) -> tf.data.Dataset:
+    """
+    Streams batches from sparse shards written by `utils.sparse_grid`. Only
+    the nonzero DOMs are read and moved, each batch is densified in graph by
+    `densify` just before it reaches the network.
+
+    Args:
+        files: Sparse HDF5 files.
+        split: `train`, `validate` or `test`.
+        batch_size: Events per batch.
+        label: Name of the label used as target.
+        shuffle: Shuffle files, events within blocks and batches.
+        block_rows: Events read at a time.
+        cycle_length: Files read concurrently, at most `CYCLE_LENGTH` when
+            `None`, so memory does not grow with the number of files.
+        valid_only: Drop events whose label is not positive.
+        seed: Shuffle seed.
+
+    Returns:
+        Dataset of `((X_DC, X_IC), Y)` batches.
+    """
+
+    if isinstance(files, str):
+        files = [files]
+
+    shapes = sparse_shapes(files[0], split)
+    (_, *shape_DC), dtype_DC = shapes[f"X_{split}_DC"]
+    (_, *shape_IC), dtype_IC = shapes[f"X_{split}_IC"]
+    _, dtype_Y = shapes[f"Y_{split}"]
+
+    def entries(shape, dtype):
+        return (
+            tf.TensorSpec(shape=[None], dtype=tf.int64),
+            tf.TensorSpec(shape=[None], dtype=tf.int32),
+            tf.TensorSpec(shape=[None, shape[-1]], dtype=tf.as_dtype(dtype)),
+        )
+
+    signature = (
+        (entries(shape_DC, dtype_DC), entries(shape_IC, dtype_IC)),
+        tf.TensorSpec(shape=[None], dtype=tf.as_dtype(dtype_Y)),
+    )
+
+    def file_batches(path):
+        return tf.data.Dataset.from_generator(
+            partial(
+                read_sparse_batches,
+                split=split,
+                batch_size=batch_size,
+                label=label,
+                block_rows=block_rows,
+                valid_only=valid_only,
+                shuffle=shuffle,
+                seed=seed,
+            ),
+            args=(path,),
+            output_signature=signature,
+        )
+
+    def dense(grids, Y):
+        sparse_DC, sparse_IC = grids
+
+        return (densify(*sparse_DC, shape_DC), densify(*sparse_IC, shape_IC)), Y
+
+    dataset = tf.data.Dataset.from_tensor_slices(list(files))
+
+    if shuffle:
+        dataset = dataset.shuffle(len(files), seed=seed)
+
+    dataset = dataset.interleave(
+        file_batches,
+        cycle_length=cycle_length or min(len(files), CYCLE_LENGTH),
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=not shuffle or seed is not None,
+    )
+
+    dataset = dataset.map(dense, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = with_upcast(dataset, *grid_storage(files[0], split))
+
+    return dataset.prefetch(tf.data.AUTOTUNE)
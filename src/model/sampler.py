@@ -0,0 +1,315 @@
+import os
+import json
+import h5py
+import keras
+import numpy as np
+import tensorflow as tf
+
+from functools import partial
+from typing import Optional, Sequence
+
+from model.pipeline import aligned_rows, grid_storage, with_upcast
+from utils.labels import DEFAULT_LABEL, LabelSchema
+from utils.valid_index import read_runs, valid_index
+
+
+class GlobalSampler:
+    """
+    Shuffled batches mixing the valid events of every file, instead of one
+    file per epoch.
+
+    Valid rows are grouped into blocks of whole HDF5 chunks of one file. Each
+    pass over the data draws a permutation of every block of every file and
+    reads them `mix_blocks` at a time, the rows of such a group are shuffled
+    together and cut into batches. Batches run on across groups and passes,
+    so the stream is endless and `steps_per_epoch` is free.
+
+    The order is a pure function of `seed`, so the position in the stream is
+    the number of batches consumed, `batch`. It is saved with `save`, with the
+    seed, and a new sampler resumes from it with `load`.
+    """
+
+    def __init__(
+        self,
+        files: Sequence[str],
+        split: str = "train",
+        batch_size: int = 128,
+        label: str = DEFAULT_LABEL,
+        block_rows: int = 4096,
+        mix_blocks: int = 8,
+        shuffle: bool = True,
+        seed: int = 0,
+    ) -> None:
+        """Construct `GlobalSampler`
+
+        Args:
+            files: HDF5 training files.
+            split: `train`, `validate` or `test`.
+            batch_size: Events per batch.
+            label: Name of the label used as target.
+            block_rows: File rows per block, rounded to the HDF5 chunk size.
+            mix_blocks: Blocks read and shuffled together.
+            shuffle: Shuffle blocks and rows, otherwise stream in file order.
+            seed: Seed of every permutation.
+
+        """
+
+        if isinstance(files, str):
+            files = [files]
+
+        self.files = list(files)
+        self.split = split
+        self.batch_size = batch_size
+        self.label = label
+        self.mix_blocks = mix_blocks
+        self.shuffle = shuffle
+        self.seed = seed
+
+        # Next batch to hand out to training
+        self.batch = 0
+
+        self.blocks = []
+
+        for file, path in enumerate(self.files):
+            with h5py.File(path, "r") as hdf:
+                rows = aligned_rows(hdf[f"X_{split}_DC"], block_rows)
+
+                if file == 0:
+                    self.shapes = {
+                        name: (hdf[name].shape[1:], hdf[name].dtype)
+                        for name in [f"X_{split}_DC", f"X_{split}_IC", f"Y_{split}"]
+                    }
+
+                for runs in valid_index(path, label, hdf).blocks(split, rows):
+                    self.blocks.append((file, np.asarray(runs, dtype=np.int64)))
+
+        assert len(self.blocks) > 0, f"no valid `{split}` events in {len(files)} files"
+
+        self.sizes = np.array(
+            [np.sum(runs[:, 1] - runs[:, 0]) for _, runs in self.blocks]
+        )
+        self.rows_per_pass = int(self.sizes.sum())
+
+    @property
+    def steps_per_pass(self) -> int:
+        """
+        Batches in one pass over every valid event.
+        """
+
+        return max(self.rows_per_pass // self.batch_size, 1)
+
+    def _order(self, cycle: int) -> np.ndarray:
+        """
+        Block order of pass `cycle` over the data.
+        """
+
+        if not self.shuffle:
+            return np.arange(len(self.blocks))
+
+        return np.random.default_rng([self.seed, cycle]).permutation(len(self.blocks))
+
+    def _groups(self, order: np.ndarray) -> np.ndarray:
+        """
+        Row offset of the start of every group of `order`, and of its end.
+        """
+
+        starts = np.arange(0, len(order), self.mix_blocks)
+        sizes = np.add.reduceat(self.sizes[order], starts)
+
+        return np.concatenate(([0], np.cumsum(sizes)))
+
+    def locate(self, batch: int) -> tuple:
+        """
+        Pass, group and row within the group where `batch` starts.
+        """
+
+        position = batch * self.batch_size
+        cycle, offset = divmod(position, self.rows_per_pass)
+
+        bounds = self._groups(self._order(cycle))
+        group = int(np.searchsorted(bounds, offset, side="right")) - 1
+
+        return cycle, group, int(offset - bounds[group])
+
+    def _read_group(self, cycle: int, group: int, handles: dict) -> tuple:
+
+        order = self._order(cycle)
+        members = order[group * self.mix_blocks : (group + 1) * self.mix_blocks]
+
+        # Read in file order for locality, the rows are shuffled afterwards
+        members = sorted(
+            members,
+            key=lambda block: (self.blocks[block][0], self.blocks[block][1][0, 0]),
+        )
+
+        DC, IC, Y = [], [], []
+
+        for block in members:
+            file, runs = self.blocks[block]
+
+            if file not in handles:
+                hdf = h5py.File(self.files[file], "r")
+                labels = LabelSchema.from_hdf(hdf).read(hdf, self.split, self.label)
+                handles[file] = (hdf, labels)
+
+            hdf, labels = handles[file]
+            rows = np.concatenate([np.arange(start, stop) for start, stop in runs])
+
+            DC.append(read_runs(hdf[f"X_{self.split}_DC"], runs))
+            IC.append(read_runs(hdf[f"X_{self.split}_IC"], runs))
+            Y.append(labels[rows])
+
+        DC, IC, Y = np.concatenate(DC), np.concatenate(IC), np.concatenate(Y)
+
+        if self.shuffle:
+            rows = np.random.default_rng([self.seed, cycle, group]).permutation(len(Y))
+            DC, IC, Y = DC[rows], IC[rows], Y[rows]
+
+        return DC, IC, Y
+
+    def batches(self, start: Optional[int] = None):
+        """
+        Endless generator of `((X_DC, X_IC), Y)` batches from batch `start`,
+        by default the current `batch`.
+        """
+
+        cycle, group, offset = self.locate(self.batch if start is None else start)
+        groups = len(self._groups(self._order(cycle))) - 1
+
+        handles = {}
+        pieces, size = [], 0
+
+        try:
+            while True:
+                DC, IC, Y = self._read_group(cycle, group, handles)
+
+                while offset < len(Y):
+                    take = min(self.batch_size - size, len(Y) - offset)
+                    window = slice(offset, offset + take)
+                    pieces.append((DC[window], IC[window], Y[window]))
+                    size += take
+                    offset += take
+
+                    if size == self.batch_size:
+                        yield self._join(pieces)
+                        pieces, size = [], 0
+
+                offset = 0
+                group += 1
+
+                if group == groups:
+                    cycle, group = cycle + 1, 0
+        finally:
+            for hdf, _ in handles.values():
+                hdf.close()
+
+    @staticmethod
+    def _join(pieces: list) -> tuple:
+        """
+        One batch from the pieces of consecutive groups it spans.
+        """
+
+        if len(pieces) == 1:
+            DC, IC, Y = pieces[0]
+        else:
+            DC, IC, Y = (np.concatenate(arrays) for arrays in zip(*pieces))
+
+        return (DC, IC), Y
+
+    def dataset(self, start: Optional[int] = None) -> tf.data.Dataset:
+        """
+        `tf.data` pipeline of `batches`, prefetched.
+        """
+
+        (shape_DC, dtype_DC) = self.shapes[f"X_{self.split}_DC"]
+        (shape_IC, dtype_IC) = self.shapes[f"X_{self.split}_IC"]
+        (_, dtype_Y) = self.shapes[f"Y_{self.split}"]
+
+        signature = (
+            (
+                tf.TensorSpec(shape=[None, *shape_DC], dtype=tf.as_dtype(dtype_DC)),
+                tf.TensorSpec(shape=[None, *shape_IC], dtype=tf.as_dtype(dtype_IC)),
+            ),
+            tf.TensorSpec(shape=[None], dtype=tf.as_dtype(dtype_Y)),
+        )
+
+        dataset = tf.data.Dataset.from_generator(
+            partial(self.batches, self.batch if start is None else start),
+            output_signature=signature,
+        )
+
+        dataset = with_upcast(dataset, *grid_storage(self.files[0], self.split))
+
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    def state(self) -> dict:
+
+        return {
+            "batch": self.batch,
+            "batch_size": self.batch_size,
+            "seed": self.seed,
+            "rows_per_pass": self.rows_per_pass,
+            "blocks": len(self.blocks),
+        }
+
+    def save(self, path: str) -> str:
+        """
+        Writes the cursor to a `.json` file.
+        """
+
+        temporary = f"{path}.tmp"
+
+        with open(temporary, "w") as f:
+            json.dump(self.state(), f, indent=2)
+
+        os.replace(temporary, path)
+
+        return path
+
+    def load(self, path: str) -> "GlobalSampler":
+        """
+        Resumes from a cursor written by `save` for the same files.
+        """
+
+        with open(path) as f:
+            return self.restore(json.load(f))
+
+    def restore(self, state: dict) -> "GlobalSampler":
+        """
+        Resumes from a cursor returned by `state` for the same files, the
+        order continues with the seed of the cursor.
+        """
+
+        for key in ["batch_size", "rows_per_pass", "blocks"]:
+            assert (
+                state[key] == self.state()[key]
+            ), f"cursor `{key}` is {state[key]}, sampler has {self.state()[key]}"
+
+        self.seed = state["seed"]
+        self.batch = state["batch"]
+
+        return self
+
+
+class SamplerCursor(keras.callbacks.Callback):
+    """
+    Advances the cursor of a `GlobalSampler` as batches are trained on, not as
+    they are prefetched, and saves it at the end of every epoch.
+    """
+
+    def __init__(self, sampler: GlobalSampler, path: Optional[str] = None) -> None:
+
+        super().__init__()
+
+        self.sampler = sampler
+        self.path = path
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = self.sampler.batch
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.sampler.batch = self.start + batch + 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.path is not None:
+            self.sampler.save(self.path)
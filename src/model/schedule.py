@@ -0,0 +1,95 @@
+import keras
+
+from keras import ops
+from typing import Callable, Optional
+
+
+def step_decay(epoch, learning_rate: float, drop: float, epochs_step_drop: int):
+    """
+    `learning_rate` dropped by a factor `drop` every `epochs_step_drop` epochs.
+    """
+
+    return learning_rate * ops.power(drop, ops.floor((1 + epoch) / epochs_step_drop))
+
+
+@keras.saving.register_keras_serializable(package="MuonNeutrinoReconstruction")
+class EpochSchedule(keras.optimizers.schedules.LearningRateSchedule):
+    """
+    Learning rate of an epoch, `function(epoch, learning_rate, drop,
+    epochs_step_drop)`, with the epoch counted from the optimizer step in
+    epochs of `steps_per_epoch` steps. It is evaluated inside the train
+    function and follows the step restored from a checkpoint, so no callback
+    has to set it and a single `fit` over many files uses the same rates as
+    one `fit` per epoch.
+
+    `function` receives the epoch as a tensor and must use `keras.ops`.
+    """
+
+    def __init__(
+        self,
+        learning_rate: float,
+        drop: float,
+        epochs_step_drop: int,
+        steps_per_epoch: int,
+        initial_epoch: int = 0,
+        function: Optional[Callable] = None,
+    ) -> None:
+        """Construct `EpochSchedule`
+
+        Args:
+            learning_rate: Learning rate of the first epochs.
+            drop: Factor of every drop.
+            epochs_step_drop: Epochs between drops.
+            steps_per_epoch: Optimizer steps of one epoch.
+            initial_epoch: Epoch of optimizer step 0.
+            function: Learning rate of an epoch, `step_decay` when `None`.
+
+        """
+
+        assert steps_per_epoch >= 1, "an epoch needs at least one step"
+
+        self.learning_rate = learning_rate
+        self.drop = drop
+        self.epochs_step_drop = epochs_step_drop
+        self.steps_per_epoch = steps_per_epoch
+        self.initial_epoch = initial_epoch
+        self.function = function or step_decay
+
+    def epoch(self, step):
+        return self.initial_epoch + ops.floor_divide(step, self.steps_per_epoch)
+
+    def __call__(self, step):
+
+        epoch = ops.cast(self.epoch(ops.cast(step, "int64")), "float32")
+
+        return ops.cast(
+            self.function(epoch, self.learning_rate, self.drop, self.epochs_step_drop),
+            "float32",
+        )
+
+    def get_config(self) -> dict:
+
+        config = {
+            "learning_rate": self.learning_rate,
+            "drop": self.drop,
+            "epochs_step_drop": self.epochs_step_drop,
+            "steps_per_epoch": self.steps_per_epoch,
+            "initial_epoch": self.initial_epoch,
+        }
+
+        if self.function is not step_decay:
+            config["function"] = keras.saving.serialize_keras_object(self.function)
+
+        return config
+
+    @classmethod
+    def from_config(cls, config: dict) -> "EpochSchedule":
+
+        config = dict(config)
+
+        if "function" in config:
+            config["function"] = keras.saving.deserialize_keras_object(
+                config["function"]
+            )
+
+        return cls(**config)
@@ -0,0 +1,159 @@
+import os
+import sys
+import hashlib
+import argparse
+
+from joblib import Memory
+from datetime import timedelta
+from functools import wraps
+
+# Caching
+cachedir = "./cache"
+memory = Memory(cachedir, mmap_mode="r", verbose=0)
+
+# Size bound of the preprocessing cache, least recently used items go first
+CACHE_BYTES_LIMIT = "20G"
+
+
+def file_hash(path: str, block_size: int = 1 << 24) -> str:
+    """
+    SHA1 of the contents of the file at `path`, read in blocks.
+    """
+
+    digest = hashlib.sha1()
+
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def fingerprint(path: str, content: bool = False) -> tuple:
+    """
+    Identifies the version of an input file for cache keys.
+
+    Args:
+        path: Input file.
+        content: Hash the file contents instead of trusting size and mtime.
+
+    """
+
+    stat = os.stat(path)
+
+    if content:
+        return (os.path.abspath(path), file_hash(path))
+
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def prune(bytes_limit=CACHE_BYTES_LIMIT, items_limit=None, age_limit=None) -> None:
+    """
+    Evicts the least recently used cache items until every limit holds.
+
+    Args:
+        bytes_limit: Maximum total size, bytes or a string like `"20G"`.
+        items_limit: Maximum number of items.
+        age_limit: Maximum `datetime.timedelta` since last access.
+
+    """
+
+    memory.reduce_size(
+        bytes_limit=bytes_limit, items_limit=items_limit, age_limit=age_limit
+    )
+
+
+def cached_stage(func):
+    """
+    Caches a preprocessing stage in `memory`, arrays in the result are stored
+    as `.npy` files and returned memory mapped. The cache is pruned back to
+    `CACHE_BYTES_LIMIT` after every newly computed result.
+
+    Stages taking input files should also take their `fingerprint` so the
+    key changes with the file.
+    """
+
+    stage = memory.cache(func)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+
+        if stage.check_call_in_cache(*args, **kwargs):
+            return stage(*args, **kwargs)
+
+        result = stage(*args, **kwargs)
+        prune()
+
+        return result
+
+    wrapper.stage = stage
+
+    return wrapper
+
+
+def cache_items() -> list:
+    """
+    Cached items, most recently used first.
+    """
+
+    items = memory.store_backend.get_items()
+
+    return sorted(items, key=lambda item: item.last_access, reverse=True)
+
+
+def _format_bytes(size: int) -> str:
+
+    for unit in ["B", "K", "M", "G"]:
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+
+    return f"{size:.1f}T"
+
+
+def main(argv=None) -> None:
+    """
+    Command line interface, run from `src` with `python -m utils.cache`.
+    """
+
+    parser = argparse.ArgumentParser(description="Inspect and prune the cache")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("info", help="list cached items")
+
+    prune_parser = commands.add_parser("prune", help="evict least recently used")
+    prune_parser.add_argument("--bytes-limit", default=CACHE_BYTES_LIMIT)
+    prune_parser.add_argument("--items-limit", type=int, default=None)
+    prune_parser.add_argument("--age-days", type=float, default=None)
+
+    commands.add_parser("clear", help="remove every cached item")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "info":
+        items = cache_items()
+        total = 0
+
+        for item in items:
+            total += item.size
+            stage = os.path.relpath(os.path.dirname(item.path), memory.location)
+            print(
+                f"{_format_bytes(item.size):>8}  "
+                f"{item.last_access:%Y-%m-%d %H:%M}  {stage}"
+            )
+
+        print(f"{len(items)} items, {_format_bytes(total)} in {memory.location}")
+
+    elif args.command == "prune":
+        age_limit = None
+        if args.age_days is not None:
+            age_limit = timedelta(days=args.age_days)
+
+        prune(args.bytes_limit, args.items_limit, age_limit)
+
+    elif args.command == "clear":
+        memory.clear(warn=False)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,16 +1,31 @@
+import os
 import h5py
 import pathlib
-import sqlite3
 import numpy as np
 import pandas as pd
 
-from joblib import Memory
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from typing import Optional, Tuple
 
+from utils.grid import pulses_to_grid
+from utils.labels import decode_label_names, label_chunks
+from utils.normalize import NORM_METHODS, Normalizer
+from utils.database import (
+    PULSE_TABLE,
+    TRUTH_TABLE,
+    CLEAN_SELECTION,
+    Selection,
+    index_db,
+    read_db,
+    read_selected,
+)
+
 # Caching
-cachedir = "./cache"
-memory = Memory(cachedir, verbose=0)
+from utils.cache import cached_stage, fingerprint, memory
+
+# Pulse columns kept when events are converted to arrays
+PULSE_FEATURES = ["dom_x", "dom_y", "dom_z", "dom_time", "charge"]
 
 
 # Pads based on the event with the longest length
@@ -27,6 +42,256 @@ def zero_pad(group, max_len):
     return padded.fillna(0)
 
 
+def event_offsets(event_no: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Finds where each event starts in a pulse table sorted by `event_no`.
+
+    Args:
+        event_no: Event number of every pulse, grouped by event.
+
+    Returns:
+        Unique event numbers and an int64 offsets array of length
+        `n_events + 1`, pulses of event `i` are rows `offsets[i]:offsets[i + 1]`.
+    """
+
+    event_no = np.asarray(event_no)
+
+    if len(event_no) == 0:
+        return event_no[:0], np.zeros(1, dtype=np.int64)
+
+    starts = np.flatnonzero(event_no[1:] != event_no[:-1]) + 1
+    starts = np.concatenate(([0], starts))
+
+    offsets = np.empty(len(starts) + 1, dtype=np.int64)
+    offsets[:-1] = starts
+    offsets[-1] = len(event_no)
+
+    return event_no[starts], offsets
+
+
+def pad_events(
+    pulse: pd.DataFrame,
+    features: Optional[list] = None,
+    max_len: Optional[int] = None,
+    dtype=np.float32,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Scatters every pulse into a preallocated zero padded array in one pass.
+
+    Args:
+        pulse: Pulse dataframe with an `event_no` column.
+        features: Columns to keep, defaults to `PULSE_FEATURES`.
+        max_len: Pulses kept per event, defaults to the longest event.
+        dtype: Data type of the padded array.
+
+    Returns:
+        Event numbers, padded array of shape `(n_events, max_len, n_features)`
+        and the number of real pulses in each event.
+    """
+
+    ragged = RaggedPulses.from_dataframe(pulse, features, dtype)
+    padded, lengths = ragged.pad(max_len)
+
+    return ragged.event_no, padded, lengths
+
+
+class RaggedPulses:
+    """
+    Pulses of many events stored as one contiguous `(n_pulses, n_features)`
+    array plus int64 offsets, pulses of event `i` are rows
+    `values[offsets[i]:offsets[i + 1]]`.
+
+    Indexing with an integer returns a view of that event's pulses, indexing
+    with a unit step slice returns a `RaggedPulses` sharing the same buffer,
+    indexing with an index array or boolean mask gathers a copy with `take`.
+    """
+
+    def __init__(
+        self,
+        values: np.ndarray,
+        offsets: np.ndarray,
+        event_no: Optional[np.ndarray] = None,
+    ) -> None:
+        """Construct `RaggedPulses`
+
+        Args:
+            values: Pulse features, rows grouped by event.
+            offsets: Start of each event in `values`, length `n_events + 1`.
+            event_no: Event number of each event.
+
+        """
+
+        offsets = np.asarray(offsets, dtype=np.int64)
+
+        assert offsets.ndim == 1 and len(offsets) >= 1, "offsets must be 1D"
+        assert np.all(np.diff(offsets) >= 0), "offsets must be non decreasing"
+        assert offsets[-1] <= len(values), "offsets run past the end of values"
+
+        if event_no is None:
+            event_no = np.arange(len(offsets) - 1)
+
+        assert len(event_no) == len(offsets) - 1, "one event_no per event"
+
+        self.values = values
+        self.offsets = offsets
+        self.event_no = np.asarray(event_no)
+
+    @classmethod
+    def from_dataframe(
+        cls,
+        pulse: pd.DataFrame,
+        features: Optional[list] = None,
+        dtype=np.float32,
+    ) -> "RaggedPulses":
+        """
+        Builds ragged pulses from a pulse dataframe with an `event_no` column.
+
+        Args:
+            pulse: Pulse dataframe.
+            features: Columns to keep, defaults to `PULSE_FEATURES`.
+            dtype: Data type of the values array.
+
+        """
+
+        if features is None:
+            features = PULSE_FEATURES
+
+        event_no = pulse["event_no"].to_numpy()
+        values = np.ascontiguousarray(pulse[features].to_numpy(dtype=dtype))
+
+        # Stable sort keeps the pulse order within each event
+        if np.any(event_no[1:] < event_no[:-1]):
+            order = np.argsort(event_no, kind="stable")
+            event_no = event_no[order]
+            values = values[order]
+
+        events, offsets = event_offsets(event_no)
+
+        return cls(values, offsets, events)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, index):
+
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+
+            if step == 1:
+                stop = max(start, stop)
+                return RaggedPulses(
+                    self.values,
+                    self.offsets[start : stop + 1],
+                    self.event_no[start:stop],
+                )
+
+            index = np.arange(start, stop, step)
+
+        if isinstance(index, (list, np.ndarray)):
+            return self.take(index)
+
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError("event index out of range")
+
+        return self.values[self.offsets[index] : self.offsets[index + 1]]
+
+    def __repr__(self) -> str:
+        return f"RaggedPulses(events={len(self)}, pulses={self.n_pulses})"
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """Number of pulses in each event."""
+        return np.diff(self.offsets)
+
+    @property
+    def n_pulses(self) -> int:
+        return int(self.offsets[-1] - self.offsets[0])
+
+    @property
+    def flat(self) -> np.ndarray:
+        """View of the pulses of every event in this container."""
+        return self.values[self.offsets[0] : self.offsets[-1]]
+
+    def event(self, event_no) -> np.ndarray:
+        """
+        Pulses of the event with event number `event_no`, assumes the events
+        are sorted by event number.
+        """
+
+        index = np.searchsorted(self.event_no, event_no)
+
+        if index == len(self) or self.event_no[index] != event_no:
+            raise KeyError(f"event {event_no} not found")
+
+        return self[index]
+
+    def take(self, indices) -> "RaggedPulses":
+        """
+        Gathers the given events, by index or by a boolean mask over every
+        event, into a new compact container (copies).
+        """
+
+        indices = np.asarray(indices)
+
+        if indices.dtype == bool:
+            if len(indices) != len(self):
+                raise IndexError(
+                    f"boolean index of {len(indices)} events, container has {len(self)}"
+                )
+
+            indices = np.flatnonzero(indices)
+
+        indices = indices.astype(np.int64)
+        indices = np.where(indices < 0, indices + len(self), indices)
+
+        lengths = self.lengths[indices]
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        rows = np.repeat(self.offsets[indices] - offsets[:-1], lengths)
+        rows += np.arange(offsets[-1])
+
+        return RaggedPulses(self.values[rows], offsets, self.event_no[indices])
+
+    def pad(self, max_len: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Scatters the pulses into a zero padded array.
+
+        Args:
+            max_len: Pulses kept per event, defaults to the longest event.
+
+        Returns:
+            Array of shape `(n_events, max_len, n_features)` and the number of
+            real pulses kept for each event.
+        """
+
+        lengths = self.lengths
+
+        if max_len is None:
+            max_len = int(lengths.max()) if len(lengths) > 0 else 0
+
+        event_index = np.repeat(np.arange(len(self)), lengths)
+        position = np.arange(self.n_pulses) - np.repeat(
+            self.offsets[:-1] - self.offsets[0], lengths
+        )
+
+        keep = position < max_len
+
+        padded = np.zeros(
+            (len(self), max_len) + self.values.shape[1:], dtype=self.values.dtype
+        )
+        padded[event_index[keep], position[keep]] = self.flat[keep]
+
+        return padded, np.minimum(lengths, max_len)
+
+
 # Data class for sublisting pulses
 @dataclass
 class DOMData:
@@ -40,60 +305,257 @@ def get_hdf5(path, header, data) -> pd.DataFrame:
 
     with h5py.File(path, "r") as hdf:
         data = np.array(hdf.get("labels"))
-        header = np.array(hdf.get("output_label_names"))
-        header = [str(i).replace("b", "").strip("'") for i in header]
+        header = decode_label_names(hdf.get("output_label_names"))
 
         df = pd.DataFrame(data, columns=header)
 
     return df
 
 
-def build_files(directory, header, data) -> pd.DataFrame:
+def _read_labels(path, indices=None) -> np.ndarray:
+    """
+    Worker reading the `labels` dataset of one file, optionally only the
+    columns at `indices`.
+    """
+
+    with h5py.File(path, "r") as hdf:
+        labels = hdf["labels"]
+
+        if indices is None:
+            return labels[:]
+
+        return labels[:, indices]
+
+
+def load_labels(
+    directory,
+    pattern: str = "*.hdf5",
+    columns: Optional[list] = None,
+    workers: Optional[int] = None,
+) -> pd.DataFrame:
+    """
+    Loads the `labels` datasets of every matching file in `directory` into one
+    table. Files are read in parallel worker processes and copied straight
+    into a preallocated column-major array, so the cost is linear in the
+    number of files.
+
+    Args:
+        directory: Directory holding the HDF5 files.
+        pattern: Glob pattern files must match.
+        columns: Names of the label columns to read, defaults to every column.
+        workers: Number of worker processes, defaults to the CPU count.
+
+    Returns:
+        Labels of every file in sorted file order.
+    """
+
+    # `.gitignore` of data directories is never a label file
+    paths = sorted(
+        path
+        for path in pathlib.Path(directory).glob(pattern)
+        if path.is_file() and path.name != ".gitignore"
+    )
+
+    assert len(paths) > 0, f"no files matching `{pattern}` in {directory}"
+
+    rows = []
+
+    for path in paths:
+        with h5py.File(path, "r") as hdf:
+            rows.append(hdf["labels"].shape[0])
 
-    import pathlib
+            if len(rows) == 1:
+                header = decode_label_names(hdf["output_label_names"])
+                dtype = hdf["labels"].dtype
 
-    hdf5_df = pd.DataFrame()
+    indices = None
 
-    pathdir = pathlib.Path(directory)
+    if columns is not None:
+        missing = [column for column in columns if column not in header]
+        assert len(missing) == 0, f"label columns {missing} not in file"
 
-    for path in pathdir.iterdir():
+        repeated = sorted({column for column in columns if columns.count(column) > 1})
+        assert len(repeated) == 0, f"label columns {repeated} requested more than once"
 
-        print(path)
+        # h5py needs increasing indices, restore the requested order afterwards
+        indices = sorted(header.index(column) for column in columns)
+        order = [indices.index(header.index(column)) for column in columns]
+        header = list(columns)
 
-        if str(path) == "data/archive/.gitignore":
-            continue
+    offsets = np.concatenate(([0], np.cumsum(rows)))
+    table = np.empty((offsets[-1], len(header)), dtype=dtype, order="F")
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    if workers > 1 and len(paths) > 1:
+        pool = ProcessPoolExecutor(max_workers=min(workers, len(paths)))
+        chunks = pool.map(_read_labels, paths, [indices] * len(paths))
+    else:
+        pool = None
+        chunks = (_read_labels(path, indices) for path in paths)
+
+    for i, chunk in enumerate(chunks):
+        if indices is not None:
+            chunk = chunk[:, order]
+
+        table[offsets[i] : offsets[i + 1]] = chunk
+
+    if pool is not None:
+        pool.shutdown()
+
+    return pd.DataFrame(table, columns=header, copy=False)
 
-        with h5py.File(path, "r") as hdf:
-            data = np.array(hdf.get("labels"))
-            header = np.array(hdf.get("output_label_names"))
-            header = [str(i).replace("b", "").strip("'") for i in header]
 
-            df = pd.DataFrame(data, columns=header)
+def build_files(directory, header=None, data=None) -> pd.DataFrame:
 
-            hdf5_df = pd.concat([hdf5_df, df], ignore_index=True)
+    # Every file of `directory`, as before `load_labels`
+    return load_labels(directory, pattern="*")
 
-    return hdf5_df
 
+def _version(path) -> tuple:
 
-def get_db(path) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    # Indexing modifies the database, its fingerprint is taken afterwards
+    index_db(path)
 
-    connect = sqlite3.connect(path)
+    return fingerprint(path)
 
-    truth_cursor = connect.execute("SELECT * FROM truth")
-    truth_headers = [description[0] for description in truth_cursor.description]
 
-    pulse_cursor = connect.execute("SELECT * FROM SRTTWOfflinePulsesDC")
-    pulse_headers = [description[0] for description in pulse_cursor.description]
+def get_db(
+    path, selection: Optional[Selection] = None
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Loads the pulse and truth tables, use `iter_events` to stream large
+    databases in event aligned chunks instead.
 
-    pulse = pd.read_sql("SELECT * FROM SRTTWOfflinePulsesDC", connect)
-    truth = pd.read_sql("SELECT * FROM truth", connect)
+    Args:
+        path: Path to the SQLite database.
+        selection: Cuts on truth columns applied inside SQLite, for example
+            `CLEAN_SELECTION`. Loads every event when `None`.
 
-    pulse_df = pd.DataFrame(pulse, columns=pulse_headers)
-    truth_df = pd.DataFrame(truth, columns=truth_headers)
+    """
+
+    if selection is not None:
+        return read_selected(path, selection)
+
+    pulse_df = read_db(path, PULSE_TABLE)
+    truth_df = read_db(path, TRUTH_TABLE)
 
     return pulse_df, truth_df
 
 
+@cached_stage
+def _cached_events(path, selection, version) -> Tuple[dict, dict]:
+
+    pulse, truth = get_db(path, selection)
+
+    pulse = {column: pulse[column].to_numpy() for column in pulse.columns}
+    truth = {column: truth[column].to_numpy() for column in truth.columns}
+
+    return pulse, truth
+
+
+def load_events(
+    path, selection: Optional[Selection] = CLEAN_SELECTION
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Cached `get_db`, the selection replaces `PulseDataProcessing.clean`. The
+    cache key covers the database path, size and mtime and the cuts.
+
+    Args:
+        path: Path to the SQLite database.
+        selection: Cuts on truth columns, `None` keeps every event.
+
+    Returns:
+        Tuple of pulse then truth dataframes.
+    """
+
+    pulse, truth = _cached_events(path, selection, _version(path))
+
+    return pd.DataFrame(pulse), pd.DataFrame(truth)
+
+
+@cached_stage
+def _cached_padded(path, selection, max_len, version):
+
+    pulse, _ = load_events(path, selection)
+
+    return pad_events(pulse, max_len=max_len)
+
+
+def load_padded(
+    path,
+    selection: Optional[Selection] = CLEAN_SELECTION,
+    max_len: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Cached `pad_events` of the selected events, arrays are memory mapped.
+
+    Args:
+        path: Path to the SQLite database.
+        selection: Cuts on truth columns, `None` keeps every event.
+        max_len: Pulses kept per event, defaults to the longest event.
+
+    Returns:
+        Event numbers, padded pulses and the length of each event.
+    """
+
+    return _cached_padded(path, selection, max_len, _version(path))
+
+
+@cached_stage
+def _cached_grid(path, selection, version):
+
+    pulse, truth = load_events(path, selection)
+    events = np.sort(truth["event_no"].to_numpy())
+
+    return (events,) + pulses_to_grid(pulse, events)
+
+
+def load_grid(
+    path, selection: Optional[Selection] = CLEAN_SELECTION
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Cached `pulses_to_grid` of the selected events, arrays are memory mapped.
+
+    Args:
+        path: Path to the SQLite database.
+        selection: Cuts on truth columns, `None` keeps every event.
+
+    Returns:
+        Event numbers, `X_DC` and `X_IC` grids.
+    """
+
+    return _cached_grid(path, selection, _version(path))
+
+
+@cached_stage
+def _cached_normalizer(path, selection, method, version) -> Normalizer:
+
+    pulse, _ = load_events(path, selection)
+
+    return Normalizer(method).partial_fit(pulse[PULSE_FEATURES].to_numpy())
+
+
+def load_normalizer(
+    path,
+    selection: Optional[Selection] = CLEAN_SELECTION,
+    method: str = "standard_scaler",
+) -> Normalizer:
+    """
+    Cached normalization statistics of the `PULSE_FEATURES` of the selected
+    events, pass to `PulseDataProcessing.normalize`.
+
+    Args:
+        path: Path to the SQLite database.
+        selection: Cuts on truth columns, `None` keeps every event.
+        method: One of `NORM_METHODS`.
+
+    """
+
+    return _cached_normalizer(path, selection, method, _version(path))
+
+
 class PulseDataProcessing:
 
     def __init__(
@@ -130,13 +592,12 @@ class PulseDataProcessing:
         if normalize is None:
             normalize = True
 
-        self.normalize = normalize
+        self.normalize_state = normalize
         self.padded_state = False
 
-        norm_method_list = ["keras_layers", "standard_scaler", "min_max", "robust"]
-
-        assert norm_method in norm_method_list, "invalid normalization method"
-        self.nom_method = norm_method
+        assert norm_method in NORM_METHODS, "invalid normalization method"
+        self.norm_method = norm_method
+        self.normalizer = None
 
         self.dom_shape = self._dom_shape()
         self.pulse_shape = tuple(np.flip(np.shape(self.pulse)))
@@ -152,26 +613,74 @@ class PulseDataProcessing:
 
         return tuple(max(i) - min(i) for i in zip(mins, maxs))
 
-    def clean(self) -> None:
+    def clean(self, selection: Selection = CLEAN_SELECTION) -> None:
         """
         Cleans pulse and truth data by removing values with inelasticity equal to 1.0. These values
-        should not exist as they are not possible.
+        should not exist as they are not possible. Events without an
+        inelasticity are removed too. Loading with
+        `get_db(path, CLEAN_SELECTION)` applies the same cut inside SQLite instead.
+
+        Args:
+            selection: Cuts on truth columns to apply.
         """
 
-        mask = self.truth["inelasticity"] != 1.0
+        mask = selection.mask(self.truth)
         self.truth = self.truth[mask].reset_index(drop=True)
-        self.pulse = self.pulse[
-            self.pulse.event_no.isin(self.truth.event_no)
-        ].reset_index(drop=True)
 
-    def normalize(self) -> None:
+        # Sorted lookup instead of hashing every pulse
+        kept = np.sort(self.truth["event_no"].to_numpy())
+        event_no = self.pulse["event_no"].to_numpy()
+
+        pulse_mask = np.zeros(len(event_no), dtype=bool)
+
+        if len(kept) > 0:
+            position = np.searchsorted(kept, event_no).clip(max=len(kept) - 1)
+            pulse_mask = kept[position] == event_no
+
+        self.pulse = self.pulse[pulse_mask].reset_index(drop=True)
+
+    def normalize(self, normalizer: Optional[Normalizer] = None) -> None:
+        """
+        Normalizes the `PULSE_FEATURES` columns in place with `norm_method`.
+
+        Args:
+            normalizer: Statistics to apply, e.g. loaded from a training run.
+                Computed from these pulses when `None`.
+        """
+
         assert self.padded_state is False, "normalize before sublisting"
+        assert isinstance(self.pulse, pd.DataFrame), "normalize before sublisting"
+
+        values = self.pulse[PULSE_FEATURES].to_numpy()
 
-    def zero_pad(self) -> None:
+        if normalizer is None:
+            normalizer = Normalizer(self.norm_method).partial_fit(values)
+
+        self.pulse[PULSE_FEATURES] = normalizer.transform(values)
+        self.normalizer = normalizer
+
+    def zero_pad(self, mode: str = "frame", max_len: Optional[int] = None) -> None:
         """
         Zero pads events to make each event the same length.
+
+        Args:
+            mode: `frame` keeps a padded dataframe, `array` replaces the pulses
+                with a `(n_events, max_len, n_features)` array of `PULSE_FEATURES`
+                and stores the real length of each event in `self.lengths`.
+            max_len: Pulses kept per event in `array` mode, defaults to the
+                longest event.
         """
 
+        assert mode in ["frame", "array"], "mode must be `frame` or `array`"
+
+        if mode == "array":
+            self.event_no, self.pulse, self.lengths = pad_events(
+                self.pulse, max_len=max_len
+            )
+            self.pulse_shape = self.pulse.shape
+            self.padded_state = True
+            return
+
         max_len = self.pulse.groupby("event_no").size().max()
         padded = pd.concat(
             [zero_pad(group, max_len) for _, group in self.pulse.groupby("event_no")]
@@ -188,23 +697,26 @@ class PulseDataProcessing:
 
     def sublist(self) -> None:
         """
-        Creates a list of events with each event having a list of data.
+        Groups pulses by event into a `RaggedPulses` container of
+        `PULSE_FEATURES`, `self.pulse[i]` is the `(n_pulses, 5)` array of event `i`.
+        """
+
+        self.pulse = RaggedPulses.from_dataframe(self.pulse)
+        self.event_no = self.pulse.event_no
+
+    def to_grid(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Converts the pulses to the `X_DC` and `X_IC` string by DOM tensors used
+        for training. Row `i` is the event of row `i` of `self.truth`, in the
+        truth order and not sorted by `event_no`, events without pulses are
+        zero. Needs the `string` and `dom_number` pulse columns, call before
+        padding or sublisting.
         """
 
-        events = [
-            [
-                [
-                    row["dom_x"],
-                    row["dom_y"],
-                    row["dom_z"],
-                    row["dom_time"],
-                    row["charge"],
-                ]
-                for _, row in group.iterrows()
-            ]
-            for _, group in self.pulse.groupby("event_no")
-        ]
-        self.pulse = events
+        assert isinstance(self.pulse, pd.DataFrame), "convert before sublisting"
+        assert self.padded_state is False, "convert before padding"
+
+        return pulses_to_grid(self.pulse, self.truth["event_no"].to_numpy())
 
     def get_model(self):
 
@@ -243,83 +755,124 @@ class PulseDataProcessing:
         return model
 
 
-def build_contained_files(directory):
+# Datasets of every `*_contained.hdf5` training file
+CONTAINED_DATASETS = [
+    "X_test_DC",
+    "X_test_IC",
+    "X_train_DC",
+    "X_train_IC",
+    "X_validate_DC",
+    "X_validate_IC",
+    "Y_test",
+    "Y_train",
+    "Y_validate",
+]
+
+
+def merge_contained_files(
+    directory,
+    output: str = "data/archive/combined.hdf5",
+    pattern: str = "*.hdf5",
+    block_rows: int = 4096,
+    chunk_rows: Optional[int] = None,
+    compression: Optional[str] = None,
+    compression_opts=None,
+) -> str:
+    """
+    Merges the training datasets of every matching file in `directory` into one
+    file without holding them in memory. Output datasets are created at their
+    final size from the file metadata and each source is copied into its slice
+    `block_rows` rows at a time, so peak memory is a single block.
+
+    Args:
+        directory: Directory holding the contained HDF5 files.
+        output: Path of the merged file.
+        pattern: Glob pattern files must match.
+        block_rows: Rows copied per read.
+        chunk_rows: Rows per HDF5 chunk of the output, h5py picks when `None`.
+        compression: HDF5 compression filter of the output, e.g. `gzip` or `lzf`.
+        compression_opts: Options of the compression filter.
+
+    Returns:
+        Path of the merged file.
+    """
+
+    output_path = pathlib.Path(output).resolve()
+
+    paths = sorted(
+        path
+        for path in pathlib.Path(directory).glob(pattern)
+        if path.is_file() and path.resolve() != output_path
+    )
 
-    pathdir = pathlib.Path(directory)
+    assert len(paths) > 0, f"no files matching `{pattern}` in {directory}"
 
-    X_test_DC = None
-    X_test_IC = None
-    X_train_DC = None
-    X_train_IC = None
-    X_validate_DC = None
-    X_validate_IC = None
-    Y_test = None
-    Y_train = None
-    Y_validate = None
+    rows = {name: [] for name in CONTAINED_DATASETS}
+    layout = {}
 
-    count = 0
+    for path in paths:
+        with h5py.File(path, "r") as hdf:
+            for name in CONTAINED_DATASETS:
+                dataset = hdf[name]
+                rows[name].append(dataset.shape[0])
+
+                if name not in layout:
+                    layout[name] = (dataset.shape[1:], dataset.dtype)
+
+                assert (
+                    dataset.shape[1:] == layout[name][0]
+                ), f"{path} {name} has shape {dataset.shape}, expected (n, *{layout[name][0]})"
+
+    with h5py.File(output, "w") as out:
+
+        for name in CONTAINED_DATASETS:
+            shape, dtype = layout[name]
+            total = sum(rows[name])
+
+            chunks = True
+            if name.startswith("Y_"):
+                chunks = label_chunks(total)
+            elif chunk_rows is not None:
+                chunks = (max(min(chunk_rows, total), 1),) + shape
+
+            out.create_dataset(
+                name,
+                shape=(total,) + shape,
+                dtype=dtype,
+                chunks=chunks,
+                compression=compression,
+                compression_opts=compression_opts,
+            )
+
+        with h5py.File(paths[0], "r") as hdf:
+            if "output_label_names" in hdf:
+                out.create_dataset(
+                    "output_label_names", data=hdf["output_label_names"][:]
+                )
 
-    for path in pathdir.iterdir():
+        offsets = {name: 0 for name in CONTAINED_DATASETS}
 
-        with h5py.File(path, "r") as hdf:
+        for path in paths:
+            print(path)
 
-            if count >= 1:
-                X_test_DC = np.concatenate(
-                    (np.array(hdf["X_test_DC"]), X_test_DC), axis=0
-                )
-                X_test_IC = np.concatenate(
-                    (np.array(hdf["X_test_IC"]), X_test_IC), axis=0
-                )
-                X_train_DC = np.concatenate(
-                    (np.array(hdf["X_train_DC"]), X_train_DC), axis=0
-                )
-                X_train_IC = np.concatenate(
-                    (np.array(hdf["X_train_IC"]), X_train_IC), axis=0
-                )
-                X_validate_DC = np.concatenate(
-                    (np.array(hdf["X_validate_DC"]), X_validate_DC), axis=0
-                )
-                X_validate_IC = np.concatenate(
-                    (np.array(hdf["X_validate_IC"]), X_validate_IC), axis=0
-                )
-                Y_test = np.concatenate((np.array(hdf["Y_test"]), Y_test), axis=0)
-                Y_train = np.concatenate((np.array(hdf["Y_train"]), Y_train), axis=0)
-                Y_validate = np.concatenate(
-                    (np.array(hdf["Y_validate"]), Y_validate), axis=0
-                )
-            else:
-                X_test_DC = np.array(hdf["X_test_DC"])
-                X_test_IC = np.array(hdf["X_test_IC"])
-                X_train_DC = np.array(hdf["X_train_DC"])
-                X_train_IC = np.array(hdf["X_train_IC"])
-                X_validate_DC = np.array(hdf["X_validate_DC"])
-                X_validate_IC = np.array(hdf["X_validate_IC"])
-                Y_test = np.array(hdf["Y_test"])
-                Y_train = np.array(hdf["Y_train"])
-                Y_validate = np.array(hdf["Y_validate"])
-
-            print(len(X_test_DC))
-            print(len(X_test_IC))
-            print(len(X_train_DC))
-            print(len(X_train_IC))
-            print(len(Y_test))
-            print(len(Y_train))
-
-            count += 1
-
-    f = h5py.File("data/archive/combined.hdf5", "w")
-
-    f.create_dataset("X_test_DC", data=X_test_DC)
-    f.create_dataset("X_test_IC", data=X_test_IC)
-    f.create_dataset("X_train_DC", data=X_train_DC)
-
-    f.create_dataset("X_train_IC", data=X_train_IC)
-    f.create_dataset("X_validate_DC", data=X_validate_DC)
-    f.create_dataset("X_validate_IC", data=X_validate_IC)
-    f.create_dataset("Y_test", data=Y_test)
-    f.create_dataset("Y_train", data=Y_train)
-    f.create_dataset("Y_validate", data=Y_validate)
-    f.close()
+            with h5py.File(path, "r") as hdf:
+                for name in CONTAINED_DATASETS:
+                    source = hdf[name]
+                    target = out[name]
+                    offset = offsets[name]
+
+                    for start in range(0, source.shape[0], block_rows):
+                        stop = min(start + block_rows, source.shape[0])
+                        target[offset + start : offset + stop] = source[start:stop]
+
+                    offsets[name] += source.shape[0]
+
+    return output
+
+
+def build_contained_files(directory, output: str = "data/archive/combined.hdf5"):
+
+    return merge_contained_files(directory, output)
 
 
 if __name__ == "__main__":
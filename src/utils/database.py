@@ -0,0 +1,542 @@
+import os
+import sqlite3
+import hashlib
+import warnings
+import numpy as np
+import pandas as pd
+
+from typing import Iterator, Optional, Sequence, Tuple
+
+PULSE_TABLE = "SRTTWOfflinePulsesDC"
+TRUTH_TABLE = "truth"
+
+# Connection tuning for bulk reads
+MMAP_SIZE = 1 << 30  # bytes
+CACHE_SIZE = 1 << 18  # KiB
+
+# Event bitmaps of cached selections
+SELECTION_CACHE = "./cache/selections"
+
+
+def connect_db(
+    path: str,
+    read_only: bool = True,
+    mmap_size: int = MMAP_SIZE,
+    cache_size: int = CACHE_SIZE,
+) -> sqlite3.Connection:
+    """
+    Opens a SQLite database tuned for large sequential reads.
+
+    Args:
+        path: Path to the SQLite database.
+        read_only: Open through a read-only URI so this connection never
+            modifies the file, only `ensure_event_index` writes to it.
+        mmap_size: Bytes of the database file to memory map.
+        cache_size: Page cache size in KiB.
+
+    Returns:
+        Open connection.
+    """
+
+    if read_only:
+        connect = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    else:
+        connect = sqlite3.connect(path)
+
+    connect.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+    connect.execute(f"PRAGMA cache_size = {-int(cache_size)}")
+    connect.execute("PRAGMA temp_store = MEMORY")
+
+    return connect
+
+
+def table_columns(connect: sqlite3.Connection, table: str) -> list:
+    """
+    Column names of `table` read from the schema, no rows are scanned.
+    """
+
+    return [row[1] for row in connect.execute(f"PRAGMA table_info({table})")]
+
+
+def has_event_index(connect: sqlite3.Connection, table: str) -> bool:
+    """
+    Checks whether `table` has an index whose first column is `event_no`.
+    """
+
+    for index in connect.execute(f"PRAGMA index_list({table})").fetchall():
+        info = connect.execute(f"PRAGMA index_info({index[1]})").fetchall()
+        if len(info) > 0 and info[0][2] == "event_no":
+            return True
+
+    return False
+
+
+def ensure_event_index(path: str, table: str = PULSE_TABLE) -> bool:
+    """
+    Creates an index on `event_no` for `table` unless one already exists.
+
+    Args:
+        path: Path to the SQLite database.
+        table: Table to index.
+
+    Returns:
+        Whether `table` has an `event_no` index afterwards.
+    """
+
+    connect = connect_db(path)
+    indexed = has_event_index(connect, table)
+    connect.close()
+
+    if indexed:
+        return True
+
+    try:
+        connect = sqlite3.connect(path)
+        connect.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_event_no ON {table} (event_no)"
+        )
+        connect.commit()
+        connect.close()
+    except sqlite3.OperationalError as error:
+        warnings.warn(f"could not index {table}.event_no ({error}), reads will scan")
+        return False
+
+    return True
+
+
+def index_db(path: str, tables: Sequence[str] = (PULSE_TABLE, TRUTH_TABLE)) -> None:
+    """
+    Creates the `event_no` indexes of every table read by event. Adding an
+    index changes the size and mtime of the database, so it runs before any
+    cache key is taken from the file, else the first rerun misses the cache.
+    """
+
+    for table in tables:
+        ensure_event_index(path, table)
+
+
+def event_numbers(
+    connect: sqlite3.Connection,
+    table: str = TRUTH_TABLE,
+    event_range: Optional[Tuple[int, int]] = None,
+) -> np.ndarray:
+    """
+    Sorted unique event numbers in `table`.
+
+    Args:
+        connect: Open connection.
+        table: Table to read event numbers from.
+        event_range: Inclusive `(first, last)` event numbers to keep.
+
+    """
+
+    query = f"SELECT DISTINCT event_no FROM {table}"
+    params = ()
+
+    if event_range is not None:
+        query += " WHERE event_no BETWEEN ? AND ?"
+        params = tuple(int(i) for i in event_range)
+
+    query += " ORDER BY event_no"
+
+    rows = connect.execute(query, params).fetchall()
+
+    return np.array([row[0] for row in rows], dtype=np.int64)
+
+
+def iter_db(
+    path: str,
+    table: str = PULSE_TABLE,
+    columns: Optional[Sequence[str]] = None,
+    chunk_events: int = 10000,
+    event_range: Optional[Tuple[int, int]] = None,
+    events: Optional[Sequence[int]] = None,
+    index: bool = True,
+) -> Iterator[pd.DataFrame]:
+    """
+    Streams `table` in event aligned chunks, every chunk holds all rows of a
+    contiguous run of at most `chunk_events` event numbers, sorted by `event_no`.
+
+    Args:
+        path: Path to the SQLite database.
+        table: Table to read.
+        columns: Columns to read, defaults to every column. `event_no` is
+            always included.
+        chunk_events: Maximum number of events per chunk.
+        event_range: Inclusive `(first, last)` event numbers to read.
+        events: Explicit event numbers to read, combined with `event_range`.
+        index: Create the `event_no` index if it does not exist yet.
+
+    Yields:
+        One dataframe per chunk.
+    """
+
+    if index:
+        ensure_event_index(path, table)
+
+    connect = connect_db(path)
+
+    try:
+        if columns is None:
+            columns = table_columns(connect, table)
+        elif "event_no" not in columns:
+            columns = ["event_no"] + list(columns)
+
+        selected = ", ".join(columns)
+
+        if events is None:
+            chunk_query = (
+                f"SELECT {selected} FROM {table} "
+                "WHERE event_no BETWEEN ? AND ? ORDER BY event_no"
+            )
+            numbers = event_numbers(connect, table, event_range)
+        else:
+            numbers = np.unique(np.asarray(events, dtype=np.int64))
+
+            if event_range is not None:
+                first, last = event_range
+                numbers = numbers[(numbers >= first) & (numbers <= last)]
+
+            connect.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS selected_events "
+                "(event_no INTEGER PRIMARY KEY)"
+            )
+            columns_joined = ", ".join(f"{table}.{column}" for column in columns)
+            chunk_query = (
+                f"SELECT {columns_joined} FROM selected_events "
+                f"JOIN {table} ON {table}.event_no = selected_events.event_no "
+                f"WHERE selected_events.event_no BETWEEN ? AND ? "
+                f"ORDER BY {table}.event_no"
+            )
+
+        for start in range(0, len(numbers), chunk_events):
+            chunk = numbers[start : start + chunk_events]
+
+            if events is not None:
+                connect.execute("DELETE FROM selected_events")
+                connect.executemany(
+                    "INSERT INTO selected_events VALUES (?)",
+                    ((int(i),) for i in chunk),
+                )
+
+            yield pd.read_sql(
+                chunk_query, connect, params=(int(chunk[0]), int(chunk[-1]))
+            )
+
+    finally:
+        connect.close()
+
+
+def iter_events(
+    path: str,
+    chunk_events: int = 10000,
+    pulse_columns: Optional[Sequence[str]] = None,
+    truth_columns: Optional[Sequence[str]] = None,
+    event_range: Optional[Tuple[int, int]] = None,
+    events: Optional[Sequence[int]] = None,
+) -> Iterator[Tuple[pd.DataFrame, pd.DataFrame]]:
+    """
+    Streams matching pulse and truth chunks covering the same events, memory
+    use is bounded by `chunk_events` instead of the size of the database.
+
+    Args:
+        path: Path to the SQLite database.
+        chunk_events: Maximum number of events per chunk.
+        pulse_columns: Pulse columns to read, defaults to every column.
+        truth_columns: Truth columns to read, defaults to every column.
+        event_range: Inclusive `(first, last)` event numbers to read.
+        events: Explicit event numbers to read.
+
+    Yields:
+        Tuple of pulse then truth dataframes.
+    """
+
+    ensure_event_index(path, PULSE_TABLE)
+
+    truth_chunks = iter_db(
+        path, TRUTH_TABLE, truth_columns, chunk_events, event_range, events
+    )
+
+    for truth in truth_chunks:
+        if len(truth) == 0:
+            continue
+
+        chunk = truth["event_no"].to_numpy()
+        pulse = next(
+            iter_db(
+                path,
+                PULSE_TABLE,
+                pulse_columns,
+                len(chunk),
+                events=chunk,
+                index=False,
+            ),
+            None,
+        )
+
+        if pulse is None:
+            pulse = pd.DataFrame(columns=pulse_columns or [])
+
+        yield pulse, truth
+
+
+def read_db(
+    path: str,
+    table: str,
+    columns: Optional[Sequence[str]] = None,
+) -> pd.DataFrame:
+    """
+    Reads `table` with a single query over a tuned read-only connection.
+
+    Args:
+        path: Path to the SQLite database.
+        table: Table to read.
+        columns: Columns to read, defaults to every column.
+
+    """
+
+    connect = connect_db(path)
+    selected = "*" if columns is None else ", ".join(columns)
+    df = pd.read_sql(f"SELECT {selected} FROM {table}", connect)
+    connect.close()
+
+    return df
+
+
+class Selection:
+    """
+    Cuts on truth columns compiled into SQL so only pulses of surviving
+    events are read from SQLite. Each cut is a `(column, operator, value)`
+    tuple, cuts are combined with `AND`. As in SQL, a NULL value fails every
+    cut, `!=` and `not in` included, and `mask` follows the same rule.
+
+    The surviving event numbers are cached as a bitmap keyed by the database
+    file and the cuts, so repeated runs with the same cuts skip the query.
+    """
+
+    operators = ["==", "!=", "<", "<=", ">", ">=", "in", "not in", "between"]
+
+    def __init__(
+        self,
+        cuts: Sequence[Tuple[str, str, object]],
+        cache_dir: Optional[str] = SELECTION_CACHE,
+    ) -> None:
+        """Construct `Selection`
+
+        Args:
+            cuts: Cuts on truth columns, for example `("inelasticity", "!=", 1.0)`.
+            cache_dir: Directory for event bitmaps, `None` disables caching.
+
+        """
+
+        for column, operator, _ in cuts:
+            assert column.isidentifier(), f"invalid column name `{column}`"
+            assert operator in self.operators, f"invalid operator `{operator}`"
+
+        self.cuts = [tuple(cut) for cut in cuts]
+        self.cache_dir = cache_dir
+
+    def __repr__(self) -> str:
+        return f"Selection({self.cuts})"
+
+    def where(self, alias: str = TRUTH_TABLE) -> Tuple[str, tuple]:
+        """
+        Compiles the cuts into a SQL `WHERE` clause.
+
+        Args:
+            alias: Name the truth table is referred to by in the query.
+
+        Returns:
+            Clause and its parameters.
+        """
+
+        clauses = []
+        params = []
+
+        for column, operator, value in self.cuts:
+            column = f"{alias}.{column}"
+
+            if operator == "between":
+                clauses.append(f"{column} BETWEEN ? AND ?")
+                params.extend(value)
+            elif operator in ["in", "not in"]:
+                marks = ", ".join("?" for _ in value)
+                clauses.append(f"{column} {operator.upper()} ({marks})")
+                params.extend(value)
+            else:
+                operator = "=" if operator == "==" else operator
+                clauses.append(f"{column} {operator} ?")
+                params.append(value)
+
+        if len(clauses) == 0:
+            return "", ()
+
+        return "WHERE " + " AND ".join(clauses), tuple(params)
+
+    def mask(self, truth: pd.DataFrame) -> np.ndarray:
+        """
+        Evaluates the cuts on a truth dataframe already in memory, with the
+        result of `where` in SQLite.
+        """
+
+        mask = np.ones(len(truth), dtype=bool)
+
+        for column, operator, value in self.cuts:
+            values = truth[column]
+
+            # Pandas comparisons of NaN with `!=` and `not in` are true
+            mask &= values.notna().to_numpy()
+
+            if operator == "between":
+                mask &= values.between(*value).to_numpy()
+            elif operator == "in":
+                mask &= values.isin(value).to_numpy()
+            elif operator == "not in":
+                mask &= ~values.isin(value).to_numpy()
+            else:
+                mask &= {
+                    "==": values.eq,
+                    "!=": values.ne,
+                    "<": values.lt,
+                    "<=": values.le,
+                    ">": values.gt,
+                    ">=": values.ge,
+                }[operator](value).to_numpy()
+
+        return mask
+
+    def query(
+        self, table: str = PULSE_TABLE, columns: Optional[Sequence[str]] = None
+    ) -> Tuple[str, tuple]:
+        """
+        Query reading `table` with the cuts applied, tables other than truth
+        are joined against truth on `event_no`.
+        """
+
+        if columns is None:
+            selected = f"{table}.*"
+        else:
+            selected = ", ".join(f"{table}.{column}" for column in columns)
+
+        join = ""
+
+        if table != TRUTH_TABLE:
+            join = f"JOIN {TRUTH_TABLE} ON {TRUTH_TABLE}.event_no = {table}.event_no"
+
+        where, params = self.where()
+
+        query = (
+            f"SELECT {selected} FROM {table} {join} {where} ORDER BY {table}.event_no"
+        )
+
+        return query, params
+
+    def key(self, path: str) -> str:
+        """
+        Cache key of this selection on the database at `path`.
+        """
+
+        stat = os.stat(path)
+        content = repr((os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+        content += repr(self.cuts)
+
+        return hashlib.sha1(content.encode()).hexdigest()
+
+    def event_ids(self, path: str) -> np.ndarray:
+        """
+        Sorted event numbers passing the cuts, read from the bitmap cache when
+        the same cuts were already applied to the same database file.
+
+        Args:
+            path: Path to the SQLite database.
+
+        """
+
+        cache = None
+
+        if self.cache_dir is not None:
+            # `read_selected` would index after the key is taken
+            index_db(path)
+
+            cache = os.path.join(self.cache_dir, f"{self.key(path)}.npz")
+
+            if os.path.isfile(cache):
+                with np.load(cache) as bitmap:
+                    bits = np.unpackbits(bitmap["bits"], count=int(bitmap["size"]))
+                    return np.flatnonzero(bits).astype(np.int64) + bitmap["first"]
+
+        where, params = self.where()
+
+        connect = connect_db(path)
+        rows = connect.execute(
+            f"SELECT DISTINCT event_no FROM {TRUTH_TABLE} {where} ORDER BY event_no",
+            params,
+        ).fetchall()
+        connect.close()
+
+        events = np.array([row[0] for row in rows], dtype=np.int64)
+
+        if cache is not None:
+            first = events[0] if len(events) > 0 else 0
+            size = events[-1] - first + 1 if len(events) > 0 else 0
+
+            bits = np.zeros(size, dtype=bool)
+            bits[events - first] = True
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.savez(cache, first=first, size=size, bits=np.packbits(bits))
+
+        return events
+
+
+# Events with inelasticity equal to 1.0 are not physical
+CLEAN_SELECTION = Selection([("inelasticity", "!=", 1.0)])
+
+
+def read_selected(
+    path: str,
+    selection: Selection = CLEAN_SELECTION,
+    pulse_columns: Optional[Sequence[str]] = None,
+    truth_columns: Optional[Sequence[str]] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Reads pulse and truth rows of the events passing `selection`, the cuts
+    run inside SQLite so rejected pulses are never loaded.
+
+    Args:
+        path: Path to the SQLite database.
+        selection: Cuts on truth columns.
+        pulse_columns: Pulse columns to read, defaults to every column.
+        truth_columns: Truth columns to read, defaults to every column.
+
+    Returns:
+        Tuple of pulse then truth dataframes.
+    """
+
+    if selection.cache_dir is None:
+        connect = connect_db(path)
+
+        query, params = selection.query(PULSE_TABLE, pulse_columns)
+        pulse = pd.read_sql(query, connect, params=params)
+
+        query, params = selection.query(TRUTH_TABLE, truth_columns)
+        truth = pd.read_sql(query, connect, params=params)
+
+        connect.close()
+
+        return pulse, truth
+
+    events = selection.event_ids(path)
+    chunk_events = max(len(events), 1)
+
+    chunks = []
+
+    for table, columns in [(PULSE_TABLE, pulse_columns), (TRUTH_TABLE, truth_columns)]:
+        chunk = next(iter_db(path, table, columns, chunk_events, events=events), None)
+
+        if chunk is None:
+            chunk = pd.DataFrame(columns=columns or [])
+
+        chunks.append(chunk)
+
+    return tuple(chunks)
@@ -0,0 +1,224 @@
+import os
+import hashlib
+import numpy as np
+
+from typing import Optional, Tuple
+
+# Strings in each detector grid, row order of X_DC and X_IC
+DC_STRINGS = [79, 80, 81, 82, 83, 84, 85, 86]
+IC_STRINGS = [
+    17, 18, 19, 25, 26, 27, 28, 34, 35, 36, 37, 38, 44, 45, 46, 47, 54, 55, 56
+]
+
+N_STRINGS = 86
+DOMS_PER_STRING = 60
+
+
+def string_rows(strings: list) -> np.ndarray:
+    """
+    Lookup table from string number to its row in a detector grid, strings
+    outside the grid map to -1.
+    """
+
+    rows = np.full(N_STRINGS + 1, -1, dtype=np.int64)
+    rows[strings] = np.arange(len(strings))
+
+    return rows
+
+
+DC_ROWS = string_rows(DC_STRINGS)
+IC_ROWS = string_rows(IC_STRINGS)
+
+
+def grid_slots(
+    string: np.ndarray, dom: np.ndarray, rows: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Maps (string, DOM) pairs to flat slots `row * DOMS_PER_STRING + dom - 1`
+    of a detector grid.
+
+    Args:
+        string: String number of each pulse.
+        dom: DOM number of each pulse, counting from 1.
+        rows: Lookup table from `string_rows`.
+
+    Returns:
+        Flat slot of each pulse and a mask of pulses inside the grid.
+    """
+
+    string = np.asarray(string, dtype=np.int64)
+    dom = np.asarray(dom, dtype=np.int64)
+
+    inside = (string >= 0) & (string <= N_STRINGS)
+    inside &= (dom >= 1) & (dom <= DOMS_PER_STRING)
+
+    row = np.where(inside, rows[np.where(inside, string, 0)], -1)
+    inside &= row >= 0
+
+    return row * DOMS_PER_STRING + dom - 1, inside
+
+
+# Binary copies of parsed geometry files
+GEOMETRY_CACHE = "./cache/geometry"
+
+GEOMETRY_DTYPE = np.dtype(
+    [
+        ("string", np.int16),
+        ("dom", np.int16),
+        ("x", np.float32),
+        ("y", np.float32),
+        ("z", np.float32),
+    ]
+)
+
+_geometries = {}
+
+
+class DOMGeometry:
+    """
+    DOM positions as a structured array sorted by (string, DOM), with a dense
+    index for O(1) vectorized (string, DOM) lookups.
+    """
+
+    def __init__(self, table: np.ndarray) -> None:
+        """Construct `DOMGeometry`
+
+        Args:
+            table: Structured array of `GEOMETRY_DTYPE`.
+
+        """
+
+        table = np.sort(table.astype(GEOMETRY_DTYPE), order=["string", "dom"])
+
+        self.table = table
+        self.xyz = np.stack([table["x"], table["y"], table["z"]], axis=1)
+
+        self.index = np.full(
+            (table["string"].max() + 1, table["dom"].max() + 1), -1, dtype=np.int64
+        )
+        self.index[table["string"], table["dom"]] = np.arange(len(table))
+
+        strings, starts, counts = np.unique(
+            table["string"], return_index=True, return_counts=True
+        )
+        self.strings = {
+            int(string): slice(start, start + count)
+            for string, start, count in zip(strings, starts, counts)
+        }
+
+        self.dc = table[table["string"] > 78]
+        self.ic = table[table["string"] <= 78]
+
+        self.grids = {
+            "DC": self.grid_positions(DC_STRINGS),
+            "IC": self.grid_positions(IC_STRINGS),
+        }
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    @classmethod
+    def from_file(cls, path: str) -> "DOMGeometry":
+        """
+        Parses a `DOM_Position_GeoCalibDetectorStatus` file with columns
+        string, DOM, x, y and z after one header line.
+        """
+
+        data = np.loadtxt(path, skiprows=1, ndmin=2)
+
+        table = np.empty(len(data), dtype=GEOMETRY_DTYPE)
+        for i, name in enumerate(GEOMETRY_DTYPE.names):
+            table[name] = data[:, i]
+
+        return cls(table)
+
+    def lookup(self, string, dom) -> np.ndarray:
+        """
+        Rows of `self.table` of each (string, DOM) pair, -1 where unknown.
+        """
+
+        string = np.asarray(string, dtype=np.int64)
+        dom = np.asarray(dom, dtype=np.int64)
+
+        inside = (string >= 0) & (string < self.index.shape[0])
+        inside &= (dom >= 0) & (dom < self.index.shape[1])
+
+        rows = np.full(np.shape(string), -1, dtype=np.int64)
+        rows[inside] = self.index[string[inside], dom[inside]]
+
+        return rows
+
+    def positions(self, string, dom) -> np.ndarray:
+        """
+        `(..., 3)` positions of each (string, DOM) pair.
+
+        Raises:
+            KeyError: If any pair is not in the geometry.
+        """
+
+        rows = self.lookup(string, dom)
+
+        if np.any(rows < 0):
+            raise KeyError("unknown (string, DOM) pairs in lookup")
+
+        return self.xyz[rows]
+
+    def string(self, string: int) -> np.ndarray:
+        """
+        DOMs of one string, a view of `self.table`.
+        """
+
+        return self.table[self.strings[string]]
+
+    def grid_positions(self, strings: list) -> np.ndarray:
+        """
+        `(len(strings), DOMS_PER_STRING, 3)` positions of a detector grid, grid
+        slot `dom - 1` holds DOM `dom`. Missing DOMs are NaN.
+        """
+
+        string = np.repeat(strings, DOMS_PER_STRING)
+        dom = np.tile(np.arange(1, DOMS_PER_STRING + 1), len(strings))
+
+        rows = self.lookup(string, dom)
+
+        positions = np.full((len(rows), 3), np.nan, dtype=np.float32)
+        positions[rows >= 0] = self.xyz[rows[rows >= 0]]
+
+        return positions.reshape(len(strings), DOMS_PER_STRING, 3)
+
+
+def load_geometry(path: str, cache_dir: Optional[str] = GEOMETRY_CACHE) -> DOMGeometry:
+    """
+    Loads a geometry file, parsing it only once. The parsed table is kept in
+    memory for the process and as a binary copy in `cache_dir`, keyed by the
+    file path, size and modification time.
+
+    Args:
+        path: Path to the geometry `.dat` file.
+        cache_dir: Directory for the binary copy, `None` disables it.
+
+    """
+
+    stat = os.stat(path)
+    content = repr((os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+    key = hashlib.sha1(content.encode()).hexdigest()
+
+    if key in _geometries:
+        return _geometries[key]
+
+    cache = None
+    if cache_dir is not None:
+        cache = os.path.join(cache_dir, f"{key}.npy")
+
+    if cache is not None and os.path.isfile(cache):
+        geometry = DOMGeometry(np.load(cache))
+    else:
+        geometry = DOMGeometry.from_file(path)
+
+        if cache is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            np.save(cache, geometry.table)
+
+    _geometries[key] = geometry
+
+    return geometry
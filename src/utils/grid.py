@@ -0,0 +1,282 @@
+import os
+import h5py
+import numpy as np
+import pandas as pd
+
+from typing import Optional, Sequence, Tuple
+
+from utils.database import CLEAN_SELECTION, Selection, iter_events
+from utils.geometry import (
+    DC_ROWS,
+    DC_STRINGS,
+    DOMS_PER_STRING,
+    IC_ROWS,
+    IC_STRINGS,
+    grid_slots,
+)
+from utils.labels import label_chunks
+from utils.sparse_grid import SparseGrid
+
+# Per DOM features of X_DC and X_IC, in order
+GRID_FEATURES = [
+    "charge_sum",
+    "first_time",
+    "last_time",
+    "charge_weighted_time",
+    "charge_weighted_time_std",
+]
+
+SPLITS = ["train", "validate", "test"]
+
+
+def dom_features(
+    slot: np.ndarray, time: np.ndarray, charge: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reduces pulses to `GRID_FEATURES` per hit slot with segmented reductions.
+
+    Args:
+        slot: Flat slot of each pulse.
+        time: Pulse time.
+        charge: Pulse charge.
+
+    Returns:
+        Sorted unique hit slots and their `(n_slots, 5)` features.
+    """
+
+    order = np.lexsort((time, slot))
+    slot = slot[order]
+    time = time[order].astype(np.float64)
+    charge = charge[order].astype(np.float64)
+
+    if len(slot) == 0:
+        return slot, np.zeros((0, len(GRID_FEATURES)), dtype=np.float32)
+
+    starts = np.flatnonzero(np.diff(slot, prepend=slot[0] - 1))
+
+    charge_sum = np.add.reduceat(charge, starts)
+    first_time = np.minimum.reduceat(time, starts)
+    last_time = np.maximum.reduceat(time, starts)
+
+    weight = np.where(charge_sum > 0, charge_sum, 1.0)
+    mean_time = np.add.reduceat(charge * time, starts) / weight
+
+    # Centered second moment, avoids cancellation at large absolute times
+    lengths = np.diff(np.append(starts, len(slot)))
+    residual = time - np.repeat(mean_time, lengths)
+    std_time = np.sqrt(np.add.reduceat(charge * residual * residual, starts) / weight)
+
+    features = np.stack(
+        [charge_sum, first_time, last_time, mean_time, std_time], axis=1
+    )
+
+    return slot[starts], features.astype(np.float32)
+
+
+def pulses_to_grid(
+    pulse: pd.DataFrame,
+    events: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Converts a pulse table to the `X_DC` and `X_IC` string by DOM tensors read
+    by `Convolution`, whole batches of events at once.
+
+    Args:
+        pulse: Pulses with `event_no`, `string`, `dom_number`, `dom_time` and
+            `charge` columns.
+        events: Unique event numbers in output order, any order, defaults to
+            the sorted events of `pulse`. Events without pulses stay empty.
+
+    Returns:
+        Arrays of shape `(n_events, 8, 60, 5)` and `(n_events, 19, 60, 5)`.
+    """
+
+    event_no = pulse["event_no"].to_numpy()
+
+    if events is None:
+        events = np.unique(event_no)
+
+    events = np.asarray(events)
+
+    # Sorted lookup, mapped back to the row of each event in `events`
+    order = np.argsort(events, kind="stable")
+
+    assert np.all(
+        np.diff(events[order]) != 0
+    ), "events must be unique, a repeated event gets no pulses"
+
+    position = np.searchsorted(events[order], event_no)
+
+    found = position < len(events)
+    found[found] = events[order[position[found]]] == event_no[found]
+
+    event_index = np.zeros(len(event_no), dtype=np.intp)
+    event_index[found] = order[position[found]]
+
+    string = pulse["string"].to_numpy()
+    dom = pulse["dom_number"].to_numpy()
+    time = pulse["dom_time"].to_numpy()
+    charge = pulse["charge"].to_numpy()
+
+    grids = []
+
+    for strings, rows in [(DC_STRINGS, DC_ROWS), (IC_STRINGS, IC_ROWS)]:
+        n_slots = len(strings) * DOMS_PER_STRING
+
+        slot, inside = grid_slots(string, dom, rows)
+        inside &= found
+
+        slot = event_index[inside] * n_slots + slot[inside]
+        slot, features = dom_features(slot, time[inside], charge[inside])
+
+        grid = np.zeros((len(events) * n_slots, len(GRID_FEATURES)), np.float32)
+        grid[slot] = features
+
+        grids.append(
+            grid.reshape(len(events), len(strings), DOMS_PER_STRING, len(GRID_FEATURES))
+        )
+
+    return tuple(grids)
+
+
+def write_shard(
+    path: str,
+    X_DC: np.ndarray,
+    X_IC: np.ndarray,
+    Y: np.ndarray,
+    label_names: Sequence[str],
+    split: np.ndarray,
+    event_no: Optional[np.ndarray] = None,
+    compression: Optional[str] = "gzip",
+    sparse: bool = False,
+) -> str:
+    """
+    Writes one shard with the `X_{split}_DC`, `X_{split}_IC` and `Y_{split}`
+    datasets read by `Convolution._get_training_data`, or with the grids as
+    `utils.sparse_grid.SparseGrid` groups.
+
+    Args:
+        path: Output file.
+        X_DC: DeepCore grid of every event.
+        X_IC: IceCube grid of every event.
+        Y: Labels of every event.
+        label_names: Name of each label column.
+        split: Index into `SPLITS` of every event.
+        event_no: Event number of every event.
+        compression: HDF5 compression filter.
+        sparse: Store only the DOMs with any nonzero feature.
+
+    """
+
+    with h5py.File(path, "w") as hdf:
+
+        for i, name in enumerate(SPLITS):
+            rows = np.flatnonzero(split == i)
+
+            for detector, X in [("DC", X_DC), ("IC", X_IC)]:
+                if sparse:
+                    SparseGrid.from_dense(X[rows]).write(
+                        hdf, f"X_{name}_{detector}", compression
+                    )
+                else:
+                    hdf.create_dataset(
+                        f"X_{name}_{detector}", data=X[rows], compression=compression
+                    )
+            hdf.create_dataset(
+                f"Y_{name}",
+                data=Y[rows],
+                chunks=label_chunks(len(rows)),
+                compression=compression,
+            )
+
+            if event_no is not None:
+                hdf.create_dataset(f"event_no_{name}", data=event_no[rows])
+
+        hdf.create_dataset("output_label_names", data=np.array(label_names, dtype="S"))
+        hdf.create_dataset("grid_features", data=np.array(GRID_FEATURES, dtype="S"))
+
+    return path
+
+
+def convert_db(
+    path: str,
+    output_dir: str,
+    selection: Optional[Selection] = CLEAN_SELECTION,
+    label_columns: Optional[Sequence[str]] = None,
+    events_per_shard: int = 50000,
+    fractions: Tuple[float, float, float] = (0.8, 0.1, 0.1),
+    seed: int = 0,
+    compression: Optional[str] = "gzip",
+    sparse: bool = False,
+) -> list:
+    """
+    Converts a SQLite pulse database to `*_contained.hdf5` training shards,
+    streaming `events_per_shard` events at a time.
+
+    Args:
+        path: Path to the SQLite database.
+        output_dir: Directory the shards are written to.
+        selection: Cuts on truth columns, `None` keeps every event.
+        label_columns: Truth columns stored as labels, defaults to every
+            numeric truth column.
+        events_per_shard: Events read and written per shard.
+        fractions: Train, validate and test fractions.
+        seed: Seed of the split assignment.
+        compression: HDF5 compression filter.
+        sparse: Write `*_sparse.hdf5` shards holding only the nonzero DOMs.
+
+    Returns:
+        Paths of the written shards.
+    """
+
+    assert np.isclose(sum(fractions), 1.0), "split fractions must sum to 1"
+
+    events = None
+    if selection is not None:
+        events = selection.event_ids(path)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    rng = np.random.default_rng(seed)
+    shards = []
+
+    chunks = iter_events(
+        path,
+        events_per_shard,
+        ["event_no", "string", "dom_number", "dom_time", "charge"],
+        label_columns,
+        events=events,
+    )
+
+    for i, (pulse, truth) in enumerate(chunks):
+
+        truth = truth.sort_values("event_no")
+        event_no = truth["event_no"].to_numpy()
+
+        labels = truth.drop(columns="event_no").select_dtypes("number")
+        if label_columns is not None:
+            labels = truth[[column for column in label_columns if column != "event_no"]]
+
+        X_DC, X_IC = pulses_to_grid(pulse, event_no)
+        split = rng.choice(len(SPLITS), size=len(event_no), p=fractions)
+
+        suffix = "contained_sparse" if sparse else "contained"
+        shard = os.path.join(output_dir, f"{stem}_{i:04d}_{suffix}.hdf5")
+        shards.append(
+            write_shard(
+                shard,
+                X_DC,
+                X_IC,
+                labels.to_numpy(dtype=np.float64),
+                list(labels.columns),
+                split,
+                event_no,
+                compression,
+                sparse,
+            )
+        )
+
+        print(shard)
+
+    return shards
@@ -0,0 +1,183 @@
+import re
+import h5py
+import numpy as np
+
+from typing import Optional, Sequence, Union
+
+from utils.cache import cached_stage, fingerprint
+
+# Target of TrainingArgs data class argument `train_variable`
+DEFAULT_LABEL = "inelasticity"
+
+# Columns of `Y_*` by the indices used before labels were resolved by name,
+# for files written without `output_label_names`
+FALLBACK_COLUMNS = {
+    "zenith": 1,
+    "time": 3,
+    "azimuth": 7,
+    "is_antineutrino": 11,
+    "charge": 12,
+    "inelasticity": 14,
+}
+
+# Rows per HDF5 chunk of label datasets written one column per chunk
+LABEL_CHUNK_ROWS = 1 << 16
+
+
+def decode_label_names(names) -> list:
+    """
+    Decodes the byte strings stored in `output_label_names`.
+    """
+
+    return [
+        name.decode() if isinstance(name, bytes) else str(name)
+        for name in np.asarray(names).tolist()
+    ]
+
+
+def label_chunks(rows: int, chunk_rows: int = LABEL_CHUNK_ROWS):
+    """
+    HDF5 chunk shape storing a `(rows, n_labels)` label dataset column-major,
+    reading one label decompresses only the chunks of its column.
+    """
+
+    if rows == 0:
+        return None
+
+    return (min(rows, chunk_rows), 1)
+
+
+def is_column_major(dataset: h5py.Dataset) -> bool:
+    """
+    Whether each HDF5 chunk of a 2D label dataset holds a single column.
+    """
+
+    if dataset.shape[1] == 1:
+        return True
+
+    return dataset.chunks is not None and dataset.chunks[1] == 1
+
+
+@cached_stage
+def label_table(source: tuple, split: str, block_rows: int = LABEL_CHUNK_ROWS):
+    """
+    Column-major copy of `Y_{split}` of the file identified by `source`, a
+    `fingerprint`. The file is read once, afterwards the memory mapped copy
+    serves one label at the cost of 1/N of the labels.
+
+    Args:
+        source: Fingerprint of the HDF5 file.
+        split: `train`, `validate` or `test`.
+        block_rows: Rows read at a time.
+
+    Returns:
+        Fortran ordered array of every label.
+    """
+
+    with h5py.File(source[0], "r") as hdf:
+        Y = hdf[f"Y_{split}"]
+        table = np.empty(Y.shape, dtype=Y.dtype, order="F")
+
+        for start in range(0, Y.shape[0], block_rows):
+            table[start : start + block_rows] = Y[start : start + block_rows]
+
+    return table
+
+
+class LabelSchema:
+    """
+    Resolves the columns of the `Y_*` label datasets by name. Names are taken
+    from `output_label_names`, files without it fall back to `FALLBACK_COLUMNS`.
+    Matching ignores case and punctuation, so `IsAntineutrino` and
+    `is_antineutrino` are the same label.
+    """
+
+    def __init__(self, names: Optional[Sequence[str]] = None) -> None:
+        """Construct `LabelSchema`
+
+        Args:
+            names: Name of each label column, `None` for the fallback layout.
+
+        """
+
+        self.names = None if names is None else list(names)
+
+        if self.names is None:
+            columns = FALLBACK_COLUMNS.items()
+        else:
+            columns = ((name, column) for column, name in enumerate(self.names))
+
+        self.index = {}
+        for name, column in columns:
+            self.index.setdefault(self._key(name), column)
+
+    @staticmethod
+    def _key(name: str) -> str:
+        return re.sub(r"[^a-z0-9]", "", str(name).lower())
+
+    @classmethod
+    def from_hdf(cls, hdf: h5py.File) -> "LabelSchema":
+
+        if "output_label_names" in hdf:
+            return cls(decode_label_names(hdf["output_label_names"][:]))
+
+        return cls()
+
+    @classmethod
+    def from_file(cls, path: str) -> "LabelSchema":
+
+        with h5py.File(path, "r") as hdf:
+            return cls.from_hdf(hdf)
+
+    def __contains__(self, name: str) -> bool:
+        return self._key(name) in self.index
+
+    def column(self, name: str) -> int:
+        """
+        Column of label `name`.
+        """
+
+        known = self.names if self.names is not None else list(FALLBACK_COLUMNS)
+
+        assert name in self, f"label `{name}` not in {known}"
+
+        return self.index[self._key(name)]
+
+    def columns(self, names: Sequence[str]) -> list:
+        return [self.column(name) for name in names]
+
+    def read(
+        self,
+        hdf: h5py.File,
+        split: str,
+        names: Union[str, Sequence[str]] = DEFAULT_LABEL,
+        rows=slice(None),
+    ) -> np.ndarray:
+        """
+        Reads labels of `split` by name. Column-major files are read directly,
+        other files through their cached `label_table`.
+
+        Args:
+            hdf: Open HDF5 file.
+            split: `train`, `validate` or `test`.
+            names: One label name, or a list of names.
+            rows: Slice or increasing indices of the rows to read.
+
+        Returns:
+            Array of shape `(n,)` for one name, `(n, len(names))` for a list.
+        """
+
+        Y = hdf[f"Y_{split}"]
+
+        if is_column_major(Y):
+            table = Y
+        else:
+            table = label_table(fingerprint(hdf.filename), split)
+
+        if isinstance(names, str):
+            return np.asarray(table[rows, self.column(names)])
+
+        return np.stack(
+            [np.asarray(table[rows, column]) for column in self.columns(names)],
+            axis=-1,
+        )
@@ -0,0 +1,431 @@
+import os
+import h5py
+import numpy as np
+
+from typing import Iterable, Optional, Sequence
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.precision import decode, storage_of
+
+NORM_METHODS = ["keras_layers", "standard_scaler", "min_max", "robust"]
+
+
+class RunningStats:
+    """
+    Per feature count, mean, variance, minimum and maximum updated one batch
+    at a time with Welford's algorithm, partial statistics of different
+    workers combine exactly with `merge`.
+    """
+
+    def __init__(self, n_features: int) -> None:
+
+        self.count = 0
+        self.mean = np.zeros(n_features)
+        self.m2 = np.zeros(n_features)
+        self.min = np.full(n_features, np.inf)
+        self.max = np.full(n_features, -np.inf)
+
+    @property
+    def variance(self) -> np.ndarray:
+        return self.m2 / max(self.count, 1)
+
+    def update(self, values: np.ndarray) -> None:
+        """
+        Adds a `(n, n_features)` batch.
+        """
+
+        if len(values) == 0:
+            return
+
+        values = np.asarray(values, dtype=np.float64)
+
+        batch = RunningStats(values.shape[1])
+        batch.count = len(values)
+        batch.mean = values.mean(axis=0)
+        batch.m2 = ((values - batch.mean) ** 2).sum(axis=0)
+        batch.min = values.min(axis=0)
+        batch.max = values.max(axis=0)
+
+        self.merge(batch)
+
+    def merge(self, other: "RunningStats") -> None:
+        """
+        Combines the statistics of `other` into this one (Chan et al.).
+        """
+
+        if other.count == 0:
+            return
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch of one feature, values are summarised by at
+    most `capacity` weighted centroids of roughly equal weight. The rank
+    error is about `1 / capacity`.
+    """
+
+    def __init__(self, capacity: int = 2048) -> None:
+
+        self.capacity = capacity
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+
+    def update(self, values: np.ndarray) -> None:
+
+        values = np.asarray(values, dtype=np.float64).ravel()
+
+        self._compress(
+            np.concatenate((self.means, values)),
+            np.concatenate((self.weights, np.ones(len(values)))),
+        )
+
+    def merge(self, other: "QuantileSketch") -> None:
+
+        self._compress(
+            np.concatenate((self.means, other.means)),
+            np.concatenate((self.weights, other.weights)),
+        )
+
+    def _compress(self, means: np.ndarray, weights: np.ndarray) -> None:
+
+        order = np.argsort(means, kind="stable")
+        means = means[order]
+        weights = weights[order]
+
+        if len(means) <= self.capacity:
+            self.means, self.weights = means, weights
+            return
+
+        # Equal weight bins over the cumulative weight
+        before = np.cumsum(weights) - weights
+        bins = np.floor(before / weights.sum() * self.capacity).astype(np.int64)
+        starts = np.flatnonzero(np.diff(bins, prepend=-1))
+
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def quantile(self, q) -> np.ndarray:
+        """
+        Approximate quantiles `q` in [0, 1].
+        """
+
+        assert len(self.means) > 0, "sketch is empty"
+
+        centers = np.cumsum(self.weights) - self.weights / 2
+
+        return np.interp(np.asarray(q) * self.weights.sum(), centers, self.means)
+
+
+class Normalizer:
+    """
+    Streaming statistics for the `norm_method` options. Every method reduces
+    to `(x - shift) / scale` per feature, applied batch by batch with
+    `transform` or in graph with `keras_layer`, so no normalized copy of the
+    data is ever held.
+
+    - `standard_scaler` and `keras_layers`: mean and standard deviation.
+    - `min_max`: minimum and range.
+    - `robust`: median and interquartile range from `QuantileSketch`.
+    """
+
+    def __init__(
+        self,
+        method: str = "standard_scaler",
+        n_features: Optional[int] = None,
+        capacity: int = 2048,
+    ) -> None:
+        """Construct `Normalizer`
+
+        Args:
+            method: One of `NORM_METHODS`.
+            n_features: Number of features, the size of the last axis. Taken
+                from the first batch when `None`.
+            capacity: Centroids per feature of the robust quantile sketches.
+
+        """
+
+        assert method in NORM_METHODS, "invalid normalization method"
+
+        self.method = method
+        self.capacity = capacity
+        self.stats = None
+        self.sketches = None
+
+        if n_features is not None:
+            self._start(n_features)
+
+    def _start(self, n_features: int) -> None:
+
+        self.stats = RunningStats(n_features)
+
+        if self.method == "robust":
+            self.sketches = [QuantileSketch(self.capacity) for _ in range(n_features)]
+
+    @property
+    def n_features(self) -> int:
+        return len(self.stats.mean)
+
+    def partial_fit(
+        self, batch: np.ndarray, mask: Optional[np.ndarray] = None
+    ) -> "Normalizer":
+        """
+        Adds a batch, features along the last axis.
+
+        Args:
+            batch: Array of shape `(..., n_features)`.
+            mask: Boolean array of shape `batch.shape[:-1]` selecting the
+                entries to count, e.g. real pulses of a padded batch.
+
+        """
+
+        batch = np.asarray(batch)
+
+        if self.stats is None:
+            self._start(batch.shape[-1])
+
+        if mask is not None:
+            values = batch[np.asarray(mask, dtype=bool)]
+        else:
+            values = batch.reshape(-1, batch.shape[-1])
+
+        self.stats.update(values)
+
+        if self.sketches is not None:
+            for feature, sketch in enumerate(self.sketches):
+                sketch.update(values[:, feature])
+
+        return self
+
+    def add_zeros(self, count: int, n_features: Optional[int] = None) -> "Normalizer":
+        """
+        Counts `count` all zero entries without materializing them, e.g. the
+        empty DOMs of a sparse grid.
+        """
+
+        if count <= 0:
+            return self
+
+        if self.stats is None:
+            self._start(n_features)
+
+        zeros = RunningStats(self.n_features)
+        zeros.count = count
+        zeros.min = np.zeros(self.n_features)
+        zeros.max = np.zeros(self.n_features)
+
+        self.stats.merge(zeros)
+
+        if self.sketches is not None:
+            for sketch in self.sketches:
+                sketch._compress(
+                    np.concatenate((sketch.means, [0.0])),
+                    np.concatenate((sketch.weights, [float(count)])),
+                )
+
+        return self
+
+    def fit(self, batches: Iterable[np.ndarray]) -> "Normalizer":
+        """
+        Single pass over an iterable of batches.
+        """
+
+        for batch in batches:
+            self.partial_fit(batch)
+
+        return self
+
+    def merge(self, other: "Normalizer") -> "Normalizer":
+        """
+        Combines the partial statistics of another worker into this one.
+        """
+
+        assert other.method == self.method, "cannot merge different methods"
+
+        if other.stats is None:
+            return self
+
+        if self.stats is None:
+            self._start(other.n_features)
+
+        self.stats.merge(other.stats)
+
+        if self.sketches is not None:
+            for sketch, other_sketch in zip(self.sketches, other.sketches):
+                sketch.merge(other_sketch)
+
+        return self
+
+    @property
+    def shift(self) -> np.ndarray:
+
+        assert self.stats is not None and self.stats.count > 0, "fit before use"
+
+        if self.method == "min_max":
+            return self.stats.min
+        if self.method == "robust":
+            return np.array([sketch.quantile(0.5) for sketch in self.sketches])
+
+        return self.stats.mean
+
+    @property
+    def scale(self) -> np.ndarray:
+
+        assert self.stats is not None and self.stats.count > 0, "fit before use"
+
+        if self.method == "min_max":
+            scale = self.stats.max - self.stats.min
+        elif self.method == "robust":
+            scale = np.array(
+                [
+                    np.subtract(*sketch.quantile([0.75, 0.25]))
+                    for sketch in self.sketches
+                ]
+            )
+        else:
+            scale = np.sqrt(self.stats.variance)
+
+        # Constant features are only shifted
+        return np.where(scale > 0, scale, 1.0)
+
+    def transform(self, batch: np.ndarray, dtype=np.float32) -> np.ndarray:
+        """
+        Normalizes one batch, features along the last axis.
+        """
+
+        shift = self.shift.astype(dtype)
+        scale = self.scale.astype(dtype)
+
+        return (np.asarray(batch, dtype=dtype) - shift) / scale
+
+    def keras_layer(self, name: Optional[str] = None):
+        """
+        `keras.layers.Normalization` applying this normalization in graph.
+        """
+
+        from keras import layers
+
+        return layers.Normalization(
+            axis=-1, mean=self.shift, variance=self.scale**2, name=name
+        )
+
+    def save(self, path: str) -> str:
+        """
+        Writes the statistics to a `.npz` file.
+        """
+
+        arrays = {
+            "method": np.array(self.method),
+            "capacity": np.array(self.capacity),
+            "count": np.array(self.stats.count),
+            "mean": self.stats.mean,
+            "m2": self.stats.m2,
+            "min": self.stats.min,
+            "max": self.stats.max,
+        }
+
+        if self.sketches is not None:
+            for feature, sketch in enumerate(self.sketches):
+                arrays[f"sketch_means_{feature}"] = sketch.means
+                arrays[f"sketch_weights_{feature}"] = sketch.weights
+
+        np.savez(path, **arrays)
+
+        return path
+
+    @classmethod
+    def load(cls, path: str) -> "Normalizer":
+        """
+        Reads statistics written by `save`.
+        """
+
+        with np.load(path) as arrays:
+            normalizer = cls(
+                str(arrays["method"]), len(arrays["mean"]), int(arrays["capacity"])
+            )
+
+            normalizer.stats.count = int(arrays["count"])
+            normalizer.stats.mean = arrays["mean"]
+            normalizer.stats.m2 = arrays["m2"]
+            normalizer.stats.min = arrays["min"]
+            normalizer.stats.max = arrays["max"]
+
+            if normalizer.sketches is not None:
+                for feature, sketch in enumerate(normalizer.sketches):
+                    sketch.means = arrays[f"sketch_means_{feature}"]
+                    sketch.weights = arrays[f"sketch_weights_{feature}"]
+
+        return normalizer
+
+
+def _fit_file(path, dataset, method, block_rows, ignore_zeros) -> Normalizer:
+    """
+    Worker computing partial statistics of one dataset of one file.
+    """
+
+    normalizer = Normalizer(method)
+
+    with h5py.File(path, "r") as hdf:
+        data = hdf[dataset]
+        storage = storage_of(data)
+
+        for start in range(0, data.shape[0], block_rows):
+            block = decode(data[start : start + block_rows], storage)
+
+            mask = None
+            if ignore_zeros:
+                mask = np.any(block != 0, axis=-1)
+
+            normalizer.partial_fit(block, mask)
+
+    return normalizer
+
+
+def fit_files(
+    paths: Sequence[str],
+    dataset: str,
+    method: str = "standard_scaler",
+    block_rows: int = 4096,
+    ignore_zeros: bool = False,
+    workers: Optional[int] = None,
+) -> Normalizer:
+    """
+    Computes normalization statistics of `dataset` over many HDF5 files in a
+    single streaming pass, one worker process per file, and merges them.
+
+    Args:
+        paths: HDF5 files.
+        dataset: Dataset to normalize, features along the last axis.
+        method: One of `NORM_METHODS`.
+        block_rows: Rows read at a time.
+        ignore_zeros: Skip entries whose features are all zero, e.g. DOMs
+            without hits.
+        workers: Number of worker processes, defaults to the CPU count.
+
+    """
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    arguments = [(path, dataset, method, block_rows, ignore_zeros) for path in paths]
+
+    normalizer = Normalizer(method)
+
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+            for partial in pool.map(_fit_file, *zip(*arguments)):
+                normalizer.merge(partial)
+    else:
+        for argument in arguments:
+            normalizer.merge(_fit_file(*argument))
+
+    return normalizer
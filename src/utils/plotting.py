@@ -8,6 +8,8 @@ import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
 
 # from utils.data_process import *
+from utils.geometry import load_geometry
+from utils.labels import LabelSchema
 from dataclasses import dataclass
 from typing import Union, Optional
 import matplotlib.colors as colors
@@ -104,16 +106,10 @@ def dom_plot():
 
     # Reading original dom positions from dat file
     dat = "/home/bread/Documents/projects/neutrino/data/model/DOM_Position_GeoCalibDetectorStatus_2020.Run134142.Pass2_V0.dat"
-    df = pd.read_csv(
-        dat,
-        delimiter=" ",
-        header=None,
-        names=["String", "Count", "X", "Y", "Z"],
-        skiprows=[0],
-    )
+    geometry = load_geometry(dat)
 
-    dc = df[df["String"] > 78]
-    df = df[df["String"] <= 78]
+    dc = geometry.dc
+    df = geometry.ic
 
     pulse, truth = get_db(
         "/home/bread/Documents/projects/neutrino/data/database/oscNext_genie_level5_v02.00_pass2.141122.000000.db"
@@ -127,23 +123,15 @@ def dom_plot():
 
     pulse = data.pulse
 
-    maximum = 0
-    index = 0
-
-    for i in range(len(pulse)):
-        if len(pulse[i]) > maximum:
-            index = i
-            maximum = len(pulse[i])
-
-    pulse = np.array(pulse[index])
+    pulse = pulse[np.argmax(pulse.lengths)]
 
     print(pulse)
 
     # Plotting
     fig = plt.figure()
     ax = fig.add_subplot(projection="3d")
-    ax.scatter(df["X"], df["Y"], df["Z"], s=0.55, alpha=0.55)
-    ax.scatter(dc["X"], dc["Y"], dc["Z"], s=0.55, alpha=0.55, color="orange")
+    ax.scatter(df["x"], df["y"], df["z"], s=0.55, alpha=0.55)
+    ax.scatter(dc["x"], dc["y"], dc["z"], s=0.55, alpha=0.55, color="orange")
     ax.scatter(pulse[:, 0], pulse[:, 1], pulse[:, 2], s=pulse[:, 3] * 15, color="red")
     plt.show()
 
@@ -222,12 +210,17 @@ def correlation_mapping():
 
     for file in files:
         hdf = h5py.File(file, "r")
-        inelasticity.extend(np.array(hdf["Y_test"][:, 14]))
-        anti.extend(np.array(hdf["Y_test"][:, 11]))
-        charge.extend(np.array(hdf["Y_test"][:, 12]))
-        time.extend(np.array(hdf["Y_test"][:, 3]))
-        zenith.extend(np.array(hdf["Y_test"][:, 1]))
-        azimuth.extend(np.array(hdf["Y_test"][:, 7]))
+        labels = LabelSchema.from_hdf(hdf).read(
+            hdf,
+            "test",
+            ["inelasticity", "is_antineutrino", "charge", "time", "zenith", "azimuth"],
+        )
+        inelasticity.extend(labels[:, 0])
+        anti.extend(labels[:, 1])
+        charge.extend(labels[:, 2])
+        time.extend(labels[:, 3])
+        zenith.extend(labels[:, 4])
+        azimuth.extend(labels[:, 5])
 
     data = pd.DataFrame(
         {
@@ -448,56 +441,13 @@ def plot_data_transform():
         "src/data/model/DOM_Position_GeoCalibDetectorStatus_2020.Run134142.Pass2_V0.dat"
     )
 
-    df = pd.read_csv(
-        dat,
-        delimiter=" ",
-        header=None,
-        names=["String", "Count", "X", "Y", "Z"],
-        skiprows=[0],
-    )
-
-    dc = df[df["String"] > 78]
-
-    plot_df = pd.DataFrame({"X": [1], "Y": [2], "Z": [2], "Charge": [3]})
-
-    x_pos = []
-    y_pos = []
-    z_pos = []
-    charge = []
-
-    for row in range(len(X_test_DC[0])):
-
-        indices = np.where(X_test_DC[0][row][:, 0] > 0.0)
-
-        string = dc[dc["String"] == 79 + row]
-
-        if len(indices[0]) > 0:
-
-            for index in indices[0]:
-                charge.append(X_test_DC[0][row][index][0])
-
-            print(indices[0])
-
-            x_positions = [
-                string.loc[string["Count"] == indices[0][i]]["X"].values[0]
-                for i in range(len(indices[0]))
-            ]
-            for x in x_positions:
-                x_pos.append(x)
+    geometry = load_geometry(dat)
 
-            y_positions = [
-                string.loc[string["Count"] == indices[0][i]]["Y"].values[0]
-                for i in range(len(indices[0]))
-            ]
-            for y in y_positions:
-                y_pos.append(y)
+    # Grid slots of the first test event with charge
+    rows, doms = np.nonzero(X_test_DC[0][:, :, 0] > 0.0)
 
-            z_positions = [
-                string.loc[string["Count"] == indices[0][i]]["Z"].values[0]
-                for i in range(len(indices[0]))
-            ]
-            for z in z_positions:
-                z_pos.append(z)
+    charge = X_test_DC[0][rows, doms, 0]
+    x_pos, y_pos, z_pos = geometry.grids["DC"][rows, doms].T
 
     # Plotting
     fig = plt.figure()
@@ -0,0 +1,353 @@
+import os
+import sys
+import time
+import glob
+import h5py
+import argparse
+import numpy as np
+
+from typing import Optional, Sequence
+
+# Storage types of the X_* grids, bfloat16 is kept as its uint16 bit pattern
+STORAGE_DTYPES = ["float32", "float16", "bfloat16"]
+
+# Relative rounding error of each storage type over its normal range
+UNIT_ROUNDOFF = {"float32": 2.0**-24, "float16": 2.0**-11, "bfloat16": 2.0**-8}
+
+SPLITS = ["train", "validate", "test"]
+
+
+def storage_of(dataset) -> str:
+    """
+    Storage type of a dataset, the `storage` attribute written by
+    `convert_precision` or else its dtype. Sparse grids are groups, their
+    type is that of `values`.
+    """
+
+    if "storage" in dataset.attrs:
+        return str(dataset.attrs["storage"])
+
+    if isinstance(dataset, h5py.Group):
+        dataset = dataset["values"]
+
+    return np.dtype(dataset.dtype).name
+
+
+def encode(X: np.ndarray, storage: str) -> np.ndarray:
+    """
+    Converts float values to `storage`, bfloat16 rounds to nearest even and
+    returns the upper 16 bits of the float32 pattern as uint16.
+    """
+
+    assert storage in STORAGE_DTYPES, f"storage must be one of {STORAGE_DTYPES}"
+
+    if storage != "bfloat16":
+        return np.asarray(X, dtype=storage)
+
+    bits = np.ascontiguousarray(X, dtype=np.float32).view(np.uint32)
+    rounding = ((bits >> 16) & 1) + np.uint32(0x7FFF)
+
+    return ((bits + rounding) >> 16).astype(np.uint16)
+
+
+def decode(X: np.ndarray, storage: str) -> np.ndarray:
+    """
+    Float32 values of an array stored as `storage`.
+    """
+
+    if storage == "bfloat16":
+        return (np.asarray(X, dtype=np.uint32) << 16).view(np.float32)
+
+    return np.asarray(X, dtype=np.float32)
+
+
+class PrecisionCheck:
+    """
+    Per feature worst case of a conversion to `storage`, accumulated one
+    block at a time. A feature passes when every value is finite and within
+    `atol + rtol * |x|` of its converted value, by default `rtol` is the unit
+    roundoff of `storage` so only overflow and loss of normal range fail.
+    """
+
+    def __init__(
+        self, storage: str, rtol: Optional[float] = None, atol: float = 0.0
+    ) -> None:
+        """Construct `PrecisionCheck`
+
+        Args:
+            storage: One of `STORAGE_DTYPES`.
+            rtol: Tolerated relative error, defaults to `UNIT_ROUNDOFF`.
+            atol: Tolerated absolute error.
+
+        """
+
+        self.storage = storage
+        self.rtol = UNIT_ROUNDOFF[storage] if rtol is None else rtol
+        self.atol = atol
+
+        self.max_abs = None
+        self.max_error = None
+        self.failures = None
+
+    def update(self, X: np.ndarray) -> "PrecisionCheck":
+
+        values = np.asarray(X, dtype=np.float64).reshape(-1, X.shape[-1])
+
+        # Overflow to inf is what the check looks for
+        with np.errstate(invalid="ignore", over="ignore"):
+            restored = decode(encode(values, self.storage), self.storage)
+            restored = restored.astype(np.float64)
+
+            error = np.abs(restored - values)
+            failed = ~np.isfinite(restored) | (
+                error > self.atol + self.rtol * np.abs(values)
+            )
+
+        if self.max_abs is None:
+            features = values.shape[1]
+            self.max_abs = np.zeros(features)
+            self.max_error = np.zeros(features)
+            self.failures = np.zeros(features, dtype=np.int64)
+
+        if len(values) > 0:
+            self.max_abs = np.maximum(self.max_abs, np.abs(values).max(axis=0))
+            self.max_error = np.maximum(
+                self.max_error, np.where(np.isfinite(error), error, np.inf).max(axis=0)
+            )
+            self.failures += failed.sum(axis=0)
+
+        return self
+
+    @property
+    def passed(self) -> bool:
+        return self.failures is not None and not self.failures.any()
+
+    def summary(self, names: Optional[Sequence[str]] = None) -> str:
+
+        if names is None:
+            names = [str(feature) for feature in range(len(self.failures))]
+
+        return "\n".join(
+            f"{name}: max |x| {peak:.4g}, max error {error:.4g}, {count} lossy values"
+            for name, peak, error, count in zip(
+                names, self.max_abs, self.max_error, self.failures
+            )
+        )
+
+
+def _feature_names(hdf: h5py.File, features: int) -> list:
+
+    if "grid_features" in hdf and len(hdf["grid_features"]) == features:
+        return [name.decode() for name in hdf["grid_features"][:]]
+
+    return [str(feature) for feature in range(features)]
+
+
+def convert_precision(
+    path: str,
+    output: str,
+    storage: str = "float16",
+    block_rows: int = 4096,
+    rtol: Optional[float] = None,
+    atol: float = 0.0,
+) -> str:
+    """
+    Rewrites the `X_*` grids of a training shard as `storage`, other datasets
+    are copied unchanged. Every grid is checked first, per feature, and the
+    conversion is refused when any value would lose more than the tolerance.
+
+    Args:
+        path: Dense `*_contained.hdf5` shard.
+        output: Converted shard, usually the same name in another directory.
+        storage: One of `STORAGE_DTYPES`.
+        block_rows: Events read at a time.
+        rtol: Tolerated relative error, defaults to the unit roundoff.
+        atol: Tolerated absolute error.
+
+    Returns:
+        Path of the converted shard.
+    """
+
+    assert os.path.abspath(path) != os.path.abspath(output), "output overwrites input"
+
+    with h5py.File(path, "r") as hdf:
+        grids = [name for name in hdf if name.startswith("X_")]
+
+        for name in grids:
+            check = PrecisionCheck(storage, rtol, atol)
+
+            for start in range(0, hdf[name].shape[0], block_rows):
+                check.update(
+                    decode(hdf[name][start : start + block_rows], storage_of(hdf[name]))
+                )
+
+            assert (
+                check.passed
+            ), f"{path} {name} is lossy as {storage}:\n" + check.summary(
+                _feature_names(hdf, hdf[name].shape[-1])
+            )
+
+        with h5py.File(output, "w") as out:
+            for name in hdf:
+                if name not in grids:
+                    hdf.copy(hdf[name], out, name)
+                    continue
+
+                source = hdf[name]
+                target = out.create_dataset(
+                    name,
+                    shape=source.shape,
+                    dtype=np.uint16 if storage == "bfloat16" else storage,
+                    chunks=source.chunks,
+                    compression=source.compression,
+                    compression_opts=source.compression_opts,
+                )
+                target.attrs["storage"] = storage
+
+                for start in range(0, source.shape[0], block_rows):
+                    block = decode(
+                        source[start : start + block_rows], storage_of(source)
+                    )
+                    target[start : start + len(block)] = encode(block, storage)
+
+    return output
+
+
+def report(
+    paths: Sequence[str],
+    output_dir: str,
+    storages: Sequence[str] = ("float16", "bfloat16"),
+    model_path: Optional[str] = None,
+    label: Optional[str] = None,
+    batch_size: int = 128,
+) -> dict:
+    """
+    Converts `paths` to every storage type under `output_dir` and compares
+    them with the originals: bytes on disk, time to stream the validation
+    grids, and with `model_path` the validation MAE of that trained model on
+    the upcast inputs.
+
+    Args:
+        paths: Dense float32 `*_contained.hdf5` shards.
+        output_dir: Directory of one sub directory per storage type.
+        storages: Storage types compared to the originals.
+        model_path: Trained Keras model, skips the MAE comparison when `None`.
+        label: Name of the label the model predicts.
+        batch_size: Events per batch.
+
+    Returns:
+        Dictionary from storage type to its measurements.
+    """
+
+    from model.pipeline import make_dataset
+    from utils.labels import DEFAULT_LABEL
+
+    label = label or DEFAULT_LABEL
+
+    model = None
+    if model_path is not None:
+        import keras
+
+        model = keras.models.load_model(model_path, compile=False)
+
+    converted = {"float32": list(paths)}
+
+    for storage in storages:
+        directory = os.path.join(output_dir, storage)
+        os.makedirs(directory, exist_ok=True)
+
+        converted[storage] = [
+            convert_precision(
+                path, os.path.join(directory, os.path.basename(path)), storage
+            )
+            for path in paths
+        ]
+
+    results = {}
+
+    for storage, files in converted.items():
+        result = {"disk_bytes": sum(os.path.getsize(path) for path in files)}
+
+        dataset = make_dataset(
+            files, "validate", batch_size=batch_size, label=label, shuffle_buffer=None
+        )
+
+        start = time.time()
+        for _ in dataset:
+            pass
+        result["read_seconds"] = time.time() - start
+
+        if model is not None:
+            errors = [
+                np.abs(model.predict_on_batch(X)[:, 0] - Y.numpy()) for X, Y in dataset
+            ]
+            result["val_mae"] = float(np.concatenate(errors).mean())
+
+        results[storage] = result
+
+    baseline = results["float32"]
+
+    for storage, result in results.items():
+        line = (
+            f"{storage:>9}: disk {result['disk_bytes'] / baseline['disk_bytes']:.2f}x, "
+            f"read {result['read_seconds']:.2f}s "
+            f"({baseline['read_seconds'] - result['read_seconds']:+.2f}s saved)"
+        )
+
+        if "val_mae" in result:
+            line += (
+                f", val MAE {result['val_mae']:.5f} "
+                f"({result['val_mae'] - baseline['val_mae']:+.5f})"
+            )
+
+        print(line)
+
+    return results
+
+
+def main(argv=None) -> None:
+    """
+    Command line interface, run from `src` with `python -m utils.precision`.
+    """
+
+    parser = argparse.ArgumentParser(description="Reduced precision training shards")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    convert = commands.add_parser("convert", help="rewrite the grids of every shard")
+    convert.add_argument("data_dir")
+    convert.add_argument("output_dir")
+    convert.add_argument("--storage", choices=STORAGE_DTYPES[1:], default="float16")
+    convert.add_argument("--rtol", type=float, default=None)
+    convert.add_argument("--atol", type=float, default=0.0)
+    convert.add_argument("--pattern", default="*_contained.hdf5")
+
+    compare = commands.add_parser("report", help="I/O time and MAE per storage type")
+    compare.add_argument("data_dir")
+    compare.add_argument("output_dir")
+    compare.add_argument("--model", default=None)
+    compare.add_argument("--label", default=None)
+    compare.add_argument("--pattern", default="*_contained.hdf5")
+
+    args = parser.parse_args(argv)
+
+    paths = sorted(glob.glob(os.path.join(args.data_dir, args.pattern)))
+
+    assert len(paths) > 0, f"no files matching `{args.pattern}` in {args.data_dir}"
+
+    if args.command == "convert":
+        os.makedirs(args.output_dir, exist_ok=True)
+
+        for path in paths:
+            output = os.path.join(args.output_dir, os.path.basename(path))
+            print(
+                convert_precision(
+                    path, output, args.storage, rtol=args.rtol, atol=args.atol
+                )
+            )
+
+    elif args.command == "report":
+        report(paths, args.output_dir, model_path=args.model, label=args.label)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,463 @@
+import os
+import sys
+import time
+import glob
+import h5py
+import argparse
+import numpy as np
+
+from typing import Optional, Sequence, Tuple
+
+from utils.labels import DEFAULT_LABEL, LabelSchema
+from utils.normalize import Normalizer
+from utils.precision import decode, storage_of
+from utils.valid_index import valid_index
+
+SPLITS = ["train", "validate", "test"]
+
+# Datasets copied unchanged from dense shards
+COPIED_DATASETS = ["output_label_names", "grid_features"]
+
+# Nonzero DOMs per HDF5 chunk of the sparse datasets
+SPARSE_CHUNK = 1 << 14
+
+
+class SparseGrid:
+    """
+    Compressed sparse rows of string by DOM grids. Event `i` owns the entries
+    `indptr[i]:indptr[i + 1]` of `slots`, the flat `string * n_doms + dom`
+    index of each DOM with any nonzero feature, and of `values`, the features
+    of that DOM. Most DOMs of an event see no light, so this is a small
+    fraction of the dense `(n, strings, doms, features)` array.
+    """
+
+    def __init__(
+        self,
+        indptr: np.ndarray,
+        slots: np.ndarray,
+        values: np.ndarray,
+        shape: Tuple[int, int, int],
+    ) -> None:
+        """Construct `SparseGrid`
+
+        Args:
+            indptr: Offsets of the entries of every event, `n + 1` values.
+            slots: Flat DOM slot of every entry.
+            values: Features of every entry.
+            shape: Dense shape of one event, `(strings, doms, features)`.
+
+        """
+
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.slots = np.asarray(slots, dtype=np.int32)
+        self.values = np.asarray(values)
+        self.shape = tuple(int(size) for size in shape)
+
+    @classmethod
+    def from_dense(cls, X: np.ndarray) -> "SparseGrid":
+
+        n, strings, doms, features = X.shape
+
+        flat = X.reshape(n, strings * doms, features)
+        events, slots = np.nonzero(np.any(flat != 0, axis=-1))
+
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(events, minlength=n), out=indptr[1:])
+
+        return cls(indptr, slots, flat[events, slots], (strings, doms, features))
+
+    def __len__(self) -> int:
+        return len(self.indptr) - 1
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    @property
+    def nbytes(self) -> int:
+        return self.indptr.nbytes + self.slots.nbytes + self.values.nbytes
+
+    def take(self, indices) -> "SparseGrid":
+        """
+        Gathers the given events into a new compact grid (copies).
+        """
+
+        indices = np.asarray(indices, dtype=np.int64)
+
+        lengths = self.lengths[indices]
+        indptr = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+
+        rows = np.repeat(self.indptr[indices] - indptr[:-1], lengths)
+        rows += np.arange(indptr[-1])
+
+        return SparseGrid(indptr, self.slots[rows], self.values[rows], self.shape)
+
+    def to_dense(self) -> np.ndarray:
+        """
+        Scatters the entries into the dense `(n, strings, doms, features)` array.
+        """
+
+        strings, doms, features = self.shape
+
+        dense = np.zeros((len(self), strings * doms, features), dtype=self.values.dtype)
+        dense[np.repeat(np.arange(len(self)), self.lengths), self.slots] = self.values
+
+        return dense.reshape(len(self), strings, doms, features)
+
+    def write(self, hdf: h5py.File, name: str, compression: Optional[str] = None):
+        """
+        Writes the grid as group `name` holding `indptr`, `slots` and `values`.
+        """
+
+        group = hdf.create_group(name)
+        group.attrs["shape"] = self.shape
+        group.attrs["storage"] = np.dtype(self.values.dtype).name
+
+        group.create_dataset("indptr", data=self.indptr)
+
+        entries = len(self.slots)
+        chunks = (min(entries, SPARSE_CHUNK),) if entries > 0 else None
+
+        group.create_dataset(
+            "slots", data=self.slots, chunks=chunks, compression=compression
+        )
+        group.create_dataset(
+            "values",
+            data=self.values,
+            chunks=None if chunks is None else chunks + self.values.shape[1:],
+            compression=compression,
+        )
+
+        return group
+
+    @classmethod
+    def read(cls, group: h5py.Group, start: int = 0, stop: Optional[int] = None):
+        """
+        Reads events `start:stop` of a group written by `write`, one contiguous
+        slice of each dataset.
+        """
+
+        if stop is None:
+            stop = len(group["indptr"]) - 1
+
+        indptr = group["indptr"][start : stop + 1]
+        first, last = indptr[0], indptr[-1]
+
+        return cls(
+            indptr - first,
+            group["slots"][first:last],
+            group["values"][first:last],
+            group.attrs["shape"],
+        )
+
+
+def is_sparse(hdf: h5py.File, name: str) -> bool:
+    return isinstance(hdf.get(name), h5py.Group)
+
+
+def sparse_shapes(path: str, split: str = "train") -> dict:
+    """
+    Dense shapes and dtypes of the datasets of one split of a sparse shard,
+    the counterpart of `model.pipeline.dataset_shapes`.
+    """
+
+    with h5py.File(path, "r") as hdf:
+        shapes = {}
+
+        for detector in ["DC", "IC"]:
+            group = hdf[f"X_{split}_{detector}"]
+            n = len(group["indptr"]) - 1
+
+            shapes[group.name[1:]] = (
+                (n, *group.attrs["shape"]),
+                group["values"].dtype,
+            )
+
+        shapes[f"Y_{split}"] = (hdf[f"Y_{split}"].shape, hdf[f"Y_{split}"].dtype)
+
+    return shapes
+
+
+def sparsify_file(
+    path: str,
+    output: Optional[str] = None,
+    block_rows: int = 4096,
+    compression: Optional[str] = None,
+) -> str:
+    """
+    Converts a dense `*_contained.hdf5` shard to a sparse shard, streaming
+    `block_rows` events at a time. Labels and metadata are copied unchanged.
+
+    Args:
+        path: Dense HDF5 shard.
+        output: Sparse shard, defaults to `*_sparse.hdf5` next to `path`.
+        block_rows: Events converted per read.
+        compression: HDF5 compression filter of the sparse datasets.
+
+    Returns:
+        Path of the sparse shard.
+    """
+
+    if output is None:
+        output = os.path.splitext(path)[0] + "_sparse.hdf5"
+
+    with h5py.File(path, "r") as hdf, h5py.File(output, "w") as out:
+
+        for name in COPIED_DATASETS:
+            if name in hdf:
+                out.create_dataset(name, data=hdf[name][:])
+
+        for split in SPLITS:
+            for name in [f"Y_{split}", f"event_no_{split}"]:
+                if name in hdf:
+                    hdf.copy(hdf[name], out, name)
+
+            for detector in ["DC", "IC"]:
+                dense = hdf[f"X_{split}_{detector}"]
+                n, strings, doms, features = dense.shape
+
+                group = out.create_group(f"X_{split}_{detector}")
+                group.attrs["shape"] = (strings, doms, features)
+                group.attrs["storage"] = storage_of(dense)
+
+                indptr = group.create_dataset("indptr", shape=(n + 1,), dtype=np.int64)
+                slots = group.create_dataset(
+                    "slots",
+                    shape=(0,),
+                    maxshape=(None,),
+                    chunks=(SPARSE_CHUNK,),
+                    dtype=np.int32,
+                    compression=compression,
+                )
+                values = group.create_dataset(
+                    "values",
+                    shape=(0, features),
+                    maxshape=(None, features),
+                    chunks=(SPARSE_CHUNK, features),
+                    dtype=dense.dtype,
+                    compression=compression,
+                )
+
+                indptr[0] = 0
+                entries = 0
+
+                for start in range(0, n, block_rows):
+                    block = SparseGrid.from_dense(dense[start : start + block_rows])
+
+                    stop = entries + len(block.slots)
+
+                    slots.resize((stop,))
+                    values.resize((stop, features))
+                    slots[entries:stop] = block.slots
+                    values[entries:stop] = block.values
+
+                    rows = slice(start + 1, start + len(block) + 1)
+                    indptr[rows] = block.indptr[1:] + entries
+                    entries = stop
+
+    return output
+
+
+def read_sparse_batches(
+    path,
+    split: str = "train",
+    batch_size: int = 128,
+    label: str = DEFAULT_LABEL,
+    block_rows: int = 4096,
+    valid_only: bool = True,
+    shuffle: bool = False,
+    seed: Optional[int] = None,
+):
+    """
+    Generator of the batches of one sparse shard, still sparse. Each batch is
+    `((lengths_DC, slots_DC, values_DC), (lengths_IC, slots_IC, values_IC)), Y`
+    with `lengths` the entries of every event, densified per batch by
+    `model.pipeline.densify`.
+
+    Args:
+        path: Sparse HDF5 shard.
+        split: `train`, `validate` or `test`.
+        batch_size: Events per batch.
+        label: Name of the label used as target.
+        block_rows: Events read at a time.
+        valid_only: Drop events whose label is not positive.
+        shuffle: Shuffle events within each block.
+        seed: Shuffle seed.
+
+    """
+
+    if isinstance(path, bytes):
+        path = path.decode()
+
+    rng = np.random.default_rng(seed)
+
+    with h5py.File(path, "r") as hdf:
+        labels = LabelSchema.from_hdf(hdf).read(hdf, split, label)
+
+        if valid_only:
+            rows = valid_index(path, label, hdf).rows[split]
+        else:
+            rows = np.arange(len(labels))
+
+        groups = [hdf[f"X_{split}_DC"], hdf[f"X_{split}_IC"]]
+
+        for first in range(0, len(rows), block_rows):
+            block = rows[first : first + block_rows]
+
+            start, stop = block[0], block[-1] + 1
+            events = block - start
+
+            if shuffle:
+                events = rng.permutation(events)
+
+            grids = [
+                SparseGrid.read(group, start, stop).take(events) for group in groups
+            ]
+            Y = labels[events + start]
+
+            for batch in range(0, len(events), batch_size):
+                end = min(batch + batch_size, len(events))
+                parts = []
+
+                # Events of a taken grid are compact, a batch is one slice
+                for grid in grids:
+                    lo, hi = grid.indptr[batch], grid.indptr[end]
+                    parts.append(
+                        (
+                            grid.lengths[batch:end],
+                            grid.slots[lo:hi],
+                            grid.values[lo:hi],
+                        )
+                    )
+
+                yield tuple(parts), Y[batch:end]
+
+
+def fit_sparse_files(
+    paths: Sequence[str], name: str, method: str = "standard_scaler"
+) -> Normalizer:
+    """
+    Normalization statistics of the sparse grid `name` over many shards,
+    equal to `utils.normalize.fit_files` on the dense arrays. Only the
+    nonzero DOMs are read, the empty ones are counted as zeros.
+    """
+
+    normalizer = Normalizer(method)
+
+    for path in paths:
+        with h5py.File(path, "r") as hdf:
+            group = hdf[name]
+            strings, doms, _ = group.attrs["shape"]
+            values = group["values"]
+            storage = storage_of(group)
+
+            for start in range(0, len(values), SPARSE_CHUNK):
+                normalizer.partial_fit(
+                    decode(values[start : start + SPARSE_CHUNK], storage)
+                )
+
+            empty = (len(group["indptr"]) - 1) * strings * doms - len(values)
+            normalizer.add_zeros(empty, values.shape[1])
+
+    return normalizer
+
+
+def _timed_batches(dataset, batches: int) -> Tuple[int, float]:
+
+    events = 0
+    start = time.time()
+
+    for _, Y in dataset.take(batches):
+        events += len(Y)
+
+    return events, time.time() - start
+
+
+def benchmark(paths: Sequence[str], batch_size: int = 128, batches: int = 200):
+    """
+    Compares dense shards with their sparse conversions: size on disk, bytes
+    in memory per event and events per second through the input pipeline.
+
+    Args:
+        paths: Dense `*_contained.hdf5` shards, converted when no sparse shard
+            exists next to them.
+        batch_size: Events per batch.
+        batches: Batches timed per pipeline.
+
+    Returns:
+        Dictionary of the measurements.
+    """
+
+    from model.pipeline import make_dataset, make_sparse_dataset
+
+    sparse = []
+
+    for path in paths:
+        output = os.path.splitext(path)[0] + "_sparse.hdf5"
+
+        if not os.path.exists(output):
+            sparsify_file(path, output)
+
+        sparse.append(output)
+
+    report = {
+        "dense_disk_bytes": sum(os.path.getsize(path) for path in paths),
+        "sparse_disk_bytes": sum(os.path.getsize(path) for path in sparse),
+    }
+
+    with h5py.File(paths[0], "r") as hdf:
+        dense = hdf["X_train_DC"][:batch_size]
+        report["dense_event_bytes"] = dense.nbytes / len(dense)
+        report["sparse_event_bytes"] = SparseGrid.from_dense(dense).nbytes / len(dense)
+
+    # First pass builds the valid indexes and warms the page cache
+    for name, dataset in [
+        ("dense", make_dataset(paths, batch_size=batch_size, shuffle_buffer=None)),
+        ("sparse", make_sparse_dataset(sparse, batch_size=batch_size, shuffle=False)),
+    ]:
+        _timed_batches(dataset, batches)
+        events, seconds = _timed_batches(dataset, batches)
+        report[f"{name}_events_per_second"] = events / seconds
+
+    for key, value in report.items():
+        print(f"{key:>28}: {value:,.1f}")
+
+    return report
+
+
+def main(argv=None) -> None:
+    """
+    Command line interface, run from `src` with `python -m utils.sparse_grid`.
+    """
+
+    parser = argparse.ArgumentParser(description="Sparse DC/IC training shards")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    convert = commands.add_parser("convert", help="write *_sparse.hdf5 shards")
+    convert.add_argument("data_dir")
+    convert.add_argument("--pattern", default="*_contained.hdf5")
+    convert.add_argument("--compression", default=None)
+
+    timing = commands.add_parser("benchmark", help="compare dense and sparse shards")
+    timing.add_argument("data_dir")
+    timing.add_argument("--pattern", default="*_contained.hdf5")
+    timing.add_argument("--batch-size", type=int, default=128)
+    timing.add_argument("--batches", type=int, default=200)
+
+    args = parser.parse_args(argv)
+
+    paths = sorted(glob.glob(os.path.join(args.data_dir, args.pattern)))
+
+    assert len(paths) > 0, f"no files matching `{args.pattern}` in {args.data_dir}"
+
+    if args.command == "convert":
+        for path in paths:
+            print(sparsify_file(path, compression=args.compression))
+
+    elif args.command == "benchmark":
+        benchmark(paths, args.batch_size, args.batches)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
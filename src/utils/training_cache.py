@@ -0,0 +1,164 @@
+import os
+import sys
+import glob
+import json
+import h5py
+import argparse
+import numpy as np
+
+from typing import Sequence
+
+from utils.cache import fingerprint
+from utils.labels import DEFAULT_LABEL, LabelSchema
+from utils.precision import storage_of
+from utils.valid_index import contiguous_runs, read_runs, valid_index
+
+SPLITS = ["train", "validate", "test"]
+MANIFEST = "manifest.json"
+
+
+def convert(
+    files: Sequence[str],
+    output_dir: str,
+    label: str = DEFAULT_LABEL,
+    valid_only: bool = True,
+) -> dict:
+    """
+    One time conversion of `*_contained.hdf5` files to contiguous uncompressed
+    `.npy` files, `X_{split}_DC`, `X_{split}_IC` and `Y_{split}` holding only
+    the selected label, plus a `manifest.json`. The outputs are
+    preallocated and valid rows are read run by run straight into them.
+
+    Args:
+        files: HDF5 files, concatenated in this order.
+        output_dir: Directory of the `.npy` files.
+        label: Name of the label kept as target.
+        valid_only: Keep only events whose label is positive.
+
+    Returns:
+        The manifest.
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    manifest = {
+        "label": label,
+        "valid_only": valid_only,
+        "files": [list(fingerprint(path)) for path in files],
+        "arrays": {},
+        "rows": {},
+    }
+
+    for split in SPLITS:
+        rows = []
+        layout = {}
+
+        for path in files:
+            with h5py.File(path, "r") as hdf:
+                if valid_only:
+                    rows.append(valid_index(path, label, hdf).rows[split])
+                else:
+                    rows.append(np.arange(hdf[f"Y_{split}"].shape[0]))
+
+                for name in [f"X_{split}_DC", f"X_{split}_IC", f"Y_{split}"]:
+                    if name not in layout:
+                        shape = hdf[name].shape[1:]
+                        if name.startswith("Y_"):
+                            shape = ()
+                        layout[name] = (shape, hdf[name].dtype, storage_of(hdf[name]))
+
+        total = sum(len(row) for row in rows)
+        manifest["rows"][split] = [len(row) for row in rows]
+
+        outputs = {}
+        for name, (shape, dtype, storage) in layout.items():
+            path = os.path.join(output_dir, f"{name}.npy")
+            outputs[name] = np.lib.format.open_memmap(
+                path, mode="w+", dtype=dtype, shape=(total,) + shape
+            )
+            manifest["arrays"][name] = {
+                "file": f"{name}.npy",
+                "shape": [total, *shape],
+                "dtype": np.dtype(dtype).str,
+                "storage": storage,
+            }
+
+        offset = 0
+
+        for path, valid in zip(files, rows):
+            print(path, split)
+
+            with h5py.File(path, "r") as hdf:
+                schema = LabelSchema.from_hdf(hdf)
+                runs = contiguous_runs(valid)
+                target = slice(offset, offset + len(valid))
+
+                for name, output in outputs.items():
+                    if name.startswith("Y_"):
+                        output[target] = schema.read(hdf, split, label)[valid]
+                    else:
+                        # Valid runs are read straight into the mapped output
+                        read_runs(hdf[name], runs, output[target])
+
+            offset += len(valid)
+
+        for output in outputs.values():
+            output.flush()
+
+        del outputs
+
+    with open(os.path.join(output_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
+
+
+def open_training_cache(directory: str) -> dict:
+    """
+    Opens every array of a converted training cache with `np.memmap`, reads
+    are zero copy page cache hits shared by every process on the node.
+
+    Args:
+        directory: Directory written by `convert`.
+
+    Returns:
+        Dictionary from dataset name to memory mapped array, plus the
+        `manifest` entry.
+    """
+
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+
+    arrays = {"manifest": manifest}
+
+    for name, entry in manifest["arrays"].items():
+        arrays[name] = np.load(os.path.join(directory, entry["file"]), mmap_mode="r")
+
+    return arrays
+
+
+def main(argv=None) -> None:
+    """
+    Command line interface, run from `src` with `python -m utils.training_cache`.
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Convert *_contained.hdf5 files to a memory mapped cache"
+    )
+    parser.add_argument("data_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--pattern", default="*_contained.hdf5")
+    parser.add_argument("--label", default=DEFAULT_LABEL)
+    parser.add_argument("--keep-invalid", action="store_true")
+
+    args = parser.parse_args(argv)
+
+    files = sorted(glob.glob(os.path.join(args.data_dir, args.pattern)))
+
+    assert len(files) > 0, f"no files matching `{args.pattern}` in {args.data_dir}"
+
+    convert(files, args.output_dir, args.label, not args.keep_invalid)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
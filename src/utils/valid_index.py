@@ -0,0 +1,278 @@
+import os
+import h5py
+import numpy as np
+
+from typing import Optional, Sequence
+
+from utils.labels import DEFAULT_LABEL, LabelSchema
+
+SPLITS = ["train", "validate", "test"]
+
+# Used when the directory of a training file is not writable
+cachedir = "./cache/valid"
+
+
+def contiguous_runs(rows: np.ndarray) -> np.ndarray:
+    """
+    Half open `(start, stop)` runs of consecutive values of increasing `rows`.
+    """
+
+    rows = np.asarray(rows, dtype=np.int64)
+
+    if len(rows) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+
+    starts = rows[np.concatenate(([0], breaks))]
+    stops = rows[np.concatenate((breaks - 1, [len(rows) - 1]))] + 1
+
+    return np.stack((starts, stops), axis=1)
+
+
+def chunk_groups(runs: np.ndarray, chunk_rows: Optional[int]) -> list:
+    """
+    Groups consecutive `(start, stop)` runs sharing an HDF5 chunk of
+    `chunk_rows` rows, every run is its own group for unchunked datasets.
+    """
+
+    if chunk_rows is None:
+        return [[run] for run in runs]
+
+    groups = []
+
+    for start, stop in runs:
+        if groups and start // chunk_rows <= (groups[-1][-1][1] - 1) // chunk_rows:
+            groups[-1].append((start, stop))
+        else:
+            groups.append([(start, stop)])
+
+    return groups
+
+
+def read_runs(
+    dataset: h5py.Dataset, runs: np.ndarray, out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Reads the rows of `runs` of `dataset` into `out`. A run is read straight
+    into `out` with one slice, runs sharing a chunk are read with one slice
+    over all of them and copied out, so every chunk is decompressed once
+    however fragmented the runs are. No full size intermediate is made.
+
+    Args:
+        dataset: HDF5 dataset.
+        runs: `(start, stop)` row runs.
+        out: Destination of `sum(stop - start)` rows, allocated when `None`.
+
+    Returns:
+        The rows of every run, in order.
+    """
+
+    count = int(sum(stop - start for start, stop in runs))
+
+    if out is None:
+        out = np.empty((count,) + dataset.shape[1:], dtype=dataset.dtype)
+
+    assert len(out) == count, f"output holds {len(out)} rows, runs hold {count}"
+
+    chunk_rows = None if dataset.chunks is None else dataset.chunks[0]
+
+    position = 0
+
+    for group in chunk_groups(runs, chunk_rows):
+        if len(group) == 1:
+            start, stop = group[0]
+            size = stop - start
+            dataset.read_direct(
+                out, np.s_[start:stop], np.s_[position : position + size]
+            )
+            position += size
+            continue
+
+        first, last = group[0][0], group[-1][1]
+        block = dataset[first:last]
+
+        for start, stop in group:
+            size = stop - start
+            out[position : position + size] = block[start - first : stop - first]
+            position += size
+
+    return out
+
+
+class ValidIndex:
+    """
+    Rows of every split of one training file whose label is positive, with
+    their contiguous runs. Built once per file and label and stored in a
+    `.npz` sidecar next to the file, so loaders read only the valid rows
+    instead of filtering a full copy.
+    """
+
+    def __init__(self, rows: dict, label: str = DEFAULT_LABEL) -> None:
+        """Construct `ValidIndex`
+
+        Args:
+            rows: Dictionary from split to increasing valid row ids.
+            label: Label the rows were selected on.
+
+        """
+
+        self.label = label
+        self.rows = {split: np.asarray(rows[split], dtype=np.int64) for split in rows}
+        self.runs = {split: contiguous_runs(rows) for split, rows in self.rows.items()}
+
+    def count(self, split: str) -> int:
+        return len(self.rows[split])
+
+    def blocks(self, split: str, block_rows: int):
+        """
+        Generator of the runs of `split` falling in each window of
+        `block_rows` file rows, runs crossing a window edge are split.
+        """
+
+        window, pieces = None, []
+
+        for start, stop in self.runs[split]:
+            while start < stop:
+                current = start // block_rows
+                end = min(stop, (current + 1) * block_rows)
+
+                if current != window and pieces:
+                    yield pieces
+                    pieces = []
+
+                window = current
+                pieces.append((start, end))
+                start = end
+
+        if pieces:
+            yield pieces
+
+    def read(
+        self, dataset: h5py.Dataset, split: str, out: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """
+        Reads the valid rows of `split` of `dataset`.
+        """
+
+        return read_runs(dataset, self.runs[split], out)
+
+    @classmethod
+    def build(
+        cls, hdf: h5py.File, label: str = DEFAULT_LABEL, splits: Sequence[str] = SPLITS
+    ) -> "ValidIndex":
+
+        schema = LabelSchema.from_hdf(hdf)
+
+        rows = {
+            split: np.flatnonzero(schema.read(hdf, split, label) > 0)
+            for split in splits
+        }
+
+        return cls(rows, label)
+
+    def save(self, path: str, source: str) -> str:
+        """
+        Writes the index of the file at `source` to `path`.
+        """
+
+        stat = os.stat(source)
+
+        arrays = {
+            "label": np.array(self.label),
+            "source_size": np.array(stat.st_size),
+            "source_mtime_ns": np.array(stat.st_mtime_ns),
+        }
+
+        for split in self.rows:
+            arrays[f"rows_{split}"] = self.rows[split]
+            arrays[f"runs_{split}"] = self.runs[split]
+
+        # Written under a temporary name so readers never see a partial file
+        temporary = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(temporary, **arrays)
+        os.replace(temporary, path)
+
+        return path
+
+    @classmethod
+    def load(cls, path: str, source: Optional[str] = None) -> Optional["ValidIndex"]:
+        """
+        Reads an index written by `save`, `None` when it is missing or older
+        than the file at `source`.
+        """
+
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as arrays:
+            if source is not None:
+                stat = os.stat(source)
+
+                if (
+                    int(arrays["source_size"]) != stat.st_size
+                    or int(arrays["source_mtime_ns"]) != stat.st_mtime_ns
+                ):
+                    return None
+
+            rows = {
+                name[len("rows_") :]: arrays[name]
+                for name in arrays.files
+                if name.startswith("rows_")
+            }
+
+            index = cls(rows, str(arrays["label"]))
+
+            for split in rows:
+                index.runs[split] = arrays[f"runs_{split}"]
+
+        return index
+
+
+def sidecar_path(path: str, label: str = DEFAULT_LABEL) -> str:
+    """
+    Sidecar of the file at `path`, next to it when its directory is writable,
+    otherwise under `cachedir`.
+    """
+
+    directory, name = os.path.split(os.path.abspath(path))
+
+    if not os.access(directory, os.W_OK):
+        directory = os.path.join(cachedir, directory.strip(os.sep).replace(os.sep, "_"))
+        os.makedirs(directory, exist_ok=True)
+
+    return os.path.join(directory, f"{name}.{label}.valid.npz")
+
+
+def valid_index(
+    path: str, label: str = DEFAULT_LABEL, hdf: Optional[h5py.File] = None
+) -> ValidIndex:
+    """
+    Valid row index of the training file at `path`, read from its sidecar or
+    built and saved when the sidecar is missing or stale.
+
+    Args:
+        path: HDF5 training file.
+        label: Label whose positive values mark valid events.
+        hdf: The file already open, opened here when `None`.
+
+    Returns:
+        Index of every split.
+    """
+
+    sidecar = sidecar_path(path, label)
+
+    index = ValidIndex.load(sidecar, path)
+
+    if index is not None:
+        return index
+
+    if hdf is None:
+        with h5py.File(path, "r") as hdf:
+            index = ValidIndex.build(hdf, label)
+    else:
+        index = ValidIndex.build(hdf, label)
+
+    index.save(sidecar, path)
+
+    return index